@@ -0,0 +1,6 @@
+"""Reproducible data generation and load testing for the musicmain API.
+
+    python -m bench.datagen --scale 0.1 --truncate
+    python -m bench.driver --scale 0.1 --out results/run.json
+    python -m bench.compare results/before.json results/after.json
+"""
@@ -0,0 +1,94 @@
+"""Compare requests/sec of the sync and async database backends.
+
+Starts the server once per DB_BACKEND, drives the same endpoints at high
+concurrency with bench.driver, and writes both result sets plus the
+async/sync throughput ratio per endpoint:
+
+    python -m bench.backends --scale 0.1 --concurrency 256 --out results/backends.json
+
+Each server is a single uvicorn worker with the same DB_POOL_SIZE, so the
+difference is threadpool handlers versus the event loop. Rate limits and
+route concurrency caps (src/admission.py) are turned off so neither backend
+has requests shed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import dotenv
+import httpx
+
+from bench import driver
+
+dotenv.load_dotenv()
+
+BACKENDS = ("sync", "async")
+
+# Endpoints served by src/api/musicmain_async.py that don't grow the dataset between runs.
+ENDPOINTS = ["search_for_song", "search_for_artist", "search_for_album", "artist_albums", "album_songs",
+             "song_info", "album_info", "get_total_streams", "get_stream_by_artist", "view_playlist",
+             "top_streams", "top_streams_window", "playlist_recommend"]
+
+
+def start_server(backend, port, startup_timeout=60):
+    """Launch uvicorn with DB_BACKEND=backend and wait until it answers."""
+    env = {**os.environ, "DB_BACKEND": backend, "RATE_LIMIT_PER_SECOND": "0", "ROUTE_CONCURRENCY_SHARE": "0"}
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "src.api.server:app", "--port", str(port),
+                               "--log-level", "warning"], env=env)
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"{backend} server exited with status {server.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/", timeout=1).is_success:
+                return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"{backend} server did not start within {startup_timeout}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.backends", description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=3100)
+    parser.add_argument("--api-key", default=os.environ.get("API_KEY", ""))
+    parser.add_argument("--scale", type=float, default=1.0, help="scale bench.datagen was run with")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="*", choices=ENDPOINTS, help="run just these endpoints")
+    parser.add_argument("--out", help="write results JSON here")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for backend in BACKENDS:
+        server = start_server(backend, args.port)
+        try:
+            print(f"-- {backend}", flush=True)
+            os.environ["DB_BACKEND"] = backend
+            results[backend] = driver.run(f"http://127.0.0.1:{args.port}", args.api_key, args.scale, args.requests,
+                                          args.concurrency, args.seed, args.only or ENDPOINTS)
+        finally:
+            server.terminate()
+            server.wait()
+
+    ratios = {}
+    for name, sync in results["sync"]["endpoints"].items():
+        ratio = results["async"]["endpoints"][name]["throughput_rps"] / sync["throughput_rps"] if sync["throughput_rps"] else 0.0
+        ratios[name] = round(ratio, 2)
+        print(f"{name:28} sync {sync['throughput_rps']:>9} rps  async "
+              f"{results['async']['endpoints'][name]['throughput_rps']:>9} rps  ({ratio:.2f}x)")
+    results["async_over_sync_throughput"] = ratios
+
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,48 @@
+"""Diff two bench.driver result files and flag regressions.
+
+    python -m bench.compare results/before.json results/after.json --tolerance 0.2
+
+Exits 1 when any endpoint's p99 grew, or its throughput fell, by more than
+the tolerance.
+"""
+import argparse
+import json
+import sys
+
+
+def compare(before, after, tolerance):
+    """Per-endpoint changes as (name, metric, before, after, ratio, regressed) rows."""
+    rows = []
+    for name, new in after["endpoints"].items():
+        old = before["endpoints"].get(name)
+        if old is None:
+            continue
+        for metric, higher_is_worse in (("p50_ms", True), ("p99_ms", True), ("throughput_rps", False)):
+            ratio = new[metric] / old[metric] if old[metric] else 1.0
+            regressed = ratio > 1 + tolerance if higher_is_worse else ratio < 1 - tolerance
+            rows.append((name, metric, old[metric], new[metric], ratio, regressed and metric != "p50_ms"))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.compare", description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change")
+    args = parser.parse_args(argv)
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    regressions = 0
+    for name, metric, old, new, ratio, regressed in compare(before, after, args.tolerance):
+        regressions += regressed
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:28} {metric:15} {old:>10} -> {new:>10} ({ratio - 1:+.0%}){flag}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""Seeded, parallel fake-data generator for a local Postgres.
+
+Fills users, artist, album, song, user_playlist, song_playlist and streams in
+the proportions of docs/performance_writeup.md, multiplied by --scale. The
+large tables are cut into chunks that worker processes generate and COPY in
+parallel; each chunk has its own seed derived from --seed, and timestamps
+count back a year from --anchor (a fixed date unless given), so the same
+arguments always produce the same rows. The rollups and the co-occurrence
+index are rebuilt at the end so the API serves the generated data.
+
+    python -m bench.datagen --scale 1.0 --workers 8 --truncate
+"""
+import argparse
+import csv
+import io
+import multiprocessing
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import psycopg2
+import sqlalchemy
+
+from bench import dataset
+from src import database as db
+
+CHUNK_ROWS = 500000
+HISTORY_SECONDS = 365 * 24 * 3600
+SONG_POPULARITY = 1.15  # zipf exponent; a few songs get most plays
+DEFAULT_ANCHOR = datetime(2025, 1, 1)  # newest timestamp generated, UTC
+
+TABLES = ["streams", "song_playlist", "explicit_submissions", "user_playlist", "song", "album", "artist", "users"]
+IDENTITY_COLUMNS = {"users": "user_id", "artist": "id", "album": "id", "song": "song_id",
+                    "user_playlist": "playlist_id", "streams": "stream_id"}
+
+
+def _dsn():
+    return sqlalchemy.engine.make_url(db.database_connection_url()).set(
+        drivername="postgresql").render_as_string(hide_password=False)
+
+
+def _copy(connection, table, columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def _timestamps(rng, anchor, count):
+    ages = rng.integers(0, HISTORY_SECONDS, count).astype("timedelta64[s]")
+    return np.datetime_as_string(np.datetime64(anchor, "s") - ages, timezone="UTC")
+
+
+def _popular_songs(rng, count, songs):
+    return (rng.zipf(SONG_POPULARITY, count) - 1) % songs + 1
+
+
+def _catalog_rows(sizes, seed, anchor):
+    rng = np.random.default_rng(seed)
+    genres = ["pop", "rock", "hip hop", "jazz", "country", "electronic", "r&b", "indie"]
+    yield "users", ["user_id", "username"], (
+        (i, dataset.username(i)) for i in range(1, sizes["users"] + 1))
+    yield "artist", ["id", "artist_name"], (
+        (i, dataset.artist_name(i)) for i in range(1, sizes["artist"] + 1))
+    release = _timestamps(rng, anchor, sizes["album"])
+    yield "album", ["id", "album_name", "artist_id", "genre", "explicit_rating", "label", "release_date"], (
+        (i, dataset.album_name(i), dataset.album_artist(i, sizes), genres[i % len(genres)],
+         int(rng.random() < 0.3), f"label{i % 40}", release[i - 1][:10])
+        for i in range(1, sizes["album"] + 1))
+    lengths = rng.integers(90, 420, sizes["song"])
+    yield "song", ["song_id", "song_name", "artist_id", "album_id", "featured_artist", "explicit_rating", "length"], (
+        (i, dataset.song_name(i), dataset.song_artist(i, sizes), dataset.song_album(i, sizes), "",
+         int(rng.random() < 0.3), int(lengths[i - 1]))
+        for i in range(1, sizes["song"] + 1))
+    yield "user_playlist", ["playlist_id", "playlist_name", "user_id"], (
+        (i, dataset.playlist_name(i, sizes), dataset.playlist_owner(i, sizes))
+        for i in range(1, sizes["user_playlist"] + 1))
+
+
+def _load_chunk(args):
+    table, start, count, seed, sizes, anchor, dsn = args
+    rng = np.random.default_rng(seed)
+    created = _timestamps(rng, anchor, count)
+    songs = _popular_songs(rng, count, sizes["song"])
+    if table == "streams":
+        users = rng.integers(1, sizes["users"] + 1, count)
+        columns = ["stream_id", "user_id", "song_id", "created_at"]
+        rows = zip(range(start + 1, start + count + 1), users.tolist(), songs.tolist(), created.tolist())
+    else:
+        # Each chunk owns a contiguous range of playlists, so dropping duplicate
+        # (playlist, song) pairs and numbering positions can be done per chunk.
+        total = sizes["song_playlist"]
+        low = start * sizes["user_playlist"] // total + 1
+        high = max(low + 1, (start + count) * sizes["user_playlist"] // total + 1)
+        playlists = rng.integers(low, high, count)
+        _, first = np.unique(playlists * (sizes["song"] + 1) + songs, return_index=True)
+        order = first[np.lexsort((created[first], playlists[first]))]
+        playlists, songs, created = playlists[order], songs[order], created[order]
+        count = len(playlists)
+        starts = np.flatnonzero(np.r_[True, playlists[1:] != playlists[:-1]])
+        positions = np.arange(len(playlists)) - np.repeat(starts, np.diff(np.r_[starts, len(playlists)])) + 1
+        owners = (playlists - 1) % sizes["users"] + 1
+        columns = ["user_id", "playlist_id", "song_id", "position", "created_at"]
+        rows = zip(owners.tolist(), playlists.tolist(), songs.tolist(), positions.tolist(), created.tolist())
+    connection = psycopg2.connect(dsn)
+    try:
+        _copy(connection, table, columns, rows)
+        connection.commit()
+    finally:
+        connection.close()
+    return table, count
+
+
+def generate(scale=1.0, seed=0, workers=None, truncate=False, anchor=None, rebuild=True):
+    """Generate the dataset. Returns the row counts written per table."""
+    sizes = dataset.counts(scale)
+    anchor = anchor or DEFAULT_ANCHOR
+    dsn = _dsn()
+
+    connection = psycopg2.connect(dsn)
+    try:
+        if truncate:
+            with connection.cursor() as cursor:
+                cursor.execute(f"TRUNCATE {', '.join(TABLES)} RESTART IDENTITY")
+        for table, columns, rows in _catalog_rows(sizes, seed, anchor):
+            _copy(connection, table, columns, rows)
+        connection.commit()
+    finally:
+        connection.close()
+
+    from src import partitions
+    partitions.ensure(since=anchor.replace(tzinfo=timezone.utc) - timedelta(seconds=HISTORY_SECONDS))
+
+    chunks = []
+    for index, table in enumerate(["song_playlist", "streams"]):
+        for start in range(0, sizes[table], CHUNK_ROWS):
+            count = min(CHUNK_ROWS, sizes[table] - start)
+            chunks.append((table, start, count, seed * 1000003 + index * 10007 + start // CHUNK_ROWS,
+                           sizes, anchor, dsn))
+    with multiprocessing.Pool(workers) as pool:
+        for table, count in pool.imap_unordered(_load_chunk, chunks):
+            print(f"{table}: +{count} rows", flush=True)
+
+    connection = psycopg2.connect(dsn)
+    try:
+        with connection.cursor() as cursor:
+            for table, column in IDENTITY_COLUMNS.items():
+                cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'), "
+                               f"(SELECT COALESCE(MAX({column}), 0) + 1 FROM {table}), false)")
+            cursor.execute(f"ANALYZE {', '.join(TABLES)}")
+        connection.commit()
+    finally:
+        connection.close()
+
+    if rebuild:
+        from src import cooccurrence, rollups
+        with db.engine.begin() as conn:
+            rollups.rebuild_song_play_counts(conn)
+            rollups.rebuild_buckets(conn)
+        rollups.backfill_user_plays(min(workers or multiprocessing.cpu_count(), db.engine.pool.size()))
+        cooccurrence.build()
+    return sizes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.datagen", description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=float, default=1.0, help="1.0 is the 11.4M-row writeup dataset")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None, help="defaults to the CPU count")
+    parser.add_argument("--truncate", action="store_true", help="empty the tables first")
+    parser.add_argument("--skip-rebuild", action="store_true", help="don't rebuild rollups and indexes")
+    parser.add_argument("--anchor", type=datetime.fromisoformat, default=DEFAULT_ANCHOR,
+                        help=f"UTC date the generated history ends at (default {DEFAULT_ANCHOR.date()})")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    sizes = generate(args.scale, args.seed, args.workers, args.truncate, args.anchor, rebuild=not args.skip_rebuild)
+    for table, rows in sizes.items():
+        print(f"{table}: {rows}")
+    print(f"generated in {time.perf_counter() - start:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+"""Shape of the synthetic dataset, shared by the generator and the load driver.
+
+Row counts follow docs/performance_writeup.md at scale 1.0. Every name is a
+pure function of its row ID, so the driver can build valid requests for any
+scale without querying the database.
+"""
+BASE_COUNTS = {
+    "users": 40013,
+    "artist": 181,
+    "album": 1682,
+    "song": 26741,
+    "user_playlist": 250002,
+    "song_playlist": 5374725,
+    "streams": 5774216,
+}
+
+
+def counts(scale):
+    return {table: max(1, round(rows * scale)) for table, rows in BASE_COUNTS.items()}
+
+
+def username(user_id):
+    return f"user{user_id}"
+
+
+def artist_name(artist_id):
+    return f"artist{artist_id}"
+
+
+def album_name(album_id):
+    return f"album{album_id}"
+
+
+def song_name(song_id):
+    return f"song{song_id}"
+
+
+def album_artist(album_id, sizes):
+    return (album_id - 1) % sizes["artist"] + 1
+
+
+def song_album(song_id, sizes):
+    return (song_id - 1) % sizes["album"] + 1
+
+
+def song_artist(song_id, sizes):
+    return album_artist(song_album(song_id, sizes), sizes)
+
+
+def playlist_owner(playlist_id, sizes):
+    return (playlist_id - 1) % sizes["users"] + 1
+
+
+def playlist_name(playlist_id, sizes):
+    return f"u{playlist_owner(playlist_id, sizes)}p{playlist_id}"
@@ -0,0 +1,223 @@
+"""Concurrent load driver for every musicmain route.
+
+Runs --requests calls per endpoint with --concurrency workers against a
+server started on data from bench.datagen at the same --scale, and reports
+throughput and p50/p95/p99 latency per endpoint as JSON:
+
+    python main.py &
+    python -m bench.driver --scale 0.1 --concurrency 32 --out results/run.json
+
+recommend_songs calls the chat completions API; run the server with
+OPENAI_BASE_URL pointed at src/stub_upstream.py or leave it out with --skip.
+The user_recommend endpoints answer 503 until the server has loaded a model
+from python -m src.embeddings train.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import dotenv
+import httpx
+
+from bench import dataset
+
+dotenv.load_dotenv()
+
+
+def _song(rng, sizes):
+    song_id = rng.randint(1, sizes["song"])
+    return {"song_name": dataset.song_name(song_id), "artist_name": dataset.artist_name(dataset.song_artist(song_id, sizes)),
+            "album": dataset.album_name(dataset.song_album(song_id, sizes))}
+
+
+def _user(rng, sizes):
+    return dataset.username(rng.randint(1, sizes["users"]))
+
+
+def _playlist(rng, sizes):
+    playlist_id = rng.randint(1, sizes["user_playlist"])
+    return dataset.playlist_name(playlist_id, sizes), dataset.username(dataset.playlist_owner(playlist_id, sizes))
+
+
+def _album_body(rng, sizes, tag):
+    artist_id = rng.randint(1, sizes["artist"])
+    return {"album_name": f"bench-album-{tag}", "artist_name": dataset.artist_name(artist_id), "genre": "pop",
+            "explicit_rating": 0, "label": "bench", "release_date": "2024-01-01",
+            "song_list": [{"song_name": f"bench-song-{tag}-{n}", "artist_name": dataset.artist_name(artist_id),
+                           "featured_artist": "", "explicit_rating": 0, "length": 200} for n in range(12)]}
+
+
+def _add_song(rng, sizes):
+    song = _song(rng, sizes)
+    playlist, owner = _playlist(rng, sizes)
+    return {"params": {"song_name": song["song_name"], "album": song["album"], "playlist_name": playlist,
+                       "username": owner}}
+
+
+def _song_batch(rng, sizes, count=50):
+    return {"path_params": {"playlist_id": rng.randint(1, sizes["user_playlist"])},
+            "json": {"song_ids": [rng.randint(1, sizes["song"]) for _ in range(count)]}}
+
+
+def _remove_song(rng, sizes):
+    song = _song(rng, sizes)
+    playlist, _ = _playlist(rng, sizes)
+    return {"params": {"song_name": song["song_name"], "playlist_name": playlist}}
+
+
+# name -> (path, request builder). Builders get a seeded Random, the table
+# sizes and a unique tag for endpoints that must create fresh rows; a
+# "path_params" entry in what they return fills in the path template.
+ENDPOINTS = {
+    "add_user": ("/add_user/", lambda rng, sizes, tag: {"params": {"username": f"bench-user-{tag}"}}),
+    "create_artist": ("/create_artist", lambda rng, sizes, tag: {"params": {"artist_name": f"bench-artist-{tag}"}}),
+    "upload_music": ("/upload_music/", lambda rng, sizes, tag: {"json": _album_body(rng, sizes, tag)}),
+    "search_for_song": ("/search_for_song/", lambda rng, sizes, tag: {
+        "params": {k: v for k, v in _song(rng, sizes).items() if k != "album"}}),
+    "search_for_artist": ("/search_for_artist/", lambda rng, sizes, tag: {
+        "params": {"artist_name": dataset.artist_name(rng.randint(1, sizes["artist"]))}}),
+    "search_for_album": ("/search_for_album/", lambda rng, sizes, tag: {
+        "params": {"album_name": dataset.album_name(rng.randint(1, sizes["album"]))}}),
+    "search": ("/search/", lambda rng, sizes, tag: {
+        "params": {"q": dataset.song_name(rng.randint(1, sizes["song"]))[:rng.randint(3, 8)]}}),
+    "artist_albums": ("/artist_albums/", lambda rng, sizes, tag: {
+        "params": {"artist_name": dataset.artist_name(rng.randint(1, sizes["artist"]))}}),
+    "album_songs": ("/album_songs/", lambda rng, sizes, tag: {
+        "params": {"album_name": dataset.album_name(rng.randint(1, sizes["album"]))}}),
+    "song_info": ("/song_info/", lambda rng, sizes, tag: {
+        "params": {k: v for k, v in _song(rng, sizes).items() if k != "album"}}),
+    "album_info": ("/album_info/", lambda rng, sizes, tag: {
+        "params": {"album_name": dataset.album_name(rng.randint(1, sizes["album"]))}}),
+    "log_streams": ("/log_streams/", lambda rng, sizes, tag: {
+        "params": {**{k: v for k, v in _song(rng, sizes).items() if k != "album"}, "username": _user(rng, sizes)}}),
+    "log_streams_bulk": ("/log_streams/bulk/", lambda rng, sizes, tag: {
+        "json": [{**{k: v for k, v in _song(rng, sizes).items() if k != "album"}, "username": _user(rng, sizes)}
+                 for _ in range(100)]}),
+    "get_total_streams": ("/get_total_streams/", lambda rng, sizes, tag: {"params": {"username": _user(rng, sizes)}}),
+    "get_stream_by_artist": ("/get_stream_by_artist/", lambda rng, sizes, tag: {
+        "json": {"user": {"username": _user(rng, sizes)},
+                 "artist": {"artist_name": dataset.artist_name(rng.randint(1, sizes["artist"]))}}}),
+    "user_top_artists": ("/users/top_artists/", lambda rng, sizes, tag: {"params": {"username": _user(rng, sizes)}}),
+    "user_top_songs": ("/users/top_songs/", lambda rng, sizes, tag: {"params": {"username": _user(rng, sizes)}}),
+    "user_artist_plays": ("/users/artist_plays/", lambda rng, sizes, tag: {
+        "params": {"username": _user(rng, sizes), "artist_name": dataset.artist_name(rng.randint(1, sizes["artist"]))}}),
+    "create_playlist": ("/create_playlist/", lambda rng, sizes, tag: {
+        "params": {"playlist_name": f"bench-playlist-{tag}", "username": _user(rng, sizes)}}),
+    "add_song_to_playlist": ("/add_song_to_playlist/", lambda rng, sizes, tag: _add_song(rng, sizes)),
+    "playlist_add_songs": ("/playlist/{playlist_id}/songs/add", lambda rng, sizes, tag: _song_batch(rng, sizes)),
+    "playlist_reorder_songs": ("/playlist/{playlist_id}/songs/reorder", lambda rng, sizes, tag: _song_batch(rng, sizes)),
+    "playlist_remove_songs": ("/playlist/{playlist_id}/songs/remove", lambda rng, sizes, tag: _song_batch(rng, sizes)),
+    "view_playlist": ("/view_playlist/", lambda rng, sizes, tag: {
+        "params": dict(zip(("playlist_name", "username"), _playlist(rng, sizes)))}),
+    "submit_rating": ("/songs/submit_rating/", lambda rng, sizes, tag: {
+        "params": {"song": _song(rng, sizes)["song_name"], "user_rating": rng.randint(0, 1)}}),
+    "get_clean_songs": ("/playlist/get_clean_songs/", lambda rng, sizes, tag: {
+        "params": {"playlist_name": _playlist(rng, sizes)[0]}}),
+    "recommend_songs": ("/songs/recommend_songs/", lambda rng, sizes, tag: {
+        "params": {"genre": rng.choice(["pop", "rock", "jazz", "hip hop", "country", "indie folk"])}}),
+    "top_streams": ("/top_streams/", lambda rng, sizes, tag: {}),
+    "top_streams_window": ("/top_streams/window/", lambda rng, sizes, tag: {
+        "params": {"hours": rng.choice([1, 24, 168]), "limit": 10}}),
+    "playlist_recommend": ("/playlist/recommend", lambda rng, sizes, tag: {
+        "params": {"playlist_name": _playlist(rng, sizes)[0]}}),
+    "remove_song_from_playlist": ("/remove_song_from_playlist/", lambda rng, sizes, tag: _remove_song(rng, sizes)),
+    "user_recommend": ("/users/{username}/recommend", lambda rng, sizes, tag: {
+        "path_params": {"username": _user(rng, sizes)}, "params": {"limit": 10, "approximate": False}}),
+    "user_recommend_approximate": ("/users/{username}/recommend", lambda rng, sizes, tag: {
+        "path_params": {"username": _user(rng, sizes)}, "params": {"limit": 10, "approximate": True}}),
+}
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run_endpoint(client, name, path, build, sizes, requests, concurrency, seed):
+    """Fire `requests` calls at one endpoint and summarize their latencies."""
+    rng = random.Random(f"{seed}:{name}")
+    run_tag = uuid.uuid4().hex[:8]
+    calls = [build(rng, sizes, f"{run_tag}-{i}") for i in range(requests)]
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def call(kwargs):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            ok = client.post(path.format(**kwargs.pop("path_params", {})), **kwargs).is_success
+        except httpx.HTTPError:
+            ok = False
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            latencies.append(elapsed)
+            errors += not ok
+
+    wall = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(call, calls))
+    wall = time.perf_counter() - wall
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(requests / wall, 2),
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "max_ms": round(latencies[-1], 2) if latencies else 0.0,
+    }
+
+
+def run(base_url, api_key, scale, requests, concurrency, seed=0, only=None, skip=()):
+    sizes = dataset.counts(scale)
+    names = [name for name in ENDPOINTS if (not only or name in only) and name not in skip]
+    results = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    with httpx.Client(base_url=base_url.rstrip("/") + "/musicmain", headers={"access_token": api_key},
+                      timeout=60, limits=limits) as client:
+        for name in names:
+            path, build = ENDPOINTS[name]
+            results[name] = run_endpoint(client, name, path, build, sizes, requests, concurrency, seed)
+            print(f"{name}: {results[name]}", flush=True)
+    return {
+        "meta": {"started_at": datetime.now(timezone.utc).isoformat(), "base_url": base_url, "scale": scale,
+                 "requests_per_endpoint": requests, "concurrency": concurrency, "seed": seed,
+                 "db_backend": os.environ.get("DB_BACKEND", "sync"), "python": platform.python_version()},
+        "endpoints": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.driver", description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:3000")
+    parser.add_argument("--api-key", default=os.environ.get("API_KEY", ""))
+    parser.add_argument("--scale", type=float, default=1.0, help="scale bench.datagen was run with")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="*", choices=sorted(ENDPOINTS), help="run just these endpoints")
+    parser.add_argument("--skip", nargs="*", default=[], choices=sorted(ENDPOINTS))
+    parser.add_argument("--out", help="write results JSON here")
+    args = parser.parse_args(argv)
+
+    results = run(args.base_url, args.api_key, args.scale, args.requests, args.concurrency, args.seed,
+                  args.only, args.skip)
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""Recall and latency of the approximate (IVF) song lookup against the exact one.
+
+Loads the current model from EMBEDDINGS_DIR (train it first) and, for a
+sample of its users, times an exact top-k over every song and an IVF top-k
+for each --nprobe value. Recall is the share of the exact top-k that the IVF
+lookup also returned. No database is needed; the user's own plays are not
+filtered out, since that happens in SQL after the index:
+
+    python -m src.embeddings train
+    python -m bench.embeddings --users 1000 --k 10 --nprobe 1,2,4,8,16,32 --out results/embeddings.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import dotenv
+import numpy as np
+
+from src import embeddings
+
+dotenv.load_dotenv()
+
+
+def _percentile(values, q):
+    return round(float(np.percentile(values, q)), 1) if values else 0.0
+
+
+def run(users=1000, k=10, nprobes=(1, 2, 4, 8, 16, 32), seed=0, directory=embeddings.EMBEDDINGS_DIR):
+    recommender = embeddings.Recommender(directory)
+    if not recommender.load():
+        raise SystemExit(f"no model in {directory}; run python -m src.embeddings train")
+    model = recommender.model
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(model.user_ids), min(users, len(model.user_ids)), replace=False)
+    vectors = [np.asarray(model.user_vectors[row]) for row in rows]
+
+    def timed(nprobe):
+        found, micros = [], []
+        for vector in vectors:
+            start = time.perf_counter()
+            song_ids, _ = model.top_k(vector, k, nprobe)
+            micros.append((time.perf_counter() - start) * 1e6)
+            found.append(set(song_ids.tolist()))
+        return found, micros
+
+    exact, exact_us = timed(None)
+    results = {"exact": {"recall": 1.0, "p50_us": _percentile(exact_us, 50), "p99_us": _percentile(exact_us, 99),
+                         "songs_scored": len(model.song_ids)}}
+    for nprobe in nprobes:
+        found, micros = timed(nprobe)
+        recall = np.mean([len(a & b) / max(len(a), 1) for a, b in zip(exact, found)])
+        lists = min(nprobe, len(model.centroids))
+        results[f"ivf_nprobe_{nprobe}"] = {
+            "recall": round(float(recall), 4), "p50_us": _percentile(micros, 50), "p99_us": _percentile(micros, 99),
+            "songs_scored": round(len(model.song_ids) * lists / len(model.centroids))}
+    return {"meta": {**model.meta, "sampled_users": len(rows), "k": k, "seed": seed}, "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.embeddings", description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000, help="users sampled from the model")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", default="1,2,4,8,16,32", help="comma-separated IVF lists to search")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", default=embeddings.EMBEDDINGS_DIR)
+    parser.add_argument("--out", help="write results JSON here")
+    args = parser.parse_args(argv)
+
+    results = run(args.users, args.k, [int(n) for n in args.nprobe.split(",")], args.seed, args.dir)
+    for name, row in results["results"].items():
+        print(f"{name:16} recall@{args.k} {row['recall']:<7} p50 {row['p50_us']:>9} us  p99 {row['p99_us']:>9} us  "
+              f"~{row['songs_scored']} songs scored")
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""Insert, vacuum and query cost of the partitioned streams table against an unpartitioned copy.
+
+Meant for 50M+ streams: bench.datagen --scale 9 writes about 52M. The first
+run copies streams into streams_flat, an unpartitioned table with the same
+indexes plus one on created_at so the time-range queries have an index to
+use, and keeps it for later runs (--rebuild-flat recreates it):
+
+    python -m src.migrate up
+    python -m bench.datagen --scale 9 --truncate
+    python -m bench.partitions --scale 9 --out results/partitions.json
+
+For each table it times --batches multi-row inserts of --batch-size plays
+stamped now (the table alone, without stream_ingest's rollup CTEs), rolled
+back so the dataset doesn't change. It then times VACUUM (ANALYZE) of what
+autovacuum would have to process after those inserts: the whole flat table,
+but only the current month's partition. Queries run --repeat times and report
+the median:
+
+- user_recent: one user's latest 100 plays, like /get_total_streams/
+- last_7_days: plays in the last week
+- last_month_top_songs: the ten most played songs of the previous month
+- full_count: every row, which partitioning can't prune
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+import dotenv
+import psycopg2
+
+from bench import dataset
+from bench.datagen import _dsn
+
+dotenv.load_dotenv()
+
+QUERIES = {
+    "user_recent": """
+        SELECT stream_id, created_at, song_id FROM {table}
+        WHERE user_id = %(user_id)s
+        ORDER BY stream_id DESC
+        LIMIT 100""",
+    "last_7_days": "SELECT COUNT(*) FROM {table} WHERE created_at >= now() - interval '7 days'",
+    "last_month_top_songs": """
+        SELECT song_id, COUNT(*) AS plays FROM {table}
+        WHERE created_at >= date_trunc('month', now() - interval '1 month') AND created_at < date_trunc('month', now())
+        GROUP BY song_id
+        ORDER BY plays DESC
+        LIMIT 10""",
+    "full_count": "SELECT COUNT(*) FROM {table}",
+}
+
+
+def build_flat(connection, rebuild=False):
+    """Create streams_flat from streams unless it exists. Returns its row count."""
+    with connection.cursor() as cursor:
+        if rebuild:
+            cursor.execute("DROP TABLE IF EXISTS streams_flat")
+        cursor.execute("SELECT to_regclass('public.streams_flat') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            cursor.execute("CREATE TABLE streams_flat AS SELECT stream_id, created_at, user_id, song_id FROM streams")
+            cursor.execute("ALTER TABLE streams_flat ADD PRIMARY KEY (stream_id)")
+            cursor.execute("CREATE INDEX streams_flat_user_id_idx ON streams_flat (user_id, stream_id)")
+            cursor.execute("CREATE INDEX streams_flat_song_id_idx ON streams_flat (song_id)")
+            cursor.execute("CREATE INDEX streams_flat_created_at_idx ON streams_flat (created_at)")
+        connection.commit()
+        connection.autocommit = True
+        try:
+            cursor.execute("VACUUM (ANALYZE) streams_flat")
+            cursor.execute("VACUUM (ANALYZE) streams")
+        finally:
+            connection.autocommit = False
+        cursor.execute("SELECT COUNT(*) FROM streams_flat")
+        return cursor.fetchone()[0]
+
+
+def _insert(connection, table, plays):
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {table} (user_id, song_id, created_at)
+            SELECT * FROM unnest(%s::integer[], %s::integer[], %s::timestamptz[])""",
+                       ([user_id for user_id, _ in plays], [song_id for _, song_id in plays],
+                        [datetime.now(timezone.utc)] * len(plays)))
+
+
+def time_inserts(connection, table, sizes, batches, batch_size, rng):
+    """Milliseconds per batch for each insert, all rolled back at the end."""
+    timings = []
+    try:
+        for _ in range(batches):
+            plays = [(rng.randint(1, sizes["users"]), rng.randint(1, sizes["song"])) for _ in range(batch_size)]
+            start = time.perf_counter()
+            _insert(connection, table, plays)
+            timings.append((time.perf_counter() - start) * 1000)
+    finally:
+        connection.rollback()
+    return timings
+
+
+def time_vacuum(connection, target):
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            start = time.perf_counter()
+            cursor.execute(f"VACUUM (ANALYZE) {target}")
+            return (time.perf_counter() - start) * 1000
+    finally:
+        connection.autocommit = False
+
+
+def time_queries(connection, table, sizes, repeat, rng):
+    """Median milliseconds per query in QUERIES."""
+    medians = {}
+    with connection.cursor() as cursor:
+        for name, sql in QUERIES.items():
+            runs = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                cursor.execute(sql.format(table=table), {"user_id": rng.randint(1, sizes["users"])})
+                cursor.fetchall()
+                runs.append((time.perf_counter() - start) * 1000)
+            medians[name] = round(statistics.median(runs), 2)
+    connection.rollback()
+    return medians
+
+
+def run(scale, batches=50, batch_size=1000, repeat=5, seed=0, rebuild_flat=False):
+    sizes = dataset.counts(scale)
+    connection = psycopg2.connect(_dsn())
+    try:
+        rows = build_flat(connection, rebuild_flat)
+        current = "streams_p" + datetime.now(timezone.utc).strftime("%Y_%m")
+        results = {}
+        for table, vacuum_target in [("streams_flat", "streams_flat"), ("streams", current)]:
+            rng = random.Random(seed)
+            inserts = time_inserts(connection, table, sizes, batches, batch_size, rng)
+            results[table] = {
+                "insert_ms_per_batch": round(statistics.median(inserts), 2),
+                "insert_ms_p95": round(sorted(inserts)[int(0.95 * (len(inserts) - 1))], 2),
+                "vacuum_target": vacuum_target,
+                "vacuum_ms": round(time_vacuum(connection, vacuum_target), 1),
+                "queries_ms": time_queries(connection, table, sizes, repeat, rng),
+            }
+    finally:
+        connection.close()
+
+    flat, partitioned = results["streams_flat"], results["streams"]
+    speedups = {name: round(flat["queries_ms"][name] / ms, 2) if ms else 0.0
+                for name, ms in partitioned["queries_ms"].items()}
+    speedups["insert"] = round(flat["insert_ms_per_batch"] / partitioned["insert_ms_per_batch"], 2) \
+        if partitioned["insert_ms_per_batch"] else 0.0
+    speedups["vacuum"] = round(flat["vacuum_ms"] / partitioned["vacuum_ms"], 2) if partitioned["vacuum_ms"] else 0.0
+    return {
+        "meta": {"scale": scale, "rows": rows, "batches": batches, "batch_size": batch_size, "repeat": repeat,
+                 "seed": seed},
+        "results": results,
+        "partitioned_speedup": speedups,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.partitions", description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=float, default=9.0, help="scale bench.datagen was run with")
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rebuild-flat", action="store_true", help="recreate streams_flat from streams")
+    parser.add_argument("--out", help="write results JSON here")
+    args = parser.parse_args(argv)
+
+    results = run(args.scale, args.batches, args.batch_size, args.repeat, args.seed, args.rebuild_flat)
+    print(f"{results['meta']['rows']} streams")
+    for table, row in results["results"].items():
+        print(f"{table:13} insert {row['insert_ms_per_batch']:>8} ms/batch  vacuum {row['vacuum_target']} "
+              f"{row['vacuum_ms']} ms")
+        for name, ms in row["queries_ms"].items():
+            print(f"{'':13} {name:22} {ms:>10} ms")
+    print("partitioned speedup: " + ", ".join(f"{name} {x}x" for name, x in results["partitioned_speedup"].items()))
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
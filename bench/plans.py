@@ -0,0 +1,297 @@
+"""Query-plan checks for the SQL behind every musicmain endpoint.
+
+Calls every bench.driver endpoint in-process against the database filled by
+bench.datagen, captures each SQL statement the handler sends, and EXPLAINs
+it with the parameters it ran with:
+
+    python -m src.migrate up
+    python -m bench.plans check --scale 0.1
+    python -m bench.plans record --scale 0.1 --out results/plans.json
+    python -m bench.plans compare --scale 0.1 --baseline results/plans.json
+
+check fails on any Seq Scan over a table with at least --min-rows rows (from
+pg_class.reltuples). record runs EXPLAIN (ANALYZE, BUFFERS) --repeat times
+per statement, inside a transaction that is rolled back, and stores each
+plan's shape (node types with their tables and indexes), estimated cost,
+fastest execution time and buffer counts. compare profiles again and exits
+1 when a statement's plan shape changed, its estimated cost grew by more
+than --cost-tolerance, or its execution time grew by more than
+--time-tolerance and by at least --min-ms, or an endpoint sends more
+statements (round trips) per request than before. Statements are keyed by endpoint
+and a hash of their text, so an edited query shows up as new rather than
+as a regression. Routes no endpoint reached are listed as uncovered.
+
+The response cache, catalog snapshot and in-memory search index are turned
+off so every endpoint reaches Postgres; search runs through pg_trgm.
+recommend_songs calls an upstream API and is skipped.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import uuid
+
+import dotenv
+import sqlalchemy
+
+from bench import dataset
+from bench import driver
+
+dotenv.load_dotenv()
+
+MIN_ROWS = int(os.environ.get("PLAN_CHECK_MIN_ROWS", "10000"))
+SKIP = ("recommend_songs",)
+EXPLAINABLE = re.compile(r"^\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+SERVER_SETTINGS = {"RESPONSE_CACHE": "off", "CATALOG_SNAPSHOT": "0", "SEARCH_BACKEND": "pg_trgm",
+                   "STREAM_INGEST_MODE": "direct", "METRICS_ENABLED": "0"}
+
+TABLE_ROWS = sqlalchemy.text("""
+    SELECT c.relname, c.reltuples FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p')""")
+
+
+def app_client(api_key):
+    """A TestClient for the API configured so every endpoint queries Postgres."""
+    os.environ.update(SERVER_SETTINGS)
+    from fastapi.testclient import TestClient
+    from src.api import server
+
+    client = TestClient(server.app)
+    client.headers["access_token"] = api_key
+    return client
+
+
+def capture_statements(scale, api_key, seed=0, only=None):
+    """{endpoint: [(statement, parameters)]} for one driver-built request per endpoint.
+
+    Every statement sent to Postgres is listed, so the length of each list is
+    the request's round trips; parameters are None for executemany batches.
+    """
+    client = app_client(api_key)
+    from src import database as db
+
+    captured = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, None if executemany else parameters))
+
+    engines = [db.engine, *db.replica_engines]
+    for engine in engines:
+        sqlalchemy.event.listen(engine, "before_cursor_execute", record)
+    sizes = dataset.counts(scale)
+    run_tag = uuid.uuid4().hex[:8]
+    statements = {}
+    try:
+        for name, (path, build) in driver.ENDPOINTS.items():
+            if name in SKIP or (only and name not in only):
+                continue
+            captured.clear()
+            kwargs = build(random.Random(f"{seed}:{name}"), sizes, f"plans-{run_tag}")
+            response = client.post("/musicmain" + path.format(**kwargs.pop("path_params", {})), **kwargs)
+            if response.status_code >= 500:
+                raise RuntimeError(f"{name} failed with {response.status_code}: {response.text}")
+            statements[name] = list(captured)
+    finally:
+        for engine in engines:
+            sqlalchemy.event.remove(engine, "before_cursor_execute", record)
+    return statements
+
+
+def explainable(captured):
+    return [(statement, parameters) for statement, parameters in captured
+            if parameters is not None and EXPLAINABLE.match(statement)]
+
+
+def explain(connection, statement, parameters, options="FORMAT JSON"):
+    """The JSON plan of one captured statement, run on a raw psycopg2 cursor and rolled back."""
+    raw = connection.connection
+    cursor = raw.cursor()
+    try:
+        cursor.execute(f"EXPLAIN ({options}) {statement}", parameters)
+        return cursor.fetchone()[0][0]
+    finally:
+        cursor.close()
+        raw.rollback()
+
+
+def nodes(plan):
+    """Every node in a plan tree, depth first."""
+    yield plan
+    for child in plan.get("Plans", ()):
+        yield from nodes(child)
+
+
+def large_tables(connection, min_rows=MIN_ROWS):
+    return {name: rows for name, rows in connection.execute(TABLE_ROWS) if rows >= min_rows}
+
+
+def seq_scans(plan, tables):
+    """Names of large tables the plan reads with a sequential scan."""
+    return sorted({node["Relation Name"] for node in nodes(plan["Plan"])
+                   if node["Node Type"] == "Seq Scan" and node.get("Relation Name") in tables})
+
+
+def check(scale, api_key, min_rows=MIN_ROWS, seed=0, only=None):
+    """[(endpoint, tables, statement)] for every captured statement that seq-scans a large table."""
+    from src import database as db
+
+    statements = capture_statements(scale, api_key, seed, only)
+    failures = []
+    with db.engine.connect() as connection:
+        tables = large_tables(connection, min_rows)
+        for name, captured in statements.items():
+            for statement, parameters in explainable(captured):
+                scanned = seq_scans(explain(connection, statement, parameters), tables)
+                if scanned:
+                    failures.append((name, scanned, statement))
+    return failures
+
+
+def statement_key(statement):
+    return hashlib.sha1(" ".join(statement.split()).encode()).hexdigest()[:12]
+
+
+def shape(node):
+    """A plan tree as one string of node types with the table or index each one reads."""
+    target = node.get("Index Name") or node.get("Relation Name")
+    label = node["Node Type"] + (f"[{target}]" if target else "")
+    children = node.get("Plans", ())
+    return label + ("(" + ", ".join(shape(child) for child in children) + ")" if children else "")
+
+
+def summarize(plan):
+    """The parts of an EXPLAIN (ANALYZE, BUFFERS) result that are compared between runs."""
+    root = plan["Plan"]
+    return {"shape": shape(root), "total_cost": root["Total Cost"], "rows": root.get("Actual Rows"),
+            "execution_ms": plan["Execution Time"], "planning_ms": plan["Planning Time"],
+            "shared_hit": root.get("Shared Hit Blocks", 0), "shared_read": root.get("Shared Read Blocks", 0)}
+
+
+def profile(scale, api_key, seed=0, only=None, repeat=3):
+    """({endpoint: {statement key: summary}}, {endpoint: round trips}), keeping each statement's fastest run."""
+    from src import database as db
+
+    statements = capture_statements(scale, api_key, seed, only)
+    profiles = {}
+    with db.engine.connect() as connection:
+        for name, captured in statements.items():
+            entries = profiles[name] = {}
+            for statement, parameters in explainable(captured):
+                key = statement_key(statement)
+                if key in entries:
+                    continue
+                runs = [summarize(explain(connection, statement, parameters, "ANALYZE, BUFFERS, FORMAT JSON"))
+                        for _ in range(repeat)]
+                entries[key] = {**min(runs, key=lambda run: run["execution_ms"]),
+                                "statement": " ".join(statement.split())}
+    return profiles, {name: len(captured) for name, captured in statements.items()}
+
+
+def uncovered(profiles):
+    """musicmain routes whose handler no profiled endpoint reached."""
+    from src.api import server
+
+    reached = {driver.ENDPOINTS[name][0] for name in profiles}
+    return sorted(route.path[len("/musicmain"):] for route in server.app.routes
+                  if route.path.startswith("/musicmain/") and route.path[len("/musicmain"):] not in reached)
+
+
+def compare(baseline, current, cost_tolerance=0.2, time_tolerance=0.5, min_ms=1.0):
+    """(endpoint, key, metric, before, after, regressed) for every compared statement metric."""
+    rows = []
+    for name, entries in current.items():
+        before_entries = baseline.get(name, {})
+        for key, after in entries.items():
+            before = before_entries.get(key)
+            if before is None:
+                rows.append((name, key, "new statement", None, after["statement"][:120], False))
+                continue
+            if after["shape"] != before["shape"]:
+                rows.append((name, key, "plan", before["shape"], after["shape"], True))
+            cost_ratio = after["total_cost"] / before["total_cost"] if before["total_cost"] else 1.0
+            rows.append((name, key, "total_cost", before["total_cost"], after["total_cost"],
+                         cost_ratio > 1 + cost_tolerance))
+            grew = after["execution_ms"] - before["execution_ms"]
+            rows.append((name, key, "execution_ms", before["execution_ms"], after["execution_ms"],
+                         grew >= min_ms and after["execution_ms"] > before["execution_ms"] * (1 + time_tolerance)))
+            rows.append((name, key, "shared_blocks", before["shared_hit"] + before["shared_read"],
+                         after["shared_hit"] + after["shared_read"], False))
+        for key in before_entries.keys() - entries.keys():
+            rows.append((name, key, "statement gone", before_entries[key]["statement"][:120], None, False))
+    return rows
+
+
+def compare_round_trips(baseline, current):
+    """(endpoint, before, after, regressed) for endpoints in both runs; any extra round trip regresses."""
+    return [(name, baseline[name], trips, trips > baseline[name]) for name, trips in current.items() if name in baseline]
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.plans", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["check", "record", "compare"])
+    parser.add_argument("--api-key", default=os.environ.get("API_KEY", ""))
+    parser.add_argument("--scale", type=float, default=1.0, help="scale bench.datagen was run with")
+    parser.add_argument("--min-rows", type=int, default=MIN_ROWS, help="tables at least this big count as large")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="*", choices=sorted(driver.ENDPOINTS), help="just these endpoints")
+    parser.add_argument("--repeat", type=int, default=3, help="EXPLAIN ANALYZE runs per statement")
+    parser.add_argument("--baseline", help="plans JSON from record, for compare")
+    parser.add_argument("--cost-tolerance", type=float, default=0.2, help="allowed relative estimated cost growth")
+    parser.add_argument("--time-tolerance", type=float, default=0.5, help="allowed relative execution time growth")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="ignore execution time growth below this")
+    parser.add_argument("--out", help="write the profiled plans JSON here")
+    args = parser.parse_args(argv)
+
+    if args.command == "check":
+        failures = check(args.scale, args.api_key, args.min_rows, args.seed, args.only)
+        for name, tables, statement in failures:
+            print(f"{name}: seq scan on {', '.join(tables)}\n    {' '.join(statement.split())[:300]}")
+        if failures:
+            return 1
+        print("no sequential scans on large tables")
+        return 0
+
+    if args.command == "compare" and not args.baseline:
+        parser.error("compare needs --baseline")
+    profiles, round_trips = profile(args.scale, args.api_key, args.seed, args.only, args.repeat)
+    results = {"meta": {"scale": args.scale, "seed": args.seed, "repeat": args.repeat}, "statements": profiles,
+               "round_trips": round_trips}
+    if args.out:
+        _write(args.out, results)
+    for path in uncovered(profiles):
+        print(f"uncovered route: {path}")
+
+    for name, trips in round_trips.items():
+        print(f"{name:28} {trips} round trips")
+    if args.command == "record":
+        print(f"recorded {sum(len(entries) for entries in profiles.values())} statements"
+              f" from {len(profiles)} endpoints")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = 0
+    for name, key, metric, before, after, regressed in compare(baseline["statements"], profiles, args.cost_tolerance,
+                                                               args.time_tolerance, args.min_ms):
+        regressions += regressed
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:28} {key} {metric:14} {before} -> {after}{flag}")
+    for name, before, after, regressed in compare_round_trips(baseline.get("round_trips", {}), round_trips):
+        regressions += regressed
+        if before != after:
+            print(f"{name:28} round trips {before} -> {after}{'  REGRESSION' if regressed else ''}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
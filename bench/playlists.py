@@ -0,0 +1,124 @@
+"""Compare per-song playlist adds with the batch playlist routes.
+
+Creates fresh playlists for dataset users, fills half of them one song at a
+time through /add_song_to_playlist/ and the other half with one
+/playlist/{id}/songs/add call each, then times one batch remove and reorder
+per batch playlist. Reports songs/sec, round trips and the batch speedup:
+
+    python main.py &
+    python -m bench.playlists --scale 0.1 --playlists 20 --songs 100 --out results/playlists.json
+
+The playlists are left in the database under bench-batch-* names.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+import dotenv
+import httpx
+import psycopg2
+
+from bench import dataset
+from bench.datagen import _dsn
+
+dotenv.load_dotenv()
+
+
+def create_playlists(sizes, count, rng, tag):
+    """Insert `count` empty playlists owned by random users. Returns (playlist_id, name, username) tuples."""
+    owners = [rng.randint(1, sizes["users"]) for _ in range(count)]
+    connection = psycopg2.connect(_dsn())
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO user_playlist (playlist_name, user_id)
+                SELECT 'bench-batch-' || %s || '-' || n, owner
+                FROM unnest(%s::bigint[]) WITH ORDINALITY AS t(owner, n)
+                RETURNING playlist_id, playlist_name, user_id""", (tag, owners))
+            rows = cursor.fetchall()
+        connection.commit()
+    finally:
+        connection.close()
+    return [(playlist_id, name, dataset.username(owner)) for playlist_id, name, owner in rows]
+
+
+def _timed(calls):
+    start = time.perf_counter()
+    for call in calls:
+        call().raise_for_status()
+    return time.perf_counter() - start
+
+
+def run(base_url, api_key, scale, playlists, songs, seed=0):
+    sizes = dataset.counts(scale)
+    rng = random.Random(seed)
+    created = create_playlists(sizes, 2 * playlists, rng, uuid.uuid4().hex[:8])
+    per_song, batched = created[:playlists], created[playlists:]
+    picks = [rng.sample(range(1, sizes["song"] + 1), min(songs, sizes["song"])) for _ in range(playlists)]
+
+    with httpx.Client(base_url=base_url.rstrip("/") + "/musicmain", headers={"access_token": api_key},
+                      timeout=60) as client:
+        def add_one(song_id, name, owner):
+            return lambda: client.post("/add_song_to_playlist/", params={
+                "song_name": dataset.song_name(song_id), "album": dataset.album_name(dataset.song_album(song_id, sizes)),
+                "playlist_name": name, "username": owner})
+
+        def batch(action, playlist_id, song_ids):
+            return lambda: client.post(f"/playlist/{playlist_id}/songs/{action}", json={"song_ids": song_ids})
+
+        timings = {
+            "per_song_add": _timed([add_one(song_id, name, owner)
+                                    for (_, name, owner), song_ids in zip(per_song, picks) for song_id in song_ids]),
+            "batch_add": _timed([batch("add", playlist_id, song_ids)
+                                 for (playlist_id, _, _), song_ids in zip(batched, picks)]),
+            "batch_reorder": _timed([batch("reorder", playlist_id, song_ids[::-1])
+                                     for (playlist_id, _, _), song_ids in zip(batched, picks)]),
+            "batch_remove": _timed([batch("remove", playlist_id, song_ids[: len(song_ids) // 2])
+                                    for (playlist_id, _, _), song_ids in zip(batched, picks)]),
+        }
+
+    total = sum(len(song_ids) for song_ids in picks)
+    moved = {"per_song_add": total, "batch_add": total, "batch_reorder": total,
+             "batch_remove": sum(len(song_ids) // 2 for song_ids in picks)}
+    trips = {"per_song_add": total, "batch_add": playlists, "batch_reorder": playlists, "batch_remove": playlists}
+    results = {name: {"songs": moved[name], "round_trips": trips[name], "seconds": round(seconds, 3),
+                      "songs_per_sec": round(moved[name] / seconds, 1) if seconds else 0.0}
+               for name, seconds in timings.items()}
+    speedup = timings["per_song_add"] / timings["batch_add"] if timings["batch_add"] else 0.0
+    return {
+        "meta": {"base_url": base_url, "scale": scale, "playlists": playlists, "songs_per_playlist": songs,
+                 "seed": seed},
+        "results": results,
+        "batch_add_speedup": round(speedup, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.playlists", description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:3000")
+    parser.add_argument("--api-key", default=os.environ.get("API_KEY", ""))
+    parser.add_argument("--scale", type=float, default=1.0, help="scale bench.datagen was run with")
+    parser.add_argument("--playlists", type=int, default=20, help="playlists filled per path")
+    parser.add_argument("--songs", type=int, default=100, help="songs per playlist")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write results JSON here")
+    args = parser.parse_args(argv)
+
+    results = run(args.base_url, args.api_key, args.scale, args.playlists, args.songs, args.seed)
+    for name, row in results["results"].items():
+        print(f"{name:14} {row['songs']:>7} songs  {row['round_trips']:>6} round trips  "
+              f"{row['songs_per_sec']:>10} songs/s")
+    print(f"batch add is {results['batch_add_speedup']}x the per-song path")
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,11 @@
+-- The schema after every migration in migrations/. Apply those with
+-- `python -m src.migrate up` rather than running this file.
+
 create table
   public.album (
     id integer generated by default as identity,
     album_name text null,
-    artist_id text null,
+    artist_id integer null,
     genre text null,
     explicit_rating integer null,
     label text null,
@@ -22,7 +25,7 @@ create table
 create table
   public.explicit_submissions (
     id bigint generated by default as identity,
-    songid integer null,
+    song_id integer null,
     exbool integer null default 0,
     constraint explicit_submissions_pkey primary key (id)
   ) tablespace pg_default;
@@ -36,16 +39,18 @@ create table
     featured_artist text null,
     explicit_rating integer null,
     length integer null,
+    album_id integer null,
     constraint song_pkey primary key (song_id)
   ) tablespace pg_default;
 
 create table
   public.song_playlist (
-    user_id bigint not null,
+    user_id bigint null,
     playlist_id bigint not null,
     song_id bigint not null,
     created_at timestamp with time zone not null default now(),
-    constraint song_playlist_pkey primary key (user_id)
+    position integer null,
+    constraint song_playlist_pkey primary key (playlist_id, song_id)
   ) tablespace pg_default;
 
 create table
@@ -54,7 +59,32 @@ create table
     created_at timestamp with time zone not null default now(),
     user_id integer null,
     song_id integer null,
-    constraint streams_pkey primary key (stream_id)
+    constraint streams_pkey primary key (stream_id, created_at)
+  ) partition by range (created_at);
+
+-- Monthly partitions streams_pYYYY_MM are created by
+-- streams_create_partitions() (migrations/0007) via python -m src.partitions ensure.
+create table public.streams_default partition of public.streams default;
+
+create table
+  public.streams_archive (
+    partition_name text not null,
+    range_start timestamp with time zone not null,
+    range_end timestamp with time zone not null,
+    path text not null,
+    row_count bigint not null,
+    archived_at timestamp with time zone not null default now(),
+    constraint streams_archive_pkey primary key (partition_name)
+  ) tablespace pg_default;
+
+create table
+  public.streams_archived_plays (
+    user_id integer not null,
+    song_id integer not null,
+    play_count bigint not null,
+    first_played_at timestamp with time zone not null,
+    last_played_at timestamp with time zone not null,
+    constraint streams_archived_plays_pkey primary key (user_id, song_id)
   ) tablespace pg_default;
 
 create table
@@ -72,4 +102,120 @@ create table
     created_at timestamp with time zone not null default now(),
     username text null,
     constraint users_pkey primary key (user_id)
-  ) tablespace pg_default;  
\ No newline at end of file
+  ) tablespace pg_default;
+
+create table
+  public.song_play_counts (
+    song_id integer not null,
+    play_count bigint not null default 0,
+    constraint song_play_counts_pkey primary key (song_id)
+  ) tablespace pg_default;
+
+create index song_play_counts_play_count_idx on public.song_play_counts using btree (play_count desc);
+
+create table
+  public.song_play_hourly (
+    bucket_start timestamp with time zone not null,
+    song_id integer not null,
+    play_count bigint not null default 0,
+    constraint song_play_hourly_pkey primary key (bucket_start, song_id)
+  ) tablespace pg_default;
+
+create table
+  public.song_play_daily (
+    bucket_start timestamp with time zone not null,
+    song_id integer not null,
+    play_count bigint not null default 0,
+    constraint song_play_daily_pkey primary key (bucket_start, song_id)
+  ) tablespace pg_default;
+
+create table
+  public.song_explicit_scores (
+    song_id integer not null,
+    votes bigint not null default 0,
+    explicit_votes bigint not null default 0,
+    constraint song_explicit_scores_pkey primary key (song_id)
+  ) tablespace pg_default;
+
+create table
+  public.user_song_plays (
+    user_id integer not null,
+    song_id integer not null,
+    play_count bigint not null default 0,
+    first_played_at timestamp with time zone not null,
+    last_played_at timestamp with time zone not null,
+    constraint user_song_plays_pkey primary key (user_id, song_id)
+  ) tablespace pg_default;
+
+create table
+  public.user_artist_plays (
+    user_id integer not null,
+    artist_id integer not null,
+    play_count bigint not null default 0,
+    first_played_at timestamp with time zone not null,
+    last_played_at timestamp with time zone not null,
+    constraint user_artist_plays_pkey primary key (user_id, artist_id)
+  ) tablespace pg_default;
+
+create table
+  public.song_cooccurrence (
+    song_id integer not null,
+    neighbor_id integer not null,
+    weight integer not null,
+    constraint song_cooccurrence_pkey primary key (song_id, neighbor_id)
+  ) tablespace pg_default;
+
+-- While a co-occurrence build runs, triggers on song_playlist record the
+-- playlists edited in cooccurrence_build_changes (migrations/0008).
+create table
+  public.cooccurrence_build (
+    singleton boolean not null default true,
+    running boolean not null default false,
+    constraint cooccurrence_build_pkey primary key (singleton),
+    constraint cooccurrence_build_singleton check (singleton)
+  ) tablespace pg_default;
+
+create unlogged table
+  public.cooccurrence_build_changes (
+    playlist_id bigint not null
+  ) tablespace pg_default;
+
+alter table public.album add constraint album_artist_id_fkey foreign key (artist_id) references public.artist (id);
+alter table public.song add constraint song_artist_id_fkey foreign key (artist_id) references public.artist (id);
+alter table public.song add constraint song_album_id_fkey foreign key (album_id) references public.album (id);
+alter table public.user_playlist add constraint user_playlist_user_id_fkey
+  foreign key (user_id) references public.users (user_id) on delete cascade;
+alter table public.song_playlist add constraint song_playlist_playlist_id_fkey
+  foreign key (playlist_id) references public.user_playlist (playlist_id) on delete cascade;
+alter table public.song_playlist add constraint song_playlist_song_id_fkey
+  foreign key (song_id) references public.song (song_id) on delete cascade;
+alter table public.streams add constraint streams_user_id_fkey foreign key (user_id) references public.users (user_id);
+alter table public.streams add constraint streams_song_id_fkey foreign key (song_id) references public.song (song_id);
+alter table public.explicit_submissions add constraint explicit_submissions_song_id_fkey
+  foreign key (song_id) references public.song (song_id) on delete cascade;
+
+create index users_username_idx on public.users using btree (username);
+create index artist_artist_name_idx on public.artist using btree (artist_name);
+create index album_album_name_idx on public.album using btree (album_name);
+create index album_artist_id_idx on public.album using btree (artist_id, id);
+create index song_song_name_idx on public.song using btree (song_name);
+create index song_album_id_idx on public.song using btree (album_id, song_id);
+create index song_artist_id_idx on public.song using btree (artist_id);
+create index user_playlist_playlist_name_idx on public.user_playlist using btree (playlist_name);
+create index user_playlist_user_id_idx on public.user_playlist using btree (user_id, playlist_name);
+create index song_playlist_song_id_idx on public.song_playlist using btree (song_id);
+create index streams_user_id_idx on public.streams using btree (user_id, stream_id);
+create index streams_song_id_idx on public.streams using btree (song_id);
+create index explicit_submissions_song_id_idx on public.explicit_submissions using btree (song_id);
+create index user_song_plays_top_idx on public.user_song_plays using btree (user_id, play_count desc, song_id);
+create index user_artist_plays_top_idx on public.user_artist_plays using btree (user_id, play_count desc, artist_id);
+
+-- Only needed for SEARCH_BACKEND=pg_trgm (or auto) in src/search.py, and only
+-- created by migration 0005 when the server has the pg_trgm extension.
+create extension if not exists pg_trgm;
+
+create index artist_name_trgm_idx on public.artist using gin (lower(artist_name) gin_trgm_ops);
+
+create index album_name_trgm_idx on public.album using gin (lower(album_name) gin_trgm_ops);
+
+create index song_name_trgm_idx on public.song using gin (lower(song_name) gin_trgm_ops);
@@ -0,0 +1,44 @@
+-- Aggregates kept alongside the raw tables: play counts and time buckets
+-- (src/rollups.py), playlist co-occurrence (src/cooccurrence.py) and explicit
+-- vote scores.
+
+create table if not exists
+  public.song_play_counts (
+    song_id integer not null,
+    play_count bigint not null default 0,
+    constraint song_play_counts_pkey primary key (song_id)
+  ) tablespace pg_default;
+
+create index if not exists song_play_counts_play_count_idx on public.song_play_counts using btree (play_count desc);
+
+create table if not exists
+  public.song_play_hourly (
+    bucket_start timestamp with time zone not null,
+    song_id integer not null,
+    play_count bigint not null default 0,
+    constraint song_play_hourly_pkey primary key (bucket_start, song_id)
+  ) tablespace pg_default;
+
+create table if not exists
+  public.song_play_daily (
+    bucket_start timestamp with time zone not null,
+    song_id integer not null,
+    play_count bigint not null default 0,
+    constraint song_play_daily_pkey primary key (bucket_start, song_id)
+  ) tablespace pg_default;
+
+create table if not exists
+  public.song_cooccurrence (
+    song_id integer not null,
+    neighbor_id integer not null,
+    weight integer not null,
+    constraint song_cooccurrence_pkey primary key (song_id, neighbor_id)
+  ) tablespace pg_default;
+
+create table if not exists
+  public.song_explicit_scores (
+    song_id integer not null,
+    votes bigint not null default 0,
+    explicit_votes bigint not null default 0,
+    constraint song_explicit_scores_pkey primary key (song_id)
+  ) tablespace pg_default;
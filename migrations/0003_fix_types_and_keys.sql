@@ -0,0 +1,81 @@
+-- Align the schema with what the code has always read and written, key
+-- song_playlist properly and add foreign keys.
+
+-- album.artist_id held artist IDs as text.
+do $$
+begin
+  if (select data_type from information_schema.columns
+      where table_schema = 'public' and table_name = 'album' and column_name = 'artist_id') = 'text' then
+    alter table public.album alter column artist_id type integer using nullif(btrim(artist_id), '')::integer;
+  end if;
+end $$;
+
+-- Songs belong to an album; the baseline schema never declared the column.
+alter table public.song add column if not exists album_id integer null;
+
+-- The code writes explicit_submissions.song_id; the baseline called it songid.
+do $$
+begin
+  if exists (select 1 from information_schema.columns
+             where table_schema = 'public' and table_name = 'explicit_submissions' and column_name = 'songid') then
+    alter table public.explicit_submissions rename column songid to song_id;
+  end if;
+end $$;
+
+-- song_playlist was keyed on user_id alone. A song is in a playlist at most
+-- once, in a position; the earliest copy of any duplicate is kept.
+alter table public.song_playlist add column if not exists position integer null;
+alter table public.song_playlist drop constraint if exists song_playlist_pkey;
+alter table public.song_playlist alter column user_id drop not null;
+
+delete from public.song_playlist a
+using public.song_playlist b
+where a.playlist_id = b.playlist_id and a.song_id = b.song_id
+  and (a.created_at, a.ctid) > (b.created_at, b.ctid);
+
+drop index if exists public.song_playlist_playlist_song_idx;
+drop index if exists public.idx_song_playlist_playlist_id_song_id;
+alter table public.song_playlist add constraint song_playlist_pkey primary key (playlist_id, song_id);
+
+-- Same numbering as python -m src.playlists backfill.
+with ranked as (
+  select playlist_id, song_id,
+         row_number() over (partition by playlist_id order by position nulls last, created_at, song_id) as position
+  from public.song_playlist
+  where playlist_id in (select distinct playlist_id from public.song_playlist where position is null)
+)
+update public.song_playlist sp set position = ranked.position
+from ranked
+where sp.playlist_id = ranked.playlist_id and sp.song_id = ranked.song_id
+  and sp.position is distinct from ranked.position;
+
+-- Foreign keys. Rows that break one make the migration fail with the
+-- offending constraint's name; fix or delete them and rerun.
+alter table public.album add constraint album_artist_id_fkey
+  foreign key (artist_id) references public.artist (id) not valid;
+alter table public.song add constraint song_artist_id_fkey
+  foreign key (artist_id) references public.artist (id) not valid;
+alter table public.song add constraint song_album_id_fkey
+  foreign key (album_id) references public.album (id) not valid;
+alter table public.user_playlist add constraint user_playlist_user_id_fkey
+  foreign key (user_id) references public.users (user_id) on delete cascade not valid;
+alter table public.song_playlist add constraint song_playlist_playlist_id_fkey
+  foreign key (playlist_id) references public.user_playlist (playlist_id) on delete cascade not valid;
+alter table public.song_playlist add constraint song_playlist_song_id_fkey
+  foreign key (song_id) references public.song (song_id) on delete cascade not valid;
+alter table public.streams add constraint streams_user_id_fkey
+  foreign key (user_id) references public.users (user_id) not valid;
+alter table public.streams add constraint streams_song_id_fkey
+  foreign key (song_id) references public.song (song_id) not valid;
+alter table public.explicit_submissions add constraint explicit_submissions_song_id_fkey
+  foreign key (song_id) references public.song (song_id) on delete cascade not valid;
+
+alter table public.album validate constraint album_artist_id_fkey;
+alter table public.song validate constraint song_artist_id_fkey;
+alter table public.song validate constraint song_album_id_fkey;
+alter table public.user_playlist validate constraint user_playlist_user_id_fkey;
+alter table public.song_playlist validate constraint song_playlist_playlist_id_fkey;
+alter table public.song_playlist validate constraint song_playlist_song_id_fkey;
+alter table public.streams validate constraint streams_user_id_fkey;
+alter table public.streams validate constraint streams_song_id_fkey;
+alter table public.explicit_submissions validate constraint explicit_submissions_song_id_fkey;
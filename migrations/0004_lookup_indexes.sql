@@ -0,0 +1,21 @@
+-- migrate: no-transaction
+-- Lookup indexes for the name resolution, listing and playlist queries in
+-- src/api/musicmain.py, src/resolver.py and src/cooccurrence.py. Built
+-- concurrently so a live database keeps taking writes.
+
+create index concurrently if not exists users_username_idx on public.users using btree (username);
+create index concurrently if not exists artist_artist_name_idx on public.artist using btree (artist_name);
+create index concurrently if not exists album_album_name_idx on public.album using btree (album_name);
+create index concurrently if not exists album_artist_id_idx on public.album using btree (artist_id, id);
+create index concurrently if not exists song_song_name_idx on public.song using btree (song_name);
+create index concurrently if not exists song_album_id_idx on public.song using btree (album_id, song_id);
+create index concurrently if not exists song_artist_id_idx on public.song using btree (artist_id);
+create index concurrently if not exists user_playlist_playlist_name_idx on public.user_playlist using btree (playlist_name);
+create index concurrently if not exists user_playlist_user_id_idx on public.user_playlist using btree (user_id, playlist_name);
+create index concurrently if not exists song_playlist_song_id_idx on public.song_playlist using btree (song_id);
+create index concurrently if not exists streams_user_id_idx on public.streams using btree (user_id, stream_id);
+create index concurrently if not exists streams_song_id_idx on public.streams using btree (song_id);
+create index concurrently if not exists explicit_submissions_song_id_idx on public.explicit_submissions using btree (song_id);
+
+-- Hand-applied in the performance writeup and covered by a key or an index above.
+drop index concurrently if exists public.idx_users_user_id;
@@ -0,0 +1,16 @@
+-- Trigram indexes for SEARCH_BACKEND=pg_trgm (or auto) in src/search.py.
+-- Servers without the pg_trgm contrib package skip all of it; search then
+-- stays on the in-process index. The indexes can't be built CONCURRENTLY
+-- inside the check, so writes to artist, album and song wait while they build.
+
+do $$
+begin
+  if exists (select 1 from pg_available_extensions where name = 'pg_trgm') then
+    create extension if not exists pg_trgm;
+    create index if not exists artist_name_trgm_idx on public.artist using gin (lower(artist_name) gin_trgm_ops);
+    create index if not exists album_name_trgm_idx on public.album using gin (lower(album_name) gin_trgm_ops);
+    create index if not exists song_name_trgm_idx on public.song using gin (lower(song_name) gin_trgm_ops);
+  else
+    raise notice 'pg_trgm is not available; skipping the trigram search indexes';
+  end if;
+end $$;
@@ -0,0 +1,26 @@
+-- Per-user listening rollups kept current by stream_ingest.INSERT_STREAMS.
+-- Fill them from existing streams with: python -m src.rollups backfill
+
+create table if not exists
+  public.user_song_plays (
+    user_id integer not null,
+    song_id integer not null,
+    play_count bigint not null default 0,
+    first_played_at timestamp with time zone not null,
+    last_played_at timestamp with time zone not null,
+    constraint user_song_plays_pkey primary key (user_id, song_id)
+  ) tablespace pg_default;
+
+create index if not exists user_song_plays_top_idx on public.user_song_plays using btree (user_id, play_count desc, song_id);
+
+create table if not exists
+  public.user_artist_plays (
+    user_id integer not null,
+    artist_id integer not null,
+    play_count bigint not null default 0,
+    first_played_at timestamp with time zone not null,
+    last_played_at timestamp with time zone not null,
+    constraint user_artist_plays_pkey primary key (user_id, artist_id)
+  ) tablespace pg_default;
+
+create index if not exists user_artist_plays_top_idx on public.user_artist_plays using btree (user_id, play_count desc, artist_id);
@@ -0,0 +1,90 @@
+-- Range-partition streams by month of created_at (UTC), see src/partitions.py.
+-- The existing rows are copied into the new partitions inside this
+-- transaction, so stream writers wait for the whole migration.
+
+alter table public.streams rename to streams_unpartitioned;
+alter index public.streams_pkey rename to streams_unpartitioned_pkey;
+alter index public.streams_user_id_idx rename to streams_unpartitioned_user_id_idx;
+alter index public.streams_song_id_idx rename to streams_unpartitioned_song_id_idx;
+do $$
+begin
+  execute format('alter sequence %s rename to streams_unpartitioned_stream_id_seq',
+                 pg_get_serial_sequence('public.streams_unpartitioned', 'stream_id'));
+end $$;
+
+create table
+  public.streams (
+    stream_id bigint generated by default as identity,
+    created_at timestamp with time zone not null default now(),
+    user_id integer null,
+    song_id integer null,
+    constraint streams_pkey primary key (stream_id, created_at)
+  ) partition by range (created_at);
+
+-- Catches rows outside every monthly partition; normally empty.
+create table public.streams_default partition of public.streams default;
+
+-- Partitions archived to ARCHIVE_DIR and dropped.
+create table if not exists
+  public.streams_archive (
+    partition_name text not null,
+    range_start timestamp with time zone not null,
+    range_end timestamp with time zone not null,
+    path text not null,
+    row_count bigint not null,
+    archived_at timestamp with time zone not null default now(),
+    constraint streams_archive_pkey primary key (partition_name)
+  ) tablespace pg_default;
+
+-- Per user and song totals of the archived rows, so src/rollups.py can still
+-- rebuild and check lifetime counts.
+create table if not exists
+  public.streams_archived_plays (
+    user_id integer not null,
+    song_id integer not null,
+    play_count bigint not null,
+    first_played_at timestamp with time zone not null,
+    last_played_at timestamp with time zone not null,
+    constraint streams_archived_plays_pkey primary key (user_id, song_id)
+  ) tablespace pg_default;
+
+-- Creates streams_pYYYY_MM for every month from start_at's through the one
+-- containing end_at, skipping existing and archived months. Returns how many
+-- it created.
+create or replace function public.streams_create_partitions(start_at timestamp with time zone,
+                                                            end_at timestamp with time zone)
+returns integer language plpgsql as $$
+declare
+  month_start timestamp := date_trunc('month', start_at at time zone 'UTC');
+  child text;
+  created integer := 0;
+begin
+  while month_start at time zone 'UTC' <= end_at loop
+    child := 'streams_p' || to_char(month_start, 'YYYY_MM');
+    if to_regclass('public.' || child) is null
+       and not exists (select 1 from public.streams_archive a where a.partition_name = child) then
+      execute format('create table public.%I partition of public.streams for values from (%L) to (%L)',
+                     child, month_start at time zone 'UTC',
+                     (month_start + interval '1 month') at time zone 'UTC');
+      created := created + 1;
+    end if;
+    month_start := month_start + interval '1 month';
+  end loop;
+  return created;
+end $$;
+
+select public.streams_create_partitions(
+  coalesce((select min(created_at) from public.streams_unpartitioned), now()), now() + interval '3 months');
+
+insert into public.streams (stream_id, created_at, user_id, song_id)
+select stream_id, created_at, user_id, song_id from public.streams_unpartitioned;
+
+select setval(pg_get_serial_sequence('public.streams', 'stream_id'),
+              coalesce((select max(stream_id) from public.streams), 0) + 1, false);
+
+drop table public.streams_unpartitioned;
+
+create index streams_user_id_idx on public.streams using btree (user_id, stream_id);
+create index streams_song_id_idx on public.streams using btree (song_id);
+alter table public.streams add constraint streams_user_id_fkey foreign key (user_id) references public.users (user_id);
+alter table public.streams add constraint streams_song_id_fkey foreign key (song_id) references public.song (song_id);
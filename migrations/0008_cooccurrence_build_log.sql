@@ -0,0 +1,40 @@
+-- Lets python -m src.cooccurrence build read song_playlist without locking it.
+-- While cooccurrence_build.running is set, every insert into or delete from
+-- song_playlist records its playlists in cooccurrence_build_changes, and the
+-- build recounts just those playlists before it swaps the new weights in.
+
+create table if not exists
+  public.cooccurrence_build (
+    singleton boolean not null default true,
+    running boolean not null default false,
+    constraint cooccurrence_build_pkey primary key (singleton),
+    constraint cooccurrence_build_singleton check (singleton)
+  ) tablespace pg_default;
+
+insert into public.cooccurrence_build (singleton, running) values (true, false) on conflict do nothing;
+
+-- Only read by a running build, which empties it when it starts.
+create unlogged table if not exists
+  public.cooccurrence_build_changes (
+    playlist_id bigint not null
+  ) tablespace pg_default;
+
+create or replace function public.song_playlist_log_build_changes()
+returns trigger language plpgsql as $$
+begin
+  if exists (select 1 from public.cooccurrence_build where running) then
+    insert into public.cooccurrence_build_changes (playlist_id)
+    select distinct playlist_id from changed_rows;
+  end if;
+  return null;
+end $$;
+
+drop trigger if exists song_playlist_build_inserts on public.song_playlist;
+create trigger song_playlist_build_inserts after insert on public.song_playlist
+  referencing new table as changed_rows
+  for each statement execute function public.song_playlist_log_build_changes();
+
+drop trigger if exists song_playlist_build_deletes on public.song_playlist;
+create trigger song_playlist_build_deletes after delete on public.song_playlist
+  referencing old table as changed_rows
+  for each statement execute function public.song_playlist_log_build_changes();
@@ -0,0 +1,193 @@
+"""API key checks, per-key rate limits and per-route concurrency caps.
+
+Keys come from API_KEYS (comma-separated; the old single API_KEY still
+works) and API_KEY_HASHES (sha256 hex digests, for keys that shouldn't sit
+in the environment in plain text). Only the digests are kept, in a set, and
+each key shows up in counters as the first 12 hex digits of its digest. An
+API_KEYS entry may carry its own limits as key:rate:burst.
+
+Every request through auth.get_api_key is then admitted or shed before the
+handler runs:
+
+- Each key has a token bucket refilled at RATE_LIMIT_PER_SECOND up to
+  RATE_LIMIT_BURST. An empty bucket gets 429 with Retry-After set to when
+  the next token arrives. A rate of 0 turns the limit off.
+- Each route may run at most ROUTE_CONCURRENCY_SHARE of the database pool
+  (DB_POOL_SIZE + DB_MAX_OVERFLOW) at once, so one hammered route can't hold
+  every connection. ROUTE_CONCURRENCY overrides single routes as
+  route:limit pairs, by handler name. A full route gets 503 with
+  Retry-After: 1 and its token back. A share of 0 turns the caps off for
+  routes without an override.
+
+    python -m src.admission hash <key>   # the digest to put in API_KEY_HASHES
+
+Controller takes its keys, limits and clock as arguments so it can be
+driven in-process without the environment or real time.
+"""
+import argparse
+import hashlib
+import math
+import os
+import sys
+import threading
+import time
+
+import dotenv
+from fastapi import HTTPException
+
+from src import database as db
+
+dotenv.load_dotenv()
+
+RATE_LIMIT_PER_SECOND = float(os.environ.get("RATE_LIMIT_PER_SECOND", "50"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "100"))
+ROUTE_CONCURRENCY_SHARE = float(os.environ.get("ROUTE_CONCURRENCY_SHARE", "0.5"))
+SHED_RETRY_AFTER = 1
+
+
+def digest(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def key_id(key_digest):
+    return key_digest[:12]
+
+
+def parse_keys(keys="", hashes="", rate=RATE_LIMIT_PER_SECOND, burst=RATE_LIMIT_BURST):
+    """{digest: (rate, burst)} from API_KEYS-style and API_KEY_HASHES-style strings."""
+    limits = {}
+    for entry in filter(None, (part.strip() for part in keys.split(","))):
+        key, _, custom = entry.partition(":")
+        key_rate, _, key_burst = custom.partition(":")
+        limits[digest(key)] = (float(key_rate or rate), float(key_burst or burst))
+    for entry in filter(None, (part.strip().lower() for part in hashes.split(","))):
+        limits[entry] = (rate, burst)
+    return limits
+
+
+def parse_routes(routes=""):
+    """{route: limit} from ROUTE_CONCURRENCY-style route:limit pairs."""
+    caps = {}
+    for entry in filter(None, (part.strip() for part in routes.split(","))):
+        route, _, limit = entry.partition(":")
+        caps[route] = int(limit)
+    return caps
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """0.0 if a token was taken, else the seconds until one is available."""
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class Controller:
+    """Known key digests with their buckets, and in-flight requests per route."""
+
+    def __init__(self, limits, default_cap, route_caps=None, clock=time.monotonic):
+        self.default_cap = default_cap if default_cap is None else max(1, default_cap)
+        self.route_caps = route_caps or {}
+        self.clock = clock
+        self._lock = threading.Lock()
+        now = clock()
+        self._buckets = {key_digest: TokenBucket(rate, burst, now) for key_digest, (rate, burst) in limits.items()}
+        self._in_flight = {}
+        self._keys = {key_id(key_digest): {"admitted": 0, "rate_limited": 0, "shed": 0, "in_flight": 0}
+                      for key_digest in limits}
+        self._routes = {}
+
+    def authenticate(self, key):
+        """The key's digest if it is known, else None."""
+        if not key:
+            return None
+        key_digest = digest(key)
+        return key_digest if key_digest in self._buckets else None
+
+    def cap(self, route):
+        return self.route_caps.get(route, self.default_cap)
+
+    def _route_stats(self, route):
+        stats = self._routes.get(route)
+        if stats is None:
+            stats = self._routes[route] = {"in_flight": 0, "shed": 0, "cap": self.cap(route)}
+        return stats
+
+    def admit(self, key_digest, route):
+        """Take a token and a route slot for the request, or raise 429/503. Returns the release callback."""
+        counters = self._keys[key_id(key_digest)]
+        with self._lock:
+            bucket = self._buckets[key_digest]
+            wait = bucket.take(self.clock())
+            if wait:
+                counters["rate_limited"] += 1
+                raise HTTPException(status_code=429, detail="Rate limit exceeded",
+                                    headers={"Retry-After": str(max(1, math.ceil(wait)))})
+            route_stats = self._route_stats(route)
+            cap = self.cap(route)
+            if cap is not None and self._in_flight.get(route, 0) >= cap:
+                bucket.refund()
+                counters["shed"] += 1
+                route_stats["shed"] += 1
+                raise HTTPException(status_code=503, detail="Too many concurrent requests for this route",
+                                    headers={"Retry-After": str(SHED_RETRY_AFTER)})
+            self._in_flight[route] = self._in_flight.get(route, 0) + 1
+            route_stats["in_flight"] += 1
+            counters["admitted"] += 1
+            counters["in_flight"] += 1
+
+        def release():
+            with self._lock:
+                self._in_flight[route] -= 1
+                route_stats["in_flight"] -= 1
+                counters["in_flight"] -= 1
+
+        return release
+
+    def metrics(self):
+        with self._lock:
+            return {"keys": {name: dict(stats) for name, stats in self._keys.items()},
+                    "routes": {name: dict(stats) for name, stats in self._routes.items()}}
+
+
+def from_environment():
+    limits = parse_keys(",".join(filter(None, [os.environ.get("API_KEYS", ""), os.environ.get("API_KEY", "")])),
+                        os.environ.get("API_KEY_HASHES", ""))
+    default_cap = int((db.POOL_SIZE + db.MAX_OVERFLOW) * ROUTE_CONCURRENCY_SHARE) if ROUTE_CONCURRENCY_SHARE > 0 else None
+    return Controller(limits, default_cap, parse_routes(os.environ.get("ROUTE_CONCURRENCY", "")))
+
+
+controller = from_environment()
+
+
+def metrics():
+    return controller.metrics()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.admission", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["hash"])
+    parser.add_argument("key")
+    args = parser.parse_args(argv)
+    print(digest(args.key))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
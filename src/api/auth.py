@@ -1,20 +1,24 @@
 from fastapi import Security, HTTPException, status, Request
 from fastapi.security.api_key import APIKeyHeader
-import os
-import dotenv
+from src import admission
 
-dotenv.load_dotenv()
+api_key_header = APIKeyHeader(name="access_token", auto_error=False)
 
-api_keys = []  
 
-api_keys.append(os.environ.get("API_KEY"))
-api_key_header = APIKeyHeader(name="access_token", auto_error=False)
+def _route(request: Request):
+    endpoint = request.scope.get("endpoint")
+    return getattr(endpoint, "__name__", request.url.path)
 
 
 async def get_api_key(request: Request, api_key_header: str = Security(api_key_header)):
-    if api_key_header in api_keys:
-        return api_key_header
-    else:
+    """Checks the key, then holds a rate-limit token and a route slot until the response is sent"""
+    key_digest = admission.controller.authenticate(api_key_header)
+    if key_digest is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Forbidden"
         )
+    release = admission.controller.admit(key_digest, _route(request))
+    try:
+        yield api_key_header
+    finally:
+        release()
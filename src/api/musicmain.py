@@ -1,18 +1,28 @@
 from fastapi import APIRouter, Depends, Request
 from pydantic import BaseModel
 from src.api import auth
+from datetime import datetime
 from enum import Enum
 import math
 import sqlalchemy
+from src import admission
 from src import database as db
+from src import catalog_import
+from src.catalog_snapshot import catalog
+from src import embeddings
+from src import exports
+from src import genre_recommender
+from src import pagination
+from src import partitions
+from src import playlists
+from src import queries
+from src import response_cache
+from src import rollups
+from src import search
+from src.replicas import replicas
+from src.resolver import resolver
+from src import stream_ingest
 from typing import Dict
-from pip._vendor import requests
-import json
-# import openai
-# import creds as creds
-import os
-import dotenv
-from dotenv import load_dotenv, find_dotenv
 from fastapi import HTTPException
 
 
@@ -22,6 +32,135 @@ router = APIRouter(
     dependencies=[Depends(auth.get_api_key)],
 )
 
+# Records the vote and folds it into song_explicit_scores in the same statement.
+# No rows come back when the song doesn't exist.
+SUBMIT_RATING = sqlalchemy.text("""
+    WITH submitted AS (
+        INSERT INTO explicit_submissions (song_id, exbool)
+        SELECT song.song_id, CAST(:rating AS integer)
+        FROM song
+        JOIN artist ON artist.id = song.artist_id
+        WHERE song.song_name = :thesong
+        RETURNING song_id, exbool
+    )
+    INSERT INTO song_explicit_scores (song_id, votes, explicit_votes)
+    SELECT song_id, COUNT(*), COUNT(*) FILTER (WHERE exbool <> 0) FROM submitted
+    GROUP BY song_id
+    ON CONFLICT (song_id) DO UPDATE
+    SET votes = song_explicit_scores.votes + EXCLUDED.votes,
+        explicit_votes = song_explicit_scores.explicit_votes + EXCLUDED.explicit_votes
+    RETURNING song_id
+    """)
+
+# Creates the playlist for every user with the name unless one of them already
+# has a playlist by that name, and reports which happened.
+CREATE_PLAYLIST = sqlalchemy.text("""
+    WITH owner AS (
+        SELECT user_id FROM users WHERE username = :username
+    ),
+    existing AS (
+        SELECT 1 FROM user_playlist JOIN owner USING (user_id) WHERE user_playlist.playlist_name = :playlist_name
+    ),
+    created AS (
+        INSERT INTO user_playlist (playlist_name, user_id)
+        SELECT CAST(:playlist_name AS text), user_id FROM owner
+        WHERE NOT EXISTS (SELECT 1 FROM existing)
+        RETURNING user_id
+    )
+    SELECT EXISTS (SELECT 1 FROM existing) AS taken, ARRAY(SELECT user_id FROM created) AS user_ids
+    """)
+
+# Checks the song name exists, appends the album's song to the playlist and
+# counts its co-occurrence pairs with the playlist's other songs, all in one
+# round trip. The pair counts mirror cooccurrence.ADD_PAIRS for a single song.
+# The casts let asyncpg type the parameters the INSERT only selects.
+ADD_SONG_TO_PLAYLIST = sqlalchemy.text("""
+    WITH named AS (
+        SELECT song_id, album_id FROM song WHERE song_name = :song_name
+    ),
+    inserted AS (
+        INSERT INTO song_playlist (user_id, playlist_id, song_id, position)
+        SELECT CAST(:user_id AS bigint), CAST(:playlist_id AS bigint), named.song_id,
+               COALESCE((SELECT MAX(position) FROM song_playlist WHERE playlist_id = :playlist_id), 0) + 1
+        FROM named
+        WHERE named.album_id = :album_id
+        ORDER BY named.song_id
+        LIMIT 1
+        ON CONFLICT (playlist_id, song_id) DO NOTHING
+        RETURNING playlist_id, song_id
+    ),
+    others AS (
+        SELECT DISTINCT song_playlist.song_id FROM song_playlist, inserted
+        WHERE song_playlist.playlist_id = inserted.playlist_id AND song_playlist.song_id <> inserted.song_id
+    ),
+    pairs AS (
+        INSERT INTO song_cooccurrence (song_id, neighbor_id, weight)
+        SELECT inserted.song_id, others.song_id, 1 FROM inserted, others
+        UNION ALL
+        SELECT others.song_id, inserted.song_id, 1 FROM inserted, others
+        ON CONFLICT (song_id, neighbor_id) DO UPDATE
+        SET weight = song_cooccurrence.weight + EXCLUDED.weight
+    )
+    SELECT EXISTS (SELECT 1 FROM named)
+    """)
+
+# Removes the named song from every playlist with the name and uncounts its
+# co-occurrence pairs in the same round trip. The pairs mirror
+# cooccurrence.REMOVE_PAIRS; weights that would reach zero are deleted instead
+# of lowered. The final SELECT tells a missing song from a missing playlist.
+REMOVE_SONG_FROM_PLAYLIST = sqlalchemy.text("""
+    WITH removed AS (
+        DELETE FROM song_playlist
+        USING user_playlist, song
+        WHERE song_playlist.playlist_id = user_playlist.playlist_id
+        AND song_playlist.song_id = song.song_id
+        AND user_playlist.playlist_name = :playlist_name
+        AND song.song_name = :song_name
+        RETURNING song_playlist.playlist_id, song_playlist.song_id
+    ),
+    others AS (
+        SELECT sp.playlist_id, sp.song_id FROM song_playlist sp
+        WHERE sp.playlist_id IN (SELECT playlist_id FROM removed)
+          AND (sp.playlist_id, sp.song_id) NOT IN (SELECT playlist_id, song_id FROM removed)
+    ),
+    pairs AS (
+        SELECT r.song_id, o.song_id AS neighbor_id FROM removed r JOIN others o USING (playlist_id)
+        UNION ALL
+        SELECT o.song_id, r.song_id FROM removed r JOIN others o USING (playlist_id)
+        UNION ALL
+        SELECT a.song_id, b.song_id FROM removed a JOIN removed b USING (playlist_id)
+        WHERE a.song_id <> b.song_id
+    ),
+    decrements AS (
+        SELECT song_id, neighbor_id, COUNT(*) AS weight FROM pairs GROUP BY song_id, neighbor_id
+    ),
+    lowered AS (
+        UPDATE song_cooccurrence c SET weight = c.weight - d.weight
+        FROM decrements d
+        WHERE c.song_id = d.song_id AND c.neighbor_id = d.neighbor_id AND c.weight > d.weight
+    ),
+    emptied AS (
+        DELETE FROM song_cooccurrence c
+        USING decrements d
+        WHERE c.song_id = d.song_id AND c.neighbor_id = d.neighbor_id AND c.weight <= d.weight
+    )
+    SELECT EXISTS (SELECT 1 FROM song JOIN artist ON artist.id = song.artist_id WHERE song_name = :song_name) AS song_exists,
+           EXISTS (SELECT 1 FROM user_playlist WHERE playlist_name = :playlist_name) AS playlist_exists
+    """)
+
+TOP_STREAMS = sqlalchemy.text("""
+    SELECT ROW_NUMBER() OVER (ORDER BY counts.play_count DESC) AS Position,
+            song.song_name AS Song, artist.artist_name As Artist, counts.play_count AS Streams
+    FROM (
+        SELECT song_id, play_count FROM song_play_counts
+        ORDER BY play_count DESC
+        LIMIT 10
+    ) AS counts
+    JOIN song on song.song_id = counts.song_id
+    JOIN artist on artist.id = song.artist_id
+    ORDER BY Position ASC
+    """)
+
 class User(BaseModel):
     username: str
 
@@ -50,17 +189,25 @@ class Playlist(BaseModel):
     playlist_name: str
     user_id: int
 
+class Play(BaseModel):
+    song_name: str
+    artist_name: str
+    username: str
+
+class SongIds(BaseModel):
+    song_ids: list[int]
+
 @router.post("/add_user/")
 def add_user(username: str):
     """Add user to users table"""
 
     with db.engine.begin() as connection:
-        user_id = connection.execute(sqlalchemy.text("SELECT user_id FROM users WHERE username = :name"), 
-                            [{"name": username}]).scalar()
+        user_id = resolver.user_id(connection, username)
         if user_id is not None:
             return "User already exists!"
         connection.execute(sqlalchemy.text("INSERT INTO users (username) VALUES (:userName)"), 
                            [{"userName": username}])
+    resolver.forget_user(username)
 
     return f"User: {username} added!"
 
@@ -68,141 +215,174 @@ def add_user(username: str):
 def create_artist(artist_name: str):
     """ Create new artist  """
     with db.engine.begin() as connection:
-        artist_check = connection.execute(sqlalchemy.text(
-            "SELECT * FROM artist WHERE artist_name = :name"),
-                                        [{"name": artist_name}]).scalar()
+        artist_check = resolver.artist_id(connection, artist_name)
         if artist_check is None:
             artist_id = connection.execute(sqlalchemy.text("INSERT INTO artist (artist_name) VALUES (:name) RETURNING id"),
                                             [{"name": artist_name}]).scalar()
         else:
             return "Artist Creation Error: Artist already exists"
+    resolver.forget_artist(artist_name)
+    catalog.refresh()
+    search.search_index.refresh()
+    response_cache.invalidate(f"artist:{artist_name}")
     return {"Artist created! artist id": artist_id}
 
 @router.post("/upload_music/")
 def upload_new_music(new_album_catalog: Album):
     """Upload a new album including songs and metadata"""
     with db.engine.begin() as connection:
-        album_check = connection.execute(sqlalchemy.text(
-            "SELECT * FROM album WHERE album_name = :name"),
-                                        [{"name": new_album_catalog.album_name}]).scalar()
-        artistId = connection.execute(sqlalchemy.text(
-            "SELECT id FROM artist WHERE artist_name = :name"),
-                                        [{"name": new_album_catalog.artist_name}]).scalar()
+        album_check = resolver.album_id(connection, new_album_catalog.album_name)
+        artistId = resolver.artist_id(connection, new_album_catalog.artist_name)
         if album_check is None:
-            albumId = connection.execute(sqlalchemy.text(
-                "INSERT INTO album (album_name, artist_id, genre, explicit_rating, label, release_date) VALUES (:album_name, :artist_id, :genre, :xprat, :label, :release_date) RETURNING id"),
-                    [{"album_name": new_album_catalog.album_name, "artist_id": artistId, "genre": new_album_catalog.genre, "xprat": new_album_catalog.explicit_rating, "label": new_album_catalog.label, "release_date": new_album_catalog.release_date}]).scalar()
-            for song in new_album_catalog.song_list:
-                connection.execute(sqlalchemy.text(
-                    "INSERT INTO song (song_name, artist_id, featured_artist, explicit_rating, length, album_id) VALUES (:song_name, :artist_id, :featured_artist, :explicit_rating, :length, :album_id)"),
-                        [{"song_name": song.song_name, "artist_id": artistId, "featured_artist": song.featured_artist, "explicit_rating": song.explicit_rating, "length": song.length, "album_id": albumId}])
+            catalog_import.insert_album(connection, new_album_catalog, artistId)
         else:
             return "Upload Error: Album already exists"
+    resolver.forget_album(new_album_catalog.album_name)
+    for song in new_album_catalog.song_list:
+        resolver.forget_song(song.song_name, new_album_catalog.artist_name)
+    catalog.refresh()
+    search.search_index.refresh()
+    response_cache.invalidate(f"artist:{new_album_catalog.artist_name}", f"album:{new_album_catalog.album_name}")
     return f"Album: {new_album_catalog.album_name} uploaded!"
 
+@router.post("/catalog/import/")
+async def import_catalog(request: Request, file_format: str = "jsonl"):
+    """Bulk-load a JSONL (one album per line) or CSV (one song per row) catalog streamed in the request body"""
+    if file_format not in ("jsonl", "csv"):
+        raise HTTPException(status_code=400, detail="file_format must be jsonl or csv")
+    return await catalog_import.import_body(request.stream(), file_format)
+
+@router.get("/admission/metrics/")
+def admission_metrics():
+    """Admitted, rate-limited, shed and in-flight requests per API key, and in-flight requests per route"""
+    return admission.metrics()
+
+@router.get("/export/{table}")
+def export_table(table: str, format: str = "csv", since: datetime = None, until: datetime = None, from_id: int = None,
+                 to_id: int = None, part: int = 0, parts: int = 1):
+    """Stream a table as CSV or NDJSON (optionally gzipped) straight from COPY, optionally one ID range of it"""
+    return exports.response(table, format, since, until, from_id, to_id, part, parts)
+
+@router.get("/resolver/metrics/")
+def resolver_metrics():
+    """Hit, miss and eviction counts for the name-to-ID caches"""
+    return resolver.metrics()
+
 @router.post("/search_for_song/")
+@response_cache.cached("artist:{artist_name}")
 def search_for_song(song_name: str, artist_name: str):
     """Search for a song by name and artist"""
-    with db.engine.begin() as connection:
-        song_id = connection.execute(sqlalchemy.text("SELECT song_id FROM song JOIN artist ON artist.id = song.artist_id WHERE song_name = :name AND artist_name = :artist_name"),
-                            [{"name": song_name, "artist_name": artist_name}]).scalar()
+    if catalog.ready:
+        if catalog.song_id(song_name, artist_name) is None:
+            return f"Song: {song_name} does not exist by the Artist: {artist_name}"
+        return f"Song: {song_name} by {artist_name} exists!"
+    with replicas.read() as connection:
+        song_id = resolver.song_id(connection, song_name, artist_name)
         if song_id is None:
             return f"Song: {song_name} does not exist by the Artist: {artist_name}"
     return f"Song: {song_name} by {artist_name} exists!"
 
 @router.post("/search_for_artist/")
+@response_cache.cached("artist:{artist_name}")
 def search_for_artist(artist_name: str):
     """Search for an artist by name"""
-    with db.engine.begin() as connection:
-        artist_id = connection.execute(sqlalchemy.text("SELECT id FROM artist WHERE artist_name = :name"),
-                            [{"name": artist_name}]).scalar()
+    if catalog.ready:
+        if catalog.artist_id(artist_name) is None:
+            return f"Artist: {artist_name} does not exist"
+        return f"Artist: {artist_name} exists!"
+    with replicas.read() as connection:
+        artist_id = resolver.artist_id(connection, artist_name)
         if artist_id is None:
             return f"Artist: {artist_name} does not exist"
     return f"Artist: {artist_name} exists!"
 
 @router.post("/search_for_album/")
+@response_cache.cached("album:{album_name}")
 def search_for_album(album_name: str):
     """Search for an album by name"""
-    with db.engine.begin() as connection:
-        album_id = connection.execute(sqlalchemy.text("SELECT id FROM album WHERE album_name = :name"),
-                            [{"name": album_name}]).scalar()
+    if catalog.ready:
+        if catalog.album_id(album_name) is None:
+            return f"Album: {album_name} does not exist"
+        return f"Album: {album_name} exists!"
+    with replicas.read() as connection:
+        album_id = resolver.album_id(connection, album_name)
         if album_id is None:
             return f"Album: {album_name} does not exist"
     return f"Album: {album_name} exists!"
 
+@router.post("/search/")
+def search_catalog(q: str, types: str = "song,artist,album", cursor: str = None, limit: int = search.DEFAULT_PAGE_SIZE):
+    """Ranked prefix and typo-tolerant search across songs, artists and albums, a page at a time"""
+    return search.search_index.page(replicas.read, q, types.split(","), cursor, limit)
+
 @router.post("/artist_albums/")
-def artist_albums(artist_name: str):
-    """Get all albums by an artist"""
-    output = []
-    with db.engine.begin() as connection:
-        artist_id = connection.execute(sqlalchemy.text("SELECT id FROM artist WHERE artist_name = :name"),
-                            [{"name": artist_name}]).scalar()
-        if artist_id is None:
-            return "Artist does not exist!"
-        result = connection.execute(sqlalchemy.text("SELECT album_name FROM album WHERE artist_id = :id"),
-                            [{"id": artist_id}])
-    if result is not None:
-        for album_name in result:
-            output.append(album_name[0])
-    return output
+@response_cache.cached("artist:{artist_name}")
+def artist_albums(artist_name: str, cursor: str = None, limit: int = pagination.DEFAULT_PAGE_SIZE, stream: bool = False):
+    """Get all albums by an artist, a page at a time"""
+    if catalog.ready and not stream:
+        page = catalog.artist_albums(artist_name, cursor, limit)
+        return "Artist does not exist!" if page is None else page
+    with replicas.read() as connection:
+        return queries.listing(connection, queries.ARTIST_ALBUMS,
+                               {"artist_name": artist_name}, ["after_id"], lambda row: [row.id],
+                               lambda row: {"album_id": row.id, "album_name": row.album_name},
+                               cursor, limit, stream)
 
 @router.post("/album_songs/")
-def album_songs(album_name: str):
-    """Get all songs in an album"""
-    output = []
-    with db.engine.begin() as connection:
-        album_id = connection.execute(sqlalchemy.text("SELECT id FROM album WHERE album_name = :name"),
-                            [{"name": album_name}]).scalar()
-        if album_id is None:
-            return "Album does not exist!"
-        result = connection.execute(sqlalchemy.text("SELECT song_name FROM song WHERE album_id = :id"),
-                            [{"id": album_id}])
-    if result is not None:
-        for song_name in result:
-            output.append(song_name[0])
-    return output
+@response_cache.cached("album:{album_name}")
+def album_songs(album_name: str, cursor: str = None, limit: int = pagination.DEFAULT_PAGE_SIZE, stream: bool = False):
+    """Get all songs in an album, a page at a time"""
+    if catalog.ready and not stream:
+        page = catalog.album_songs(album_name, cursor, limit)
+        return "Album does not exist!" if page is None else page
+    with replicas.read() as connection:
+        return queries.listing(connection, queries.ALBUM_SONGS,
+                               {"album_name": album_name}, ["after_id"], lambda row: [row.song_id],
+                               lambda row: {"song_id": row.song_id, "song_name": row.song_name},
+                               cursor, limit, stream)
 
 @router.post("/song_info/")
+@response_cache.cached("artist:{artist_name}")
 def song_info(song_name: str, artist_name: str):
     """Get all info for a song"""
+    if catalog.ready:
+        output = catalog.song_info(song_name, artist_name)
+        return "Song does not exist by this Artist!" if output is None else output
+    with replicas.read() as connection:
+        missing, result = queries.fetch(connection, queries.SONG_INFO,
+                                        {"song_name": song_name, "artist_name": artist_name})
+    if missing is not None:
+        return missing
     output = []
-    with db.engine.begin() as connection:
-        song_id = connection.execute(sqlalchemy.text("SELECT song_id FROM song JOIN artist ON artist.id = song.artist_id WHERE song_name = :name AND artist_name = :artist_name"),
-                            [{"name": song_name, "artist_name": artist_name}]).scalar()
-        if song_id is None:
-            return "Song does not exist by this Artist!"
-        result = connection.execute(sqlalchemy.text("SELECT song_name, featured_artist, explicit_rating, length FROM song WHERE song_id = :id"),
-                            [{"id": song_id}])
-    if result is not None:
-        for song_name, featured_artist, explicit_rating, length in result:
-            output.append({
-                "Name": song_name,
-                "Featured Artist": featured_artist,
-                "Explicit Rating": explicit_rating,
-                "Length": length
-            })
+    for song_name, featured_artist, explicit_rating, length in result:
+        output.append({
+            "Name": song_name,
+            "Featured Artist": featured_artist,
+            "Explicit Rating": explicit_rating,
+            "Length": length
+        })
     return output
 
 @router.post("/album_info/")
+@response_cache.cached("album:{album_name}")
 def album_info(album_name: str):
     """Get all info for an album"""
+    if catalog.ready:
+        output = catalog.album_info(album_name)
+        return "Album does not exist!" if output is None else output
+    with replicas.read() as connection:
+        missing, result = queries.fetch(connection, queries.ALBUM_INFO, {"album_name": album_name})
+    if missing is not None:
+        return missing
     output = []
-    with db.engine.begin() as connection:
-        album_id = connection.execute(sqlalchemy.text("SELECT id FROM album WHERE album_name = :name"),
-                            [{"name": album_name}]).scalar()
-        if album_id is None:
-            return "Album does not exist!"
-        result = connection.execute(sqlalchemy.text("SELECT artist_name, album_name, genre, explicit_rating, label, release_date FROM album JOIN artist ON artist.id = album.artist_id WHERE album.id = :id"),
-                            [{"id": album_id}])
-    if result is not None:
-        for artist_name, album_name, genre, explicit_rating, label, release_date in result:
-            output.append({
-                "Artist": artist_name,
-                "Album Name": album_name,
-                "Genre": genre,
-                "Explicit Rating": explicit_rating,
-                "Label": label,
-                "Release Date": release_date})
+    for row in result:
+        output.append({
+            "Artist": row.artist_name,
+            "Album Name": row.album_name,
+            "Genre": row.genre,
+            "Explicit Rating": row.explicit_rating,
+            "Label": row.label,
+            "Release Date": row.release_date})
     return output
 
 @router.post("/log_streams/")
@@ -210,289 +390,251 @@ def log_streams(song_name: str, artist_name: str, username: str):
     """   Take in a song that is logged by a user, and put it in the stream table"""
 
     with db.engine.begin() as connection:
-        user_id = connection.execute(sqlalchemy.text("SELECT user_id FROM users WHERE username = :name"), 
-                            [{"name": username}]).scalar()
+        user_id = resolver.user_id(connection, username)
         if user_id is None:
             return "User does not exist!"
-        song_id = connection.execute(sqlalchemy.text("SELECT song_id FROM song JOIN artist ON artist.id = song.artist_id WHERE song_name = :name AND artist_name = :artist_name"),
-                            [{"name": song_name, "artist_name": artist_name}]).scalar()
+        song_id = resolver.song_id(connection, song_name, artist_name)
         if song_id is None:
             return "Song does not exist by this Artist!"
-        
-        connection.execute(sqlalchemy.text("INSERT INTO streams (user_id, song_id) VALUES (:userID, :songID)"), 
-                            [{"userID": user_id , "songID": song_id}])
 
+        if not stream_ingest.BUFFERED:
+            stream_ingest.insert_streams(connection, [(user_id, song_id, stream_ingest.now())])
+
+    if stream_ingest.BUFFERED and stream_ingest.buffer.put([(user_id, song_id, stream_ingest.now())]) == 0:
+        raise HTTPException(status_code=503, detail="Stream buffer is full, try again later",
+                            headers={"Retry-After": "1"})
+    replicas.wrote(username)
     return "Song streamed!"
 
-@router.post("/get_total_streams/")
-def get_streams(username: str):
-    """Lists of all songs streamed by user"""
-    output = [()]
+@router.post("/log_streams/bulk/")
+def log_streams_bulk(plays: list[Play]):
+    """Log many plays in one request, resolving names and inserting them set-based"""
+    if len(plays) > stream_ingest.BULK_MAX_PLAYS:
+        raise HTTPException(status_code=413, detail=f"At most {stream_ingest.BULK_MAX_PLAYS} plays per request")
+
+    stamp = stream_ingest.now()
     with db.engine.begin() as connection:
-        user_id = connection.execute(sqlalchemy.text("SELECT user_id FROM users WHERE username = :name"), 
-                            [{"name": username}]).scalar()
-        if user_id is None:
-            return "User does not exist!"
-        result = connection.execute(sqlalchemy.text(""" 
-                                                    SELECT song.song_name, artist.artist_name, song.featured_artist FROM streams
-                                                    JOIN song on streams.song_id = song.song_id 
-                                                    JOIN artist on artist.id = song.artist_id 
-                                                    JOIN users on users.user_id = streams.user_id
-                                                    WHERE users.user_id = :USERID
-                                                                    """), [{"USERID": user_id}])
-
-    if result is not None:
-        for song_name, artist_name, featured_artist in result:
-            output.append((song_name, artist_name))
+        resolved = stream_ingest.resolve_plays(connection, [(play.username, play.song_name, play.artist_name) for play in plays])
+        batch = [(user_id, song_id, stamp) for user_id, song_id in resolved if user_id is not None and song_id is not None]
+        unresolved = [i for i, (user_id, song_id) in enumerate(resolved) if user_id is None or song_id is None]
+        if not stream_ingest.BUFFERED:
+            stream_ingest.insert_streams(connection, batch)
+
+    accepted = stream_ingest.buffer.put(batch) if stream_ingest.BUFFERED else len(batch)
+    if accepted:
+        replicas.wrote(*{play.username for play, (user_id, song_id) in zip(plays, resolved)
+                         if user_id is not None and song_id is not None})
+    return {"logged": accepted, "unresolved": unresolved, "dropped": len(batch) - accepted}
+
+@router.get("/log_streams/metrics/")
+def log_streams_metrics():
+    """Queue depth, batch sizes, flush latency and backpressure counters for stream ingestion"""
+    return stream_ingest.buffer.metrics()
+
+def stream_item(row):
+    return {"stream_id": row.stream_id, "played_at": row.created_at, "song_name": row.song_name,
+            "artist_name": row.artist_name, "featured_artist": row.featured_artist}
 
-    return output
+@router.post("/get_total_streams/")
+def get_streams(username: str, cursor: str = None, limit: int = pagination.DEFAULT_PAGE_SIZE, stream: bool = False,
+                include_archived: bool = False):
+    """Lists songs streamed by user, most recent first, a page at a time, optionally with archived plays"""
+    if include_archived and stream:
+        raise HTTPException(status_code=400, detail="include_archived can't be combined with stream")
+    with replicas.read(username) as connection:
+        if include_archived:
+            return partitions.listing_with_archive(connection, username, stream_item, cursor, limit)
+        return queries.listing(connection, queries.USER_STREAMS,
+                               {"username": username}, ["after_id"], lambda row: [row.stream_id], stream_item,
+                               cursor, limit, stream)
 
 @router.post("/get_stream_by_artist/")
-def streams_by_artist(user: User, artist: Artist):
-    """Get all streams for one artist by one user"""
-
-    output = []
-    with db.engine.begin() as connection:
-        user_id = connection.execute(sqlalchemy.text("SELECT user_id FROM users WHERE username = :name"), 
-                            [{"name": user.username}]).scalar()
-        if user_id is None:
-            return "User doesn't exist!"
-        artist_name = connection.execute(sqlalchemy.text(
-            "SELECT * FROM artist WHERE artist_name = :name"),
-                                        [{"name": artist.artist_name}]).scalar()
-        if artist_name is None:
-            return "Artist doesn't exist!"
-
-        result = connection.execute(sqlalchemy.text(""" 
-                                                SELECT song.song_name  FROM streams
-                                                JOIN song on streams.song_id = song.song_id 
-                                                JOIN artist on artist.id = song.artist_id 
-                                                JOIN users on users.user_id = streams.user_id
-                                                WHERE users.username = :USERNAME AND artist.artist_name = :ARTISTID
-                                                                """), [{"USERNAME": user.username, "ARTISTID": artist.artist_name}])
-    if result is None:
-        return "Username or Artist name is incorrect"
-
-    if result is not None:
-        for row in result:
-            output.append(row[0]) 
-
-    return output
+def streams_by_artist(user: User, artist: Artist, cursor: str = None, limit: int = pagination.DEFAULT_PAGE_SIZE,
+                      stream: bool = False):
+    """Get all streams for one artist by one user, most recent first, a page at a time"""
+    with replicas.read(user.username) as connection:
+        return queries.listing(connection, queries.USER_ARTIST_STREAMS,
+                               {"username": user.username, "artist_name": artist.artist_name}, ["after_id"],
+                               lambda row: [row.stream_id],
+                               lambda row: {"stream_id": row.stream_id, "played_at": row.created_at,
+                                            "song_name": row.song_name},
+                               cursor, limit, stream)
+
+@router.post("/users/top_artists/")
+def user_top_artists(username: str, limit: int = 10):
+    """A user's most played artists with first and last play, from the per-user rollup"""
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    with replicas.read(username) as connection:
+        missing, result = queries.fetch(connection, queries.USER_TOP_ARTISTS, {"username": username, "limit": limit})
+    if missing is not None:
+        return missing
+    return [{"artist_name": row.artist_name, "plays": row.play_count, "first_played_at": row.first_played_at,
+             "last_played_at": row.last_played_at}
+            for row in result]
+
+@router.post("/users/top_songs/")
+def user_top_songs(username: str, limit: int = 10):
+    """A user's most played songs with first and last play, from the per-user rollup"""
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    with replicas.read(username) as connection:
+        missing, result = queries.fetch(connection, queries.USER_TOP_SONGS, {"username": username, "limit": limit})
+    if missing is not None:
+        return missing
+    return [{"song_name": row.song_name, "artist_name": row.artist_name, "plays": row.play_count,
+             "first_played_at": row.first_played_at, "last_played_at": row.last_played_at}
+            for row in result]
+
+@router.post("/users/artist_plays/")
+def user_artist_plays(username: str, artist_name: str):
+    """How often a user has played an artist, and when first and last"""
+    with replicas.read(username) as connection:
+        missing, result = queries.fetch(connection, queries.USER_ARTIST_PLAYS,
+                                        {"username": username, "artist_name": artist_name})
+    if missing is not None:
+        return missing
+    row = result[0]
+    return {"artist_name": artist_name, "plays": row.play_count, "first_played_at": row.first_played_at,
+            "last_played_at": row.last_played_at}
 
 @router.post("/create_playlist/") 
 def create_playlist(playlist_name: str, username: str):
     """Create a new playlist for a user"""
     with db.engine.begin() as connection:
-
-        new_playlist_name = connection.execute(sqlalchemy.text("""SELECT playlist_name FROM user_playlist
-                                              JOIN users on users.user_id = user_playlist.user_id
-                                              WHERE playlist_name = :PLAYNAME AND users.username = :USERNAME """),
-                                              [{"PLAYNAME": playlist_name, "USERNAME": username}]).scalar()
-        
-        if new_playlist_name is None:
-            connection.execute(sqlalchemy.text("""INSERT INTO user_playlist (playlist_name, user_id)
-                                                SELECT :playlist_name, user_id
-                                                FROM users where username = :username"""),
-                            [{"playlist_name": playlist_name, "username": username}])
-            return f"Playlist: {playlist_name} Created!"
-        else:
-            return "playlist name already exists for that user"
+        taken, user_ids = connection.execute(CREATE_PLAYLIST,
+                                             {"playlist_name": playlist_name, "username": username}).one()
+    if taken:
+        return "playlist name already exists for that user"
+    for user_id in user_ids:
+        resolver.forget_playlist(user_id, playlist_name)
+    if user_ids:
+        replicas.wrote(username)
+    response_cache.invalidate(f"playlist:{playlist_name}")
+    return f"Playlist: {playlist_name} Created!"
 
 @router.post("/add_song_to_playlist/")
 def add_songs_to_playlist(song_name: str, album: str, playlist_name: str , username: str):
     """Add a song to a playlist for a user"""
     with db.engine.begin() as connection:
 
-        user_id = connection.execute(sqlalchemy.text("SELECT user_id FROM users WHERE username = :name"), 
-                            [{"name": username}]).scalar()
+        user_id = resolver.user_id(connection, username)
         
         if user_id is None:
             return "User doesn't exist"
         
-        album_id = connection.execute(sqlalchemy.text("SELECT id FROM album WHERE album_name = :name"), 
-                            [{"name": album}]).scalar()
+        album_id = resolver.album_id(connection, album)
         
         if album_id is None:
             return "Album doesn't exist"
         
-        
-        playlist_id = connection.execute(sqlalchemy.text("SELECT playlist_id FROM user_playlist WHERE user_id = :id AND playlist_name = :name"), 
-                                    [{"id": user_id, "name": playlist_name}]).scalar()
+        playlist_id = resolver.playlist_id(connection, user_id, playlist_name)
         
         if playlist_id is None:
             return "Playlist doesn't exist"
 
-
-        song_check = connection.execute(sqlalchemy.text(
-            "SELECT song_id FROM song WHERE song_name = :name"),
-                                        [{"name": song_name}]).scalar()
-        if song_check is not None:
-            connection.execute(sqlalchemy.text(
-                    """INSERT INTO song_playlist (playlist_id, song_id)
-                            WITH
-                            playlist_id AS (
-                                SELECT
-                                    playlist_id
-                                FROM
-                                    user_playlist
-                                JOIN users ON users.user_id = user_playlist.user_id
-                                WHERE
-                                    users.username = :username
-                                    AND user_playlist.playlist_name = :playlist_name
-                            ),
-                            song_id AS (
-                                SELECT
-                                    song.song_id
-                                FROM
-                                    song
-                                JOIN album on album.id = song.album_id
-                                WHERE
-                                    song.song_name = :song_name 
-                                    AND album.album_name = :album
-                            )
-                            SELECT
-                            *
-                            FROM
-                            playlist_id,
-                            song_id
-                            """),
-                        [{"song_name": song_name, "album": album, "username": username, "playlist_name": playlist_name}])
-        else:
+        song_exists = connection.execute(ADD_SONG_TO_PLAYLIST,
+                                         {"user_id": user_id, "playlist_id": playlist_id, "album_id": album_id,
+                                          "song_name": song_name}).scalar()
+        if not song_exists:
             return "Song Addition Error: Song does not exist"
+        replicas.wrote(username)
+    response_cache.invalidate(f"playlist:{playlist_name}")
     return f"Song: {song_name} Added to Playlist: {playlist_name}"
 
-@router.post("/view_playlist/")
-def view_playlist(playlist_name: str, username: str):
-    """View all songs in a playlist"""
-    playlist = []
+def _apply_batch(mutation, playlist_id, song_ids):
     with db.engine.begin() as connection:
-        user_id = connection.execute(sqlalchemy.text("SELECT user_id FROM users WHERE username = :name"), 
-                            [{"name": username}]).scalar()
-        if user_id is None:
-            return "User does not exist!"
-        playlist_id = connection.execute(sqlalchemy.text("SELECT playlist_id FROM user_playlist WHERE user_id = :id AND playlist_name = :name"), 
-                            [{"id": user_id, "name": playlist_name}]).scalar()
-        if playlist_id is None:
-            return "Playlist does not exist!"
-        
-        playlist_songs = connection.execute(sqlalchemy.text("""
-                                                SELECT song.song_name
-                                                FROM song_playlist
-                                                JOIN user_playlist on user_playlist.playlist_id = song_playlist.playlist_id
-                                                JOIN song on song.song_id = song_playlist.song_id
-                                                JOIN users on users.user_id = user_playlist.user_id
-                                                WHERE user_playlist.playlist_name = :playlistName AND users.username = :username"""),
-                           [{"playlistName": playlist_name, "username": username}])
-        for row in playlist_songs:
-            playlist.append(row[0])
-        
-    return playlist
+        change = mutation(connection, playlist_id, song_ids)
+    if change is None:
+        return None
+    if change.username is not None:
+        replicas.wrote(change.username)
+    if change.song_ids:
+        response_cache.invalidate(f"playlist:{change.playlist_name}")
+    return change
+
+@router.post("/playlist/{playlist_id}/songs/add")
+def add_songs_batch(playlist_id: int, body: SongIds):
+    """Append songs to a playlist in the given order, skipping ones already in it"""
+    change = _apply_batch(playlists.add_songs, playlist_id, playlists.check_batch(body.song_ids))
+    if change is None:
+        return "Playlist doesn't exist"
+    return {"added": change.song_ids}
+
+@router.post("/playlist/{playlist_id}/songs/remove")
+def remove_songs_batch(playlist_id: int, body: SongIds):
+    """Remove songs from a playlist"""
+    change = _apply_batch(playlists.remove_songs, playlist_id, playlists.check_batch(body.song_ids))
+    if change is None:
+        return "Playlist doesn't exist"
+    return {"removed": change.song_ids}
+
+@router.post("/playlist/{playlist_id}/songs/reorder")
+def reorder_songs_batch(playlist_id: int, body: SongIds):
+    """Move songs to the front of a playlist in the given order, keeping the rest behind them"""
+    change = _apply_batch(playlists.reorder_songs, playlist_id, playlists.check_batch(body.song_ids))
+    if change is None:
+        return "Playlist doesn't exist"
+    return {"moved": len(change.song_ids)}
+
+@router.post("/view_playlist/")
+def view_playlist(playlist_name: str, username: str, cursor: str = None, limit: int = pagination.DEFAULT_PAGE_SIZE,
+                  stream: bool = False):
+    """View the songs in a playlist in playlist order, a page at a time"""
+    with replicas.read(username) as connection:
+        return queries.listing(connection, queries.PLAYLIST_SONGS,
+                               {"username": username, "playlist_name": playlist_name},
+                               ["after_position", "after_id"], lambda row: [row.position, row.song_id],
+                               lambda row: {"song_id": row.song_id, "song_name": row.song_name,
+                                            "added_at": row.created_at},
+                               cursor, limit, stream)
 
 @router.post("/songs/submit_rating/")
 def add_rating_to_song(song: str, user_rating: int):
     """Submits their rating for a song if it is explicit or not"""
     with db.engine.begin() as connection:
-
-        song_id = connection.execute(sqlalchemy.text("SELECT song_id FROM song JOIN artist ON artist.id = song.artist_id WHERE song_name = :name"),
-                            [{"name": song}]).scalar()
-        
-        if song_id is None:
-            return "Song doesn't exist"
-
-
-        connection.execute(sqlalchemy.text("""INSERT INTO explicit_submissions (song_id, exbool) 
-                                            SELECT song_id, :rating
-                                            FROM song
-                                            WHERE song_name = :thesong"""),
-                           [{"thesong": song, "rating": user_rating}])
-    
+        rated = connection.execute(SUBMIT_RATING, {"thesong": song, "rating": user_rating}).first()
+    if rated is None:
+        return "Song doesn't exist"
     return "Rating Submitted"
 
 @router.post("/playlist/get_clean_songs/")
-def get_clean_songs(playlist_name: str):
-    """Returns all songs from the playlist that are not explicit"""
-    
-    filtered_arr = []
-    with db.engine.begin() as connection:
-
-        playlist_id = connection.execute(sqlalchemy.text("SELECT playlist_id FROM user_playlist WHERE playlist_name = :name"), 
-                            [{"name": playlist_name}]).scalar()
-                
-        if playlist_id is None:
-            return "Playlist doesn't exist"
-
-        filtered_list = connection.execute(sqlalchemy.text("""SELECT song_name
-                                                FROM song_playlist
-                                                JOIN user_playlist on user_playlist.playlist_id = song_playlist.playlist_id
-                                                JOIN song on song.song_id = song_playlist.song_id
-                                                WHERE user_playlist.playlist_name = :playlistName"""),
-                           [{"playlistName": playlist_name}])
-    
-        for row in filtered_list:
-            filtered_arr.append(row[0]) 
-            
-    return filtered_arr
+def get_clean_songs(playlist_name: str, threshold: float = rollups.EXPLICIT_THRESHOLD):
+    """Returns the songs from the playlist whose share of explicit votes is below threshold"""
+    if not 0 < threshold <= 1:
+        raise HTTPException(status_code=400, detail="threshold must be in (0, 1]")
+
+    with replicas.read() as connection:
+        missing, result = queries.fetch(connection, queries.CLEAN_PLAYLIST_SONGS,
+                                        {"playlist_name": playlist_name, "threshold": threshold})
+    if missing is not None:
+        return missing
+    return [row.song_name for row in result]
 
 @router.post("/songs/recommend_songs/")
-def recommend_song(genre: str):
+async def recommend_song(genre: str):
     """Reccomends a song based on the genre given by the user"""
-
-    APIKEY = ""
-
-    dotenv_path = find_dotenv()
-    load_dotenv(dotenv_path)
-
-    APIKEY = os.environ.get("CHAT_KEY")
-
-    # Define the endpoint URL
-    url = "https://api.openai.com/v1/chat/completions"
-
-    # Define the request headers
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": "Bearer " + APIKEY
-    }
-
-    # Define the request payload
-    payload = {
-        "model": "gpt-3.5-turbo",
-        "messages": [{"role": "user", "content": f"You are a Music Reccomendation assistant, I will give you a genre name or lead, and then you will reccomend one song based on that. And you will only say the song name, and artist, nothing else\
-                      Reccomend me a song that is {genre}."}],
-        "temperature": 0.7
-    }
-
-    # Convert payload to JSON format
-    payload_json = json.dumps(payload)
-
-    # Make the POST request
-    response = requests.post(url, headers=headers, data=payload_json)
-
-    # Print the response
-    myDict = {}
-    myDict = response.json()
-    myDict= myDict['choices']
-    myDict = myDict[0]
-    myDict = myDict['message']['content']
-
-    
-    return myDict
+    try:
+        return await genre_recommender.recommender.recommend(genre)
+    except genre_recommender.UpstreamBusy:
+        raise HTTPException(status_code=503, detail="Recommendation service is busy, try again later",
+                            headers={"Retry-After": "1"})
+    except genre_recommender.UpstreamError as e:
+        raise HTTPException(status_code=502, detail=f"Recommendation service failed: {e}")
+
+@router.get("/songs/recommend_songs/metrics/")
+def recommend_song_metrics():
+    """Cache hit ratio, coalesced requests and upstream latency for the genre recommender"""
+    return genre_recommender.recommender.metrics()
 
 @router.post("/top_streams/")
+@response_cache.cached(ttl=response_cache.TOP_STREAMS_TTL)
 def top_streams():
-    """Gets the top 10 streamed songs"""
+    """Gets the top 10 streamed songs from the song_play_counts rollup"""
     try:
         stream_data = []
-        with db.engine.begin() as connection:
-            top_streams = connection.execute(sqlalchemy.text("""
-                                            SELECT ROW_NUMBER() OVER (ORDER BY COUNT(streams.stream_id) DESC) AS Position,
-                                                    song.song_name AS Song, artist.artist_name As Artist, COUNT(streams.stream_id) AS Streams
-                                            FROM streams
-                                            JOIN song on song.song_id = streams.song_id
-                                            JOIN artist on artist.id = song.artist_id
-                                            GROUP BY streams.song_id, song.song_name, artist.artist_name
-                                            ORDER BY Position ASC
-                                            LIMIT 10
-                                            """))
+        with replicas.read() as connection:
+            top_streams = connection.execute(TOP_STREAMS)
             for Position, Song, Artist, Streams in top_streams:
                 stream_data.append({
                     'Position': Position,
@@ -504,78 +646,40 @@ def top_streams():
         raise HTTPException(status_code=500, detail=str(e))
     return stream_data
 
+@router.post("/top_streams/window/")
+def top_streams_window(hours: int = 24, limit: int = 10):
+    """Gets the top streamed songs over the last `hours` hours from the bucketed play counts"""
+    if not 1 <= hours <= rollups.MAX_WINDOW_HOURS:
+        raise HTTPException(status_code=400, detail=f"hours must be between 1 and {rollups.MAX_WINDOW_HOURS}")
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+
+    stream_data = []
+    with replicas.read() as connection:
+        for Position, Song, Artist, Streams in connection.execute(rollups.TOP_SONGS_IN_WINDOW,
+                                                                  {"hours": hours, "limit": limit}):
+            stream_data.append({
+                'Position': Position,
+                'Song': Song,
+                'Artist': Artist,
+                'Streams': Streams
+            })
+    return stream_data
+
 @router.post("/playlist/recommend")
-def recommend_new_songs(playlist_name: str):
-    """Gets the top 5 songs based on your playlist and other playlists with similar songs"""
+@response_cache.cached("playlist:{playlist_name}")
+def recommend_new_songs(playlist_name: str, limit: int = 5):
+    """Gets the top songs that share the most playlists with the songs in your playlist"""
+    if not 1 <= limit <= 50:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 50")
     try: 
         ret = []
-        with db.engine.begin() as connection:
-
-            playlist_id = connection.execute(sqlalchemy.text("SELECT playlist_id FROM user_playlist WHERE playlist_name = :name"), 
-                            [{"name": playlist_name}]).scalar()
-                
-            if playlist_id is None:
-                return "Playlist doesn't exist"
-
-            recc_songs = connection.execute(sqlalchemy.text("""WITH
-                                                                playlist_6_songs AS (
-                                                                    SELECT
-                                                                    song_id
-                                                                    FROM
-                                                                    song_playlist
-                                                                    JOIN user_playlist AS up ON up.playlist_id = song_playlist.playlist_id
-                                                                    JOIN users AS u ON u.user_id = up.user_id
-                                                                    WHERE
-                                                                    up.playlist_name = :playlist_name
-                                                                ),
-                                                                matching_playlists AS (
-                                                                    SELECT
-                                                                    sp.playlist_id
-                                                                    FROM
-                                                                    song_playlist AS sp
-                                                                    JOIN user_playlist AS up ON up.playlist_id = sp.playlist_id
-                                                                    JOIN users AS u ON u.user_id = up.user_id
-                                                                    WHERE
-                                                                    song_id IN (
-                                                                        SELECT
-                                                                        song_id
-                                                                        FROM
-                                                                        playlist_6_songs
-                                                                    )
-                                                                    AND up.playlist_name != :playlist_name
-                                                                    GROUP BY
-                                                                    sp.playlist_id
-                                                                    HAVING
-                                                                    COUNT(DISTINCT song_id) >= 3
-                                                                )
-                                                                SELECT DISTINCT
-                                                                sp.song_id,
-                                                                s.song_name,
-                                                                al.album_name,
-                                                                art.artist_name
-                                                                FROM
-                                                                song_playlist AS sp
-                                                                JOIN song AS s ON s.song_id = sp.song_id
-                                                                JOIN album AS al ON s.album_id = al.id
-                                                                JOIN artist AS art ON s.artist_id = art.id
-                                                                WHERE
-                                                                playlist_id IN (
-                                                                    SELECT
-                                                                    playlist_id
-                                                                    FROM
-                                                                    matching_playlists
-                                                                )
-                                                                AND sp.song_id NOT IN (
-                                                                    SELECT
-                                                                    song_id
-                                                                    FROM
-                                                                    playlist_6_songs
-                                                                )
-                                                                LIMIT
-                                                                5
-                                                                """),
-                            [{"playlist_name": playlist_name}])
-            
+        with replicas.read() as connection:
+            missing, recc_songs = queries.fetch(connection, queries.PLAYLIST_RECOMMEND,
+                                                {"playlist_name": playlist_name, "limit": limit})
+            if missing is not None:
+                return missing
+
             for songs in recc_songs:
                 ret.append({
                     "song_id": songs.song_id,
@@ -587,32 +691,38 @@ def recommend_new_songs(playlist_name: str):
         raise HTTPException(status_code=500, detail=str(e))
     return ret
 
+@router.post("/users/{username}/recommend")
+def recommend_for_user(username: str, limit: int = 10, approximate: bool = False):
+    """Songs the user hasn't played whose embeddings are closest to theirs"""
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    if not embeddings.recommender.ready:
+        raise HTTPException(status_code=503, detail="Recommendations are loading, try again later",
+                            headers={"Retry-After": "30"})
+    with replicas.read(username) as connection:
+        user_id = resolver.user_id(connection, username)
+        if user_id is None:
+            return "User does not exist!"
+        found = embeddings.recommender.candidates(user_id, limit, approximate)
+        if found is None:
+            return "Not enough listening history to recommend songs yet"
+        song_ids, scores = found
+        result = connection.execute(embeddings.RECOMMEND, {"song_ids": song_ids, "scores": scores,
+                                                           "user_id": user_id, "limit": limit})
+        return [{"song_name": row.song_name, "artist_name": row.artist_name, "score": round(row.score, 4)}
+                for row in result]
+
 @router.post("/remove_song_from_playlist/")
 def remove_song_from_playlist(song_name: str, playlist_name: str):
     """Remove song from user playlist"""
 
     with db.engine.begin() as connection:
-
-        song_id = connection.execute(sqlalchemy.text("SELECT song_id FROM song JOIN artist ON artist.id = song.artist_id WHERE song_name = :name"),
-                            [{"name": song_name}]).scalar()
-        if song_id is None:
-            return "Song doesn't exist"
-        
-        playlist_id = connection.execute(sqlalchemy.text("SELECT playlist_id FROM user_playlist WHERE playlist_name = :name"), 
-                            [{"name": playlist_name}]).scalar()
-
-        if playlist_id is None:
-            return "Playlist doesn't exist"
-
-        connection.execute(sqlalchemy.text(
-            """
-                DELETE FROM song_playlist
-                USING user_playlist, song
-                WHERE song_playlist.playlist_id = user_playlist.playlist_id
-                AND song_playlist.song_id = song.song_id
-                AND user_playlist.playlist_name = :playlistName
-                AND song.song_name = :songName
-            """),
-            [{"songName": song_name, "playlistName" : playlist_name }])
-        
+        song_exists, playlist_exists = connection.execute(REMOVE_SONG_FROM_PLAYLIST,
+                                                          {"song_name": song_name, "playlist_name": playlist_name}).one()
+    if not song_exists:
+        return "Song doesn't exist"
+    if not playlist_exists:
+        return "Playlist doesn't exist"
+
+    response_cache.invalidate(f"playlist:{playlist_name}")
     return "SUCCESS"
@@ -0,0 +1,500 @@
+"""async def versions of the musicmain handlers on the asyncpg engine.
+
+server.py mounts this router ahead of musicmain.router when DB_BACKEND=async,
+so these routes take precedence and every other path falls through to the
+sync handlers. Handlers keep the sync names, responses and messages so
+clients and the per-route metrics can't tell the backends apart.
+
+Only three routes fall through: /catalog/import/ and /songs/recommend_songs/
+are already async def, and /export/{table} returns as soon as it has started
+a thread that streams COPY through psycopg2, which asyncpg has no drop-in for.
+"""
+from fastapi import APIRouter, Depends, HTTPException
+from starlette.concurrency import run_in_threadpool
+import sqlalchemy
+from src.api import auth
+from src.api import musicmain
+from src.api.musicmain import Album, Play, SongIds, User, Artist
+from src import admission
+from src import database as db
+from src import catalog_import
+from src.catalog_snapshot import catalog
+from src import embeddings
+from src import genre_recommender
+from src import pagination
+from src import playlists
+from src import queries
+from src import response_cache
+from src import rollups
+from src import search
+from src.replicas import replicas
+from src.resolver import resolver
+from src import stream_ingest
+
+
+router = APIRouter(
+    prefix="/musicmain",
+    tags=["musicmain"],
+    dependencies=[Depends(auth.get_api_key)],
+)
+
+@router.post("/add_user/")
+async def add_user(username: str):
+    """Add user to users table"""
+    async with db.async_engine.begin() as connection:
+        user_id = await resolver.user_id_async(connection, username)
+        if user_id is not None:
+            return "User already exists!"
+        await connection.execute(sqlalchemy.text("INSERT INTO users (username) VALUES (:userName)"),
+                                 {"userName": username})
+    resolver.forget_user(username)
+
+    return f"User: {username} added!"
+
+@router.post("/create_artist")
+async def create_artist(artist_name: str):
+    """ Create new artist  """
+    async with db.async_engine.begin() as connection:
+        if await resolver.artist_id_async(connection, artist_name) is not None:
+            return "Artist Creation Error: Artist already exists"
+        artist_id = (await connection.execute(
+            sqlalchemy.text("INSERT INTO artist (artist_name) VALUES (:name) RETURNING id"),
+            {"name": artist_name})).scalar()
+    resolver.forget_artist(artist_name)
+    await run_in_threadpool(catalog.refresh)
+    await run_in_threadpool(search.search_index.refresh)
+    response_cache.invalidate(f"artist:{artist_name}")
+    return {"Artist created! artist id": artist_id}
+
+@router.post("/upload_music/")
+async def upload_new_music(new_album_catalog: Album):
+    """Upload a new album including songs and metadata"""
+    async with db.async_engine.begin() as connection:
+        album_check = await resolver.album_id_async(connection, new_album_catalog.album_name)
+        artistId = await resolver.artist_id_async(connection, new_album_catalog.artist_name)
+        if album_check is not None:
+            return "Upload Error: Album already exists"
+        await connection.run_sync(catalog_import.insert_album, new_album_catalog, artistId)
+    resolver.forget_album(new_album_catalog.album_name)
+    for song in new_album_catalog.song_list:
+        resolver.forget_song(song.song_name, new_album_catalog.artist_name)
+    await run_in_threadpool(catalog.refresh)
+    await run_in_threadpool(search.search_index.refresh)
+    response_cache.invalidate(f"artist:{new_album_catalog.artist_name}", f"album:{new_album_catalog.album_name}")
+    return f"Album: {new_album_catalog.album_name} uploaded!"
+
+@router.get("/admission/metrics/")
+async def admission_metrics():
+    """Admitted, rate-limited, shed and in-flight requests per API key, and in-flight requests per route"""
+    return admission.metrics()
+
+@router.get("/resolver/metrics/")
+async def resolver_metrics():
+    """Hit, miss and eviction counts for the name-to-ID caches"""
+    return resolver.metrics()
+
+@router.post("/search_for_song/")
+@response_cache.cached("artist:{artist_name}")
+async def search_for_song(song_name: str, artist_name: str):
+    """Search for a song by name and artist"""
+    if catalog.ready:
+        if catalog.song_id(song_name, artist_name) is None:
+            return f"Song: {song_name} does not exist by the Artist: {artist_name}"
+        return f"Song: {song_name} by {artist_name} exists!"
+    async with replicas.read_async() as connection:
+        if await resolver.song_id_async(connection, song_name, artist_name) is None:
+            return f"Song: {song_name} does not exist by the Artist: {artist_name}"
+    return f"Song: {song_name} by {artist_name} exists!"
+
+@router.post("/search_for_artist/")
+@response_cache.cached("artist:{artist_name}")
+async def search_for_artist(artist_name: str):
+    """Search for an artist by name"""
+    if catalog.ready:
+        if catalog.artist_id(artist_name) is None:
+            return f"Artist: {artist_name} does not exist"
+        return f"Artist: {artist_name} exists!"
+    async with replicas.read_async() as connection:
+        if await resolver.artist_id_async(connection, artist_name) is None:
+            return f"Artist: {artist_name} does not exist"
+    return f"Artist: {artist_name} exists!"
+
+@router.post("/search_for_album/")
+@response_cache.cached("album:{album_name}")
+async def search_for_album(album_name: str):
+    """Search for an album by name"""
+    if catalog.ready:
+        if catalog.album_id(album_name) is None:
+            return f"Album: {album_name} does not exist"
+        return f"Album: {album_name} exists!"
+    async with replicas.read_async() as connection:
+        if await resolver.album_id_async(connection, album_name) is None:
+            return f"Album: {album_name} does not exist"
+    return f"Album: {album_name} exists!"
+
+@router.post("/search/")
+async def search_catalog(q: str, types: str = "song,artist,album", cursor: str = None,
+                         limit: int = search.DEFAULT_PAGE_SIZE):
+    """Ranked prefix and typo-tolerant search across songs, artists and albums, a page at a time"""
+    # The in-process index is CPU-bound and the pg_trgm backend uses the sync replica engines.
+    return await run_in_threadpool(search.search_index.page, replicas.read, q, types.split(","), cursor, limit)
+
+@router.post("/artist_albums/")
+@response_cache.cached("artist:{artist_name}")
+async def artist_albums(artist_name: str, cursor: str = None, limit: int = pagination.DEFAULT_PAGE_SIZE,
+                        stream: bool = False):
+    """Get all albums by an artist, a page at a time"""
+    if catalog.ready and not stream:
+        page = catalog.artist_albums(artist_name, cursor, limit)
+        return "Artist does not exist!" if page is None else page
+    async with replicas.read_async() as connection:
+        return await queries.listing_async(connection, queries.ARTIST_ALBUMS,
+                                           {"artist_name": artist_name}, ["after_id"], lambda row: [row.id],
+                                           lambda row: {"album_id": row.id, "album_name": row.album_name},
+                                           cursor, limit, stream)
+
+@router.post("/album_songs/")
+@response_cache.cached("album:{album_name}")
+async def album_songs(album_name: str, cursor: str = None, limit: int = pagination.DEFAULT_PAGE_SIZE,
+                      stream: bool = False):
+    """Get all songs in an album, a page at a time"""
+    if catalog.ready and not stream:
+        page = catalog.album_songs(album_name, cursor, limit)
+        return "Album does not exist!" if page is None else page
+    async with replicas.read_async() as connection:
+        return await queries.listing_async(connection, queries.ALBUM_SONGS,
+                                           {"album_name": album_name}, ["after_id"], lambda row: [row.song_id],
+                                           lambda row: {"song_id": row.song_id, "song_name": row.song_name},
+                                           cursor, limit, stream)
+
+@router.post("/song_info/")
+@response_cache.cached("artist:{artist_name}")
+async def song_info(song_name: str, artist_name: str):
+    """Get all info for a song"""
+    if catalog.ready:
+        output = catalog.song_info(song_name, artist_name)
+        return "Song does not exist by this Artist!" if output is None else output
+    async with replicas.read_async() as connection:
+        missing, result = await queries.fetch_async(connection, queries.SONG_INFO,
+                                                    {"song_name": song_name, "artist_name": artist_name})
+    if missing is not None:
+        return missing
+    return [{"Name": row.song_name, "Featured Artist": row.featured_artist, "Explicit Rating": row.explicit_rating,
+             "Length": row.length}
+            for row in result]
+
+@router.post("/album_info/")
+@response_cache.cached("album:{album_name}")
+async def album_info(album_name: str):
+    """Get all info for an album"""
+    if catalog.ready:
+        output = catalog.album_info(album_name)
+        return "Album does not exist!" if output is None else output
+    async with replicas.read_async() as connection:
+        missing, result = await queries.fetch_async(connection, queries.ALBUM_INFO, {"album_name": album_name})
+    if missing is not None:
+        return missing
+    return [{"Artist": row.artist_name, "Album Name": row.album_name, "Genre": row.genre,
+             "Explicit Rating": row.explicit_rating, "Label": row.label, "Release Date": row.release_date}
+            for row in result]
+
+@router.post("/log_streams/")
+async def log_streams(song_name: str, artist_name: str, username: str):
+    """   Take in a song that is logged by a user, and put it in the stream table"""
+    async with db.async_engine.begin() as connection:
+        user_id = await resolver.user_id_async(connection, username)
+        if user_id is None:
+            return "User does not exist!"
+        song_id = await resolver.song_id_async(connection, song_name, artist_name)
+        if song_id is None:
+            return "Song does not exist by this Artist!"
+
+        if not stream_ingest.BUFFERED:
+            await connection.execute(stream_ingest.INSERT_STREAMS,
+                                     stream_ingest.insert_params([(user_id, song_id, stream_ingest.now())]))
+
+    # put() can block for up to STREAM_PUT_TIMEOUT, so keep it off the event loop.
+    if stream_ingest.BUFFERED and await run_in_threadpool(
+            stream_ingest.buffer.put, [(user_id, song_id, stream_ingest.now())]) == 0:
+        raise HTTPException(status_code=503, detail="Stream buffer is full, try again later",
+                            headers={"Retry-After": "1"})
+    replicas.wrote(username)
+    return "Song streamed!"
+
+@router.post("/log_streams/bulk/")
+async def log_streams_bulk(plays: list[Play]):
+    """Log many plays in one request, resolving names and inserting them set-based"""
+    if len(plays) > stream_ingest.BULK_MAX_PLAYS:
+        raise HTTPException(status_code=413, detail=f"At most {stream_ingest.BULK_MAX_PLAYS} plays per request")
+
+    stamp = stream_ingest.now()
+    async with db.async_engine.begin() as connection:
+        resolved = await connection.run_sync(stream_ingest.resolve_plays,
+                                             [(play.username, play.song_name, play.artist_name) for play in plays])
+        batch = [(user_id, song_id, stamp) for user_id, song_id in resolved if user_id is not None and song_id is not None]
+        unresolved = [i for i, (user_id, song_id) in enumerate(resolved) if user_id is None or song_id is None]
+        if not stream_ingest.BUFFERED and batch:
+            await connection.execute(stream_ingest.INSERT_STREAMS, stream_ingest.insert_params(batch))
+
+    accepted = await run_in_threadpool(stream_ingest.buffer.put, batch) if stream_ingest.BUFFERED else len(batch)
+    if accepted:
+        replicas.wrote(*{play.username for play, (user_id, song_id) in zip(plays, resolved)
+                         if user_id is not None and song_id is not None})
+    return {"logged": accepted, "unresolved": unresolved, "dropped": len(batch) - accepted}
+
+@router.get("/log_streams/metrics/")
+async def log_streams_metrics():
+    """Queue depth, batch sizes, flush latency and backpressure counters for stream ingestion"""
+    return stream_ingest.buffer.metrics()
+
+@router.post("/get_total_streams/")
+async def get_streams(username: str, cursor: str = None, limit: int = pagination.DEFAULT_PAGE_SIZE,
+                      stream: bool = False, include_archived: bool = False):
+    """Lists songs streamed by user, most recent first, a page at a time, optionally with archived plays"""
+    if include_archived:
+        # Archive files are read with numpy, which blocks.
+        return await run_in_threadpool(musicmain.get_streams, username, cursor, limit, stream, include_archived)
+    async with replicas.read_async(username) as connection:
+        return await queries.listing_async(connection, queries.USER_STREAMS,
+                                           {"username": username}, ["after_id"], lambda row: [row.stream_id],
+                                           musicmain.stream_item, cursor, limit, stream)
+
+@router.post("/get_stream_by_artist/")
+async def streams_by_artist(user: User, artist: Artist, cursor: str = None,
+                            limit: int = pagination.DEFAULT_PAGE_SIZE, stream: bool = False):
+    """Get all streams for one artist by one user, most recent first, a page at a time"""
+    async with replicas.read_async(user.username) as connection:
+        return await queries.listing_async(connection, queries.USER_ARTIST_STREAMS,
+                                           {"username": user.username, "artist_name": artist.artist_name},
+                                           ["after_id"], lambda row: [row.stream_id],
+                                           lambda row: {"stream_id": row.stream_id, "played_at": row.created_at,
+                                                        "song_name": row.song_name},
+                                           cursor, limit, stream)
+
+@router.post("/users/top_artists/")
+async def user_top_artists(username: str, limit: int = 10):
+    """A user's most played artists with first and last play, from the per-user rollup"""
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    async with replicas.read_async(username) as connection:
+        missing, result = await queries.fetch_async(connection, queries.USER_TOP_ARTISTS,
+                                                    {"username": username, "limit": limit})
+    if missing is not None:
+        return missing
+    return [{"artist_name": row.artist_name, "plays": row.play_count, "first_played_at": row.first_played_at,
+             "last_played_at": row.last_played_at}
+            for row in result]
+
+@router.post("/users/top_songs/")
+async def user_top_songs(username: str, limit: int = 10):
+    """A user's most played songs with first and last play, from the per-user rollup"""
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    async with replicas.read_async(username) as connection:
+        missing, result = await queries.fetch_async(connection, queries.USER_TOP_SONGS,
+                                                    {"username": username, "limit": limit})
+    if missing is not None:
+        return missing
+    return [{"song_name": row.song_name, "artist_name": row.artist_name, "plays": row.play_count,
+             "first_played_at": row.first_played_at, "last_played_at": row.last_played_at}
+            for row in result]
+
+@router.post("/users/artist_plays/")
+async def user_artist_plays(username: str, artist_name: str):
+    """How often a user has played an artist, and when first and last"""
+    async with replicas.read_async(username) as connection:
+        missing, result = await queries.fetch_async(connection, queries.USER_ARTIST_PLAYS,
+                                                    {"username": username, "artist_name": artist_name})
+    if missing is not None:
+        return missing
+    row = result[0]
+    return {"artist_name": artist_name, "plays": row.play_count, "first_played_at": row.first_played_at,
+            "last_played_at": row.last_played_at}
+
+@router.post("/create_playlist/")
+async def create_playlist(playlist_name: str, username: str):
+    """Create a new playlist for a user"""
+    async with db.async_engine.begin() as connection:
+        taken, user_ids = (await connection.execute(musicmain.CREATE_PLAYLIST,
+                                                    {"playlist_name": playlist_name, "username": username})).one()
+    if taken:
+        return "playlist name already exists for that user"
+    for user_id in user_ids:
+        resolver.forget_playlist(user_id, playlist_name)
+    if user_ids:
+        replicas.wrote(username)
+    response_cache.invalidate(f"playlist:{playlist_name}")
+    return f"Playlist: {playlist_name} Created!"
+
+@router.post("/add_song_to_playlist/")
+async def add_songs_to_playlist(song_name: str, album: str, playlist_name: str, username: str):
+    """Add a song to a playlist for a user"""
+    async with db.async_engine.begin() as connection:
+        user_id = await resolver.user_id_async(connection, username)
+        if user_id is None:
+            return "User doesn't exist"
+        album_id = await resolver.album_id_async(connection, album)
+        if album_id is None:
+            return "Album doesn't exist"
+        playlist_id = await resolver.playlist_id_async(connection, user_id, playlist_name)
+        if playlist_id is None:
+            return "Playlist doesn't exist"
+        song_exists = (await connection.execute(musicmain.ADD_SONG_TO_PLAYLIST,
+                                                {"user_id": user_id, "playlist_id": playlist_id,
+                                                 "album_id": album_id, "song_name": song_name})).scalar()
+        if not song_exists:
+            return "Song Addition Error: Song does not exist"
+    replicas.wrote(username)
+    response_cache.invalidate(f"playlist:{playlist_name}")
+    return f"Song: {song_name} Added to Playlist: {playlist_name}"
+
+async def _apply_batch(mutation, playlist_id, song_ids):
+    async with db.async_engine.begin() as connection:
+        change = await connection.run_sync(mutation, playlist_id, song_ids)
+    if change is None:
+        return None
+    if change.username is not None:
+        replicas.wrote(change.username)
+    if change.song_ids:
+        response_cache.invalidate(f"playlist:{change.playlist_name}")
+    return change
+
+@router.post("/playlist/{playlist_id}/songs/add")
+async def add_songs_batch(playlist_id: int, body: SongIds):
+    """Append songs to a playlist in the given order, skipping ones already in it"""
+    change = await _apply_batch(playlists.add_songs, playlist_id, playlists.check_batch(body.song_ids))
+    if change is None:
+        return "Playlist doesn't exist"
+    return {"added": change.song_ids}
+
+@router.post("/playlist/{playlist_id}/songs/remove")
+async def remove_songs_batch(playlist_id: int, body: SongIds):
+    """Remove songs from a playlist"""
+    change = await _apply_batch(playlists.remove_songs, playlist_id, playlists.check_batch(body.song_ids))
+    if change is None:
+        return "Playlist doesn't exist"
+    return {"removed": change.song_ids}
+
+@router.post("/playlist/{playlist_id}/songs/reorder")
+async def reorder_songs_batch(playlist_id: int, body: SongIds):
+    """Move songs to the front of a playlist in the given order, keeping the rest behind them"""
+    change = await _apply_batch(playlists.reorder_songs, playlist_id, playlists.check_batch(body.song_ids))
+    if change is None:
+        return "Playlist doesn't exist"
+    return {"moved": len(change.song_ids)}
+
+@router.post("/view_playlist/")
+async def view_playlist(playlist_name: str, username: str, cursor: str = None,
+                        limit: int = pagination.DEFAULT_PAGE_SIZE, stream: bool = False):
+    """View the songs in a playlist in playlist order, a page at a time"""
+    async with replicas.read_async(username) as connection:
+        return await queries.listing_async(connection, queries.PLAYLIST_SONGS,
+                                           {"username": username, "playlist_name": playlist_name},
+                                           ["after_position", "after_id"], lambda row: [row.position, row.song_id],
+                                           lambda row: {"song_id": row.song_id, "song_name": row.song_name,
+                                                        "added_at": row.created_at},
+                                           cursor, limit, stream)
+
+@router.post("/songs/submit_rating/")
+async def add_rating_to_song(song: str, user_rating: int):
+    """Submits their rating for a song if it is explicit or not"""
+    async with db.async_engine.begin() as connection:
+        rated = (await connection.execute(musicmain.SUBMIT_RATING, {"thesong": song, "rating": user_rating})).first()
+    if rated is None:
+        return "Song doesn't exist"
+    return "Rating Submitted"
+
+@router.post("/playlist/get_clean_songs/")
+async def get_clean_songs(playlist_name: str, threshold: float = rollups.EXPLICIT_THRESHOLD):
+    """Returns the songs from the playlist whose share of explicit votes is below threshold"""
+    if not 0 < threshold <= 1:
+        raise HTTPException(status_code=400, detail="threshold must be in (0, 1]")
+    async with replicas.read_async() as connection:
+        missing, result = await queries.fetch_async(connection, queries.CLEAN_PLAYLIST_SONGS,
+                                                    {"playlist_name": playlist_name, "threshold": threshold})
+    if missing is not None:
+        return missing
+    return [row.song_name for row in result]
+
+@router.get("/songs/recommend_songs/metrics/")
+async def recommend_song_metrics():
+    """Cache hit ratio, coalesced requests and upstream latency for the genre recommender"""
+    return genre_recommender.recommender.metrics()
+
+@router.post("/top_streams/")
+@response_cache.cached(ttl=response_cache.TOP_STREAMS_TTL)
+async def top_streams():
+    """Gets the top 10 streamed songs from the song_play_counts rollup"""
+    try:
+        async with replicas.read_async() as connection:
+            result = await connection.execute(musicmain.TOP_STREAMS)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return [{'Position': Position, 'Song': Song, 'Artist': Artist, 'Streams': Streams}
+            for Position, Song, Artist, Streams in result]
+
+@router.post("/top_streams/window/")
+async def top_streams_window(hours: int = 24, limit: int = 10):
+    """Gets the top streamed songs over the last `hours` hours from the bucketed play counts"""
+    if not 1 <= hours <= rollups.MAX_WINDOW_HOURS:
+        raise HTTPException(status_code=400, detail=f"hours must be between 1 and {rollups.MAX_WINDOW_HOURS}")
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+
+    async with replicas.read_async() as connection:
+        result = await connection.execute(rollups.TOP_SONGS_IN_WINDOW, {"hours": hours, "limit": limit})
+    return [{'Position': Position, 'Song': Song, 'Artist': Artist, 'Streams': Streams}
+            for Position, Song, Artist, Streams in result]
+
+@router.post("/playlist/recommend")
+@response_cache.cached("playlist:{playlist_name}")
+async def recommend_new_songs(playlist_name: str, limit: int = 5):
+    """Gets the top songs that share the most playlists with the songs in your playlist"""
+    if not 1 <= limit <= 50:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 50")
+    try:
+        async with replicas.read_async() as connection:
+            missing, result = await queries.fetch_async(connection, queries.PLAYLIST_RECOMMEND,
+                                                        {"playlist_name": playlist_name, "limit": limit})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if missing is not None:
+        return missing
+    return [{"song_id": songs.song_id, "song_name": songs.song_name, "album_name": songs.album_name,
+             "artist_name": songs.artist_name}
+            for songs in result]
+
+@router.post("/users/{username}/recommend")
+async def recommend_for_user(username: str, limit: int = 10, approximate: bool = False):
+    """Songs the user hasn't played whose embeddings are closest to theirs"""
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    if not embeddings.recommender.ready:
+        raise HTTPException(status_code=503, detail="Recommendations are loading, try again later",
+                            headers={"Retry-After": "30"})
+    async with replicas.read_async(username) as connection:
+        user_id = await resolver.user_id_async(connection, username)
+        if user_id is None:
+            return "User does not exist!"
+        # numpy over the memory-mapped embeddings: keep it off the event loop.
+        found = await run_in_threadpool(embeddings.recommender.candidates, user_id, limit, approximate)
+        if found is None:
+            return "Not enough listening history to recommend songs yet"
+        song_ids, scores = found
+        result = await connection.execute(embeddings.RECOMMEND, {"song_ids": song_ids, "scores": scores,
+                                                                 "user_id": user_id, "limit": limit})
+    return [{"song_name": row.song_name, "artist_name": row.artist_name, "score": round(row.score, 4)}
+            for row in result]
+
+@router.post("/remove_song_from_playlist/")
+async def remove_song_from_playlist(song_name: str, playlist_name: str):
+    """Remove song from user playlist"""
+    async with db.async_engine.begin() as connection:
+        song_exists, playlist_exists = (await connection.execute(
+            musicmain.REMOVE_SONG_FROM_PLAYLIST, {"song_name": song_name, "playlist_name": playlist_name})).one()
+    if not song_exists:
+        return "Song doesn't exist"
+    if not playlist_exists:
+        return "Playlist doesn't exist"
+    response_cache.invalidate(f"playlist:{playlist_name}")
+    return "SUCCESS"
@@ -1,13 +1,24 @@
 from fastapi import FastAPI, exceptions
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import ValidationError
 from src.api import musicmain
+from src.api import musicmain_async
 import json
 import logging
 import sys
 from starlette.middleware.cors import CORSMiddleware
 import sqlalchemy
+from src import admission
 from src import database as db
+from src import catalog_snapshot
+from src import embeddings
+from src import genre_recommender
+from src import metrics
+from src import response_cache
+from src import search
+from src import stream_ingest
+from src.replicas import replicas
+from src.resolver import resolver
 
 description = """
 Shit boy this the spot for your new music discovery
@@ -32,8 +43,29 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.instrument(db.engine)
+for engine in db.replica_engines:
+    metrics.instrument(engine)
+if db.async_engine is not None:
+    for engine in [db.async_engine, *db.async_replica_engines]:
+        metrics.instrument(engine.sync_engine)
+metrics.register("admission", admission.metrics)
+metrics.register("stream_ingest", stream_ingest.buffer.metrics)
+metrics.register("resolver", resolver.metrics)
+metrics.register("replicas", replicas.metrics)
+metrics.register("catalog_snapshot", catalog_snapshot.catalog.metrics)
+metrics.register("search", search.search_index.metrics)
+metrics.register("response_cache", response_cache.response_cache.metrics)
+metrics.register("genre_recommender", genre_recommender.recommender.metrics)
+metrics.register("embeddings", embeddings.recommender.metrics)
+
+if db.BACKEND == "async":
+    # Registered first so its routes win; anything it doesn't cover falls through to the sync router.
+    app.include_router(musicmain_async.router)
 app.include_router(musicmain.router)
 
 
@@ -48,6 +80,61 @@ async def validation_exception_handler(request, exc):
 
     return JSONResponse(response, status_code=422)
 
+@app.on_event("startup")
+def watch_replicas():
+    replicas.start()
+
+@app.on_event("shutdown")
+def stop_replica_checks():
+    replicas.stop()
+
+@app.on_event("startup")
+def load_catalog_snapshot():
+    if catalog_snapshot.ENABLED:
+        catalog_snapshot.catalog.start()
+
+@app.on_event("shutdown")
+def stop_catalog_snapshot():
+    catalog_snapshot.catalog.stop()
+
+@app.on_event("startup")
+def load_search_index():
+    search.search_index.start()
+
+@app.on_event("shutdown")
+def stop_search_index():
+    search.search_index.stop()
+
+@app.on_event("startup")
+def load_embeddings():
+    embeddings.recommender.start()
+
+@app.on_event("shutdown")
+def stop_embeddings():
+    embeddings.recommender.stop()
+
+@app.on_event("shutdown")
+def flush_stream_buffer():
+    stream_ingest.buffer.stop()
+
+@app.on_event("shutdown")
+async def close_recommender_client():
+    await genre_recommender.recommender.close()
+
+@app.on_event("shutdown")
+async def dispose_async_engine():
+    if db.async_engine is not None:
+        for engine in [db.async_engine, *db.async_replica_engines]:
+            await engine.dispose()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return metrics.render()
+
+@app.get("/metrics/slow_queries")
+def slow_query_samples():
+    return list(metrics.slow_queries)
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to dBDb your home for music."}
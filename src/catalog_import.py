@@ -0,0 +1,290 @@
+"""Set-based album inserts and bulk catalog import.
+
+A catalog file is either JSONL, one album per line shaped like the
+/upload_music/ body (the discography scraper's output), or CSV with one song
+per row and the columns
+
+    artist_name, album_name, genre, album_explicit_rating, label,
+    release_date, song_name, featured_artist, explicit_rating, length
+
+Rows are read as a stream and loaded IMPORT_BATCH_ROWS songs per transaction:
+artists are created and resolved in bulk, new albums are inserted in one
+statement and their songs go in with COPY when the driver supports it. As
+with /upload_music/, albums whose name already exists are skipped. An
+album's songs may run over into the next batch but must otherwise be
+contiguous, as both formats write them: only the previous batch's albums
+are remembered. The catalog snapshot, search index and response cache are
+refreshed every IMPORT_REFRESH_BATCHES batches and when the import ends.
+
+    python -m src.catalog_import discography.jsonl
+    python -m src.catalog_import catalog.csv --format csv
+"""
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+import dotenv
+import sqlalchemy
+from fastapi.concurrency import run_in_threadpool
+
+from src import database as db
+from src import response_cache
+from src.catalog_snapshot import catalog
+from src.search import search_index
+from src.resolver import resolver
+
+dotenv.load_dotenv()
+
+BATCH_ROWS = int(os.environ.get("IMPORT_BATCH_ROWS", "5000"))
+REFRESH_BATCHES = int(os.environ.get("IMPORT_REFRESH_BATCHES", "10"))
+SPOOL_BYTES = 8 * 1024 * 1024
+
+SONG_COLUMNS = ("song_name", "artist_id", "featured_artist", "explicit_rating", "length", "album_id")
+
+INSERT_ALBUM_WITH_SONGS = sqlalchemy.text("""
+    WITH new_album AS (
+        INSERT INTO album (album_name, artist_id, genre, explicit_rating, label, release_date)
+        VALUES (:album_name, :artist_id, :genre, :xprat, :label, :release_date)
+        RETURNING id
+    )
+    INSERT INTO song (song_name, artist_id, featured_artist, explicit_rating, length, album_id)
+    SELECT s.song_name, :artist_id, s.featured_artist, s.explicit_rating, s.length, new_album.id
+    FROM unnest(CAST(:song_names AS text[]),
+                CAST(:featured_artists AS text[]),
+                CAST(:explicit_ratings AS integer[]),
+                CAST(:lengths AS integer[])) AS s(song_name, featured_artist, explicit_rating, length)
+    CROSS JOIN new_album
+    """)
+
+INSERT_ARTISTS = sqlalchemy.text("""
+    INSERT INTO artist (artist_name)
+    SELECT name FROM unnest(CAST(:names AS text[])) AS name
+    WHERE NOT EXISTS (SELECT 1 FROM artist WHERE artist_name = name)
+    """)
+
+ARTIST_IDS = sqlalchemy.text("""
+    SELECT artist_name, MIN(id) FROM artist
+    WHERE artist_name = ANY(CAST(:names AS text[]))
+    GROUP BY artist_name
+    """)
+
+INSERT_ALBUMS = sqlalchemy.text("""
+    INSERT INTO album (album_name, artist_id, genre, explicit_rating, label, release_date)
+    SELECT a.album_name, a.artist_id, a.genre, a.explicit_rating, a.label, a.release_date
+    FROM unnest(CAST(:album_names AS text[]),
+                CAST(:artist_ids AS integer[]),
+                CAST(:genres AS text[]),
+                CAST(:explicit_ratings AS integer[]),
+                CAST(:labels AS text[]),
+                CAST(:release_dates AS date[])) AS a(album_name, artist_id, genre, explicit_rating, label, release_date)
+    WHERE NOT EXISTS (SELECT 1 FROM album WHERE album.album_name = a.album_name)
+    RETURNING id, album_name
+    """)
+
+INSERT_SONGS = sqlalchemy.text("""
+    INSERT INTO song (song_name, artist_id, featured_artist, explicit_rating, length, album_id)
+    SELECT * FROM unnest(CAST(:song_names AS text[]),
+                         CAST(:artist_ids AS integer[]),
+                         CAST(:featured_artists AS text[]),
+                         CAST(:explicit_ratings AS integer[]),
+                         CAST(:lengths AS integer[]),
+                         CAST(:album_ids AS integer[]))
+    """)
+
+
+def _int(value):
+    """Ratings and lengths arrive as ints, floats, bools or strings depending on the source.
+
+    Fractions round half away from zero, as Postgres does when it casts them into an integer column.
+    """
+    if value is None or value == "":
+        return None
+    number = float(value)
+    return int(math.copysign(math.floor(abs(number) + 0.5), number))
+
+
+def insert_album(connection, album, artist_id):
+    """Insert an album and all of its songs in one statement. Returns the number of songs."""
+    connection.execute(INSERT_ALBUM_WITH_SONGS, {
+        "album_name": album.album_name, "artist_id": artist_id, "genre": album.genre,
+        "xprat": album.explicit_rating, "label": album.label, "release_date": album.release_date,
+        "song_names": [song.song_name for song in album.song_list],
+        "featured_artists": [song.featured_artist for song in album.song_list],
+        "explicit_ratings": [_int(song.explicit_rating) for song in album.song_list],
+        "lengths": [song.length for song in album.song_list],
+    })
+    return len(album.song_list)
+
+
+def read_rows(file, fmt):
+    """Yield one flat dict per song from a JSONL or CSV catalog without reading it all into memory."""
+    if fmt == "csv":
+        yield from csv.DictReader(file)
+        return
+    for line in file:
+        if not line.strip():
+            continue
+        album = json.loads(line)
+        for song in album.get("song_list", []):
+            yield {
+                "artist_name": album["artist_name"],
+                "album_name": album["album_name"],
+                "genre": album.get("genre"),
+                "album_explicit_rating": album.get("explicit_rating"),
+                "label": album.get("label"),
+                "release_date": album.get("release_date"),
+                "song_name": song["song_name"],
+                "featured_artist": song.get("featured_artist"),
+                "explicit_rating": song.get("explicit_rating"),
+                "length": song.get("length"),
+            }
+
+
+def _copy_songs(connection, songs):
+    """COPY songs in over the driver connection. Returns False when the driver has no COPY support."""
+    cursor = connection.connection.cursor()
+    try:
+        if not hasattr(cursor, "copy_expert"):
+            return False
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(songs)
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY song ({', '.join(SONG_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+        return True
+    finally:
+        cursor.close()
+
+
+class CatalogLoader:
+    """Loads song rows in batches, remembering the last batch's new albums so the next batch can extend them."""
+
+    def __init__(self, batch_rows=BATCH_ROWS, refresh_batches=REFRESH_BATCHES):
+        self.batch_rows = batch_rows
+        self.refresh_batches = max(1, refresh_batches)
+        self.created_albums = {}
+        self.stale_tags = set()
+        self.stats = {"rows": 0, "songs": 0, "albums": 0, "skipped_rows": 0, "batches": 0}
+        self._started = time.perf_counter()
+
+    def load(self, rows):
+        batch = []
+        try:
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= self.batch_rows:
+                    self._load_batch(batch)
+                    batch = []
+            if batch:
+                self._load_batch(batch)
+        finally:
+            self.refresh()
+        return self.report()
+
+    def refresh(self):
+        """Show the batches loaded so far in the catalog snapshot, search index and response cache."""
+        if not self.stale_tags:
+            return
+        catalog.refresh()
+        search_index.refresh()
+        response_cache.invalidate(*self.stale_tags)
+        self.stale_tags.clear()
+
+    def _load_batch(self, rows):
+        artist_names = sorted({row["artist_name"] for row in rows})
+        with db.engine.begin() as connection:
+            connection.execute(INSERT_ARTISTS, {"names": artist_names})
+            artist_ids = dict(connection.execute(ARTIST_IDS, {"names": artist_names}).all())
+
+            album_names = {row["album_name"] for row in rows}
+            created = {name: album_id for name, album_id in self.created_albums.items() if name in album_names}
+            new_albums = {}
+            for row in rows:
+                if row["album_name"] not in created:
+                    new_albums.setdefault(row["album_name"], row)
+            if new_albums:
+                albums = list(new_albums.values())
+                inserted = connection.execute(INSERT_ALBUMS, {
+                    "album_names": [a["album_name"] for a in albums],
+                    "artist_ids": [artist_ids[a["artist_name"]] for a in albums],
+                    "genres": [a["genre"] for a in albums],
+                    "explicit_ratings": [_int(a["album_explicit_rating"]) for a in albums],
+                    "labels": [a["label"] for a in albums],
+                    "release_dates": [a["release_date"] or None for a in albums],
+                })
+                for album_id, album_name in inserted:
+                    created[album_name] = album_id
+                    self.stats["albums"] += 1
+
+            songs = []
+            for row in rows:
+                album_id = created.get(row["album_name"])
+                if album_id is None:
+                    self.stats["skipped_rows"] += 1
+                    continue
+                songs.append((row["song_name"], artist_ids[row["artist_name"]], row["featured_artist"],
+                              _int(row["explicit_rating"]), _int(row["length"]), album_id))
+            if songs and not _copy_songs(connection, songs):
+                song_names, song_artists, featured, ratings, lengths, album_ids = (list(c) for c in zip(*songs))
+                connection.execute(INSERT_SONGS, {
+                    "song_names": song_names, "artist_ids": song_artists, "featured_artists": featured,
+                    "explicit_ratings": ratings, "lengths": lengths, "album_ids": album_ids})
+
+        self.created_albums = created
+        for name in artist_names:
+            resolver.forget_artist(name)
+        for album_name in album_names:
+            resolver.forget_album(album_name)
+        for row in rows:
+            resolver.forget_song(row["song_name"], row["artist_name"])
+        self.stale_tags.update(f"artist:{name}" for name in artist_names)
+        self.stale_tags.update(f"album:{album_name}" for album_name in album_names)
+        self.stats["rows"] += len(rows)
+        self.stats["songs"] += len(songs)
+        self.stats["batches"] += 1
+        if self.stats["batches"] % self.refresh_batches == 0:
+            self.refresh()
+
+    def report(self):
+        elapsed = time.perf_counter() - self._started
+        return {**self.stats, "seconds": round(elapsed, 3),
+                "rows_per_second": round(self.stats["rows"] / elapsed, 1) if elapsed else 0.0}
+
+
+def import_file(file, fmt="jsonl", batch_rows=BATCH_ROWS):
+    """Import an open text-mode catalog file."""
+    return CatalogLoader(batch_rows).load(read_rows(file, fmt))
+
+
+async def import_body(chunks, fmt="jsonl", batch_rows=BATCH_ROWS):
+    """Import a catalog arriving as an async stream of bytes, spooling it to disk past SPOOL_BYTES."""
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as spool:
+        async for chunk in chunks:
+            spool.write(chunk)
+        spool.seek(0)
+        text = io.TextIOWrapper(spool, encoding="utf-8", newline="")
+        return await run_in_threadpool(import_file, text, fmt, batch_rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.catalog_import", description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default=None, help="defaults to the file extension")
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="songs per transaction")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "jsonl")
+    with open(args.path, newline="", encoding="utf-8") as file:
+        report = import_file(file, fmt, args.batch_rows)
+    for name, value in report.items():
+        print(f"{name}: {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
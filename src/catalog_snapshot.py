@@ -0,0 +1,359 @@
+"""In-process snapshot of the artist, album and song tables.
+
+With CATALOG_SNAPSHOT=1 the server loads the whole catalog at startup into
+__slots__ records indexed by ID and by name, and the catalog routes
+(search_for_*, song_info, album_info, artist_albums, album_songs) answer from
+it without touching the database. Until the first load finishes they keep
+using SQL.
+
+A background thread pulls rows created since the last refresh every
+CATALOG_REFRESH_INTERVAL seconds, re-reading a CATALOG_REFRESH_OVERLAP window
+so rows from transactions that committed late aren't missed, and rebuilds the
+snapshot from scratch every CATALOG_FULL_RELOAD seconds to pick up edits and
+deletes. Handlers that create artists or albums call refresh() after they
+commit so their own writes are visible immediately.
+
+    python -m src.catalog_snapshot stats
+"""
+import argparse
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from datetime import timedelta
+
+import dotenv
+import sqlalchemy
+
+from src import database as db
+from src import pagination
+
+dotenv.load_dotenv()
+
+ENABLED = os.environ.get("CATALOG_SNAPSHOT", "0") == "1"
+REFRESH_INTERVAL = float(os.environ.get("CATALOG_REFRESH_INTERVAL", "5"))
+REFRESH_OVERLAP = timedelta(seconds=float(os.environ.get("CATALOG_REFRESH_OVERLAP", "60")))
+FULL_RELOAD = float(os.environ.get("CATALOG_FULL_RELOAD", "3600"))
+
+ARTISTS = sqlalchemy.text("""
+    SELECT id, artist_name, created_at FROM artist
+    WHERE CAST(:since AS timestamptz) IS NULL OR created_at >= :since
+    ORDER BY id""")
+ALBUMS = sqlalchemy.text("""
+    SELECT id, album_name, artist_id, genre, explicit_rating, label, release_date, added_date FROM album
+    WHERE CAST(:since AS timestamptz) IS NULL OR added_date >= :since
+    ORDER BY id""")
+SONGS = sqlalchemy.text("""
+    SELECT song_id, song_name, artist_id, album_id, featured_artist, explicit_rating, length, created_at FROM song
+    WHERE CAST(:since AS timestamptz) IS NULL OR created_at >= :since
+    ORDER BY song_id""")
+
+
+def _text(value):
+    return sys.intern(value) if value is not None else None
+
+
+class Artist:
+    __slots__ = ("id", "name")
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class Album:
+    __slots__ = ("id", "name", "artist_id", "genre", "explicit_rating", "label", "release_date")
+
+    def __init__(self, id, name, artist_id, genre, explicit_rating, label, release_date):
+        self.id = id
+        self.name = name
+        self.artist_id = artist_id
+        self.genre = genre
+        self.explicit_rating = explicit_rating
+        self.label = label
+        self.release_date = release_date
+
+
+class Song:
+    __slots__ = ("id", "name", "artist_id", "album_id", "featured_artist", "explicit_rating", "length")
+
+    def __init__(self, id, name, artist_id, album_id, featured_artist, explicit_rating, length):
+        self.id = id
+        self.name = name
+        self.artist_id = artist_id
+        self.album_id = album_id
+        self.featured_artist = featured_artist
+        self.explicit_rating = explicit_rating
+        self.length = length
+
+
+class Snapshot:
+    """Records plus ID, name and parent indexes. Names resolve to the lowest ID, like the SQL lookups."""
+
+    def __init__(self):
+        self.artists = {}
+        self.albums = {}
+        self.songs = {}
+        self.artist_by_name = {}
+        self.album_by_name = {}
+        self.song_by_name = {}
+        self.albums_by_artist = {}
+        self.songs_by_album = {}
+        self.watermarks = {"artist": None, "album": None, "song": None}
+
+    @staticmethod
+    def _advance(current, seen):
+        return seen if current is None or seen > current else current
+
+    def add_artists(self, rows):
+        for id, name, created_at in rows:
+            self.watermarks["artist"] = self._advance(self.watermarks["artist"], created_at)
+            if id in self.artists:
+                continue
+            artist = self.artists[id] = Artist(id, _text(name))
+            if artist.name not in self.artist_by_name or id < self.artist_by_name[artist.name].id:
+                self.artist_by_name[artist.name] = artist
+
+    def add_albums(self, rows):
+        for id, name, artist_id, genre, explicit_rating, label, release_date, added_date in rows:
+            self.watermarks["album"] = self._advance(self.watermarks["album"], added_date)
+            if id in self.albums:
+                continue
+            artist_id = int(artist_id) if artist_id is not None else None
+            album = self.albums[id] = Album(id, _text(name), artist_id, _text(genre), explicit_rating, _text(label),
+                                            release_date)
+            if album.name not in self.album_by_name or id < self.album_by_name[album.name].id:
+                self.album_by_name[album.name] = album
+            bisect.insort(self.albums_by_artist.setdefault(artist_id, []), id)
+
+    def add_songs(self, rows):
+        for id, name, artist_id, album_id, featured_artist, explicit_rating, length, created_at in rows:
+            self.watermarks["song"] = self._advance(self.watermarks["song"], created_at)
+            if id in self.songs:
+                continue
+            song = self.songs[id] = Song(id, _text(name), artist_id, album_id, _text(featured_artist),
+                                         explicit_rating, length)
+            bisect.insort(self.songs_by_album.setdefault(album_id, []), id)
+            self._index_song(song)
+
+    def _index_song(self, song):
+        artist = self.artists.get(song.artist_id)
+        if artist is None:
+            return
+        key = (song.name, artist.name)
+        if key not in self.song_by_name or song.id < self.song_by_name[key].id:
+            self.song_by_name[key] = song
+
+    def reindex_songs(self):
+        """Index songs whose artist arrived in a later refresh than the song."""
+        indexed = {song.id for song in self.song_by_name.values()}
+        for song in self.songs.values():
+            if song.id not in indexed:
+                self._index_song(song)
+
+    def footprint(self):
+        """Approximate bytes held by records, their strings and the indexes."""
+        seen = set()
+        total = 0
+
+        def size(obj):
+            nonlocal total
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                total += sys.getsizeof(obj)
+
+        for records in (self.artists, self.albums, self.songs):
+            size(records)
+            for record in records.values():
+                size(record)
+                for slot in record.__slots__:
+                    value = getattr(record, slot)
+                    if value is not None:
+                        size(value)
+        for index in (self.artist_by_name, self.album_by_name, self.song_by_name):
+            size(index)
+            for key in index:
+                size(key)
+        for index in (self.albums_by_artist, self.songs_by_album):
+            size(index)
+            for ids in index.values():
+                size(ids)
+        return total
+
+
+class CatalogSnapshot:
+    """The live snapshot and the worker that keeps it current."""
+
+    def __init__(self, refresh_interval=REFRESH_INTERVAL, full_reload=FULL_RELOAD):
+        self.refresh_interval = refresh_interval
+        self.full_reload = full_reload
+        self.snapshot = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._worker = None
+        self._loaded_at = 0.0
+        self._stats = {"loads": 0, "refreshes": 0, "refreshed_rows": 0, "failed_refreshes": 0,
+                       "last_load_ms": 0.0, "last_refresh_ms": 0.0}
+
+    @property
+    def ready(self):
+        return self.snapshot is not None
+
+    def _pull(self, snapshot, connection):
+        since = {table: (mark - REFRESH_OVERLAP if mark is not None else None)
+                 for table, mark in snapshot.watermarks.items()}
+        artists = connection.execute(ARTISTS, {"since": since["artist"]}).all()
+        albums = connection.execute(ALBUMS, {"since": since["album"]}).all()
+        songs = connection.execute(SONGS, {"since": since["song"]}).all()
+        snapshot.add_artists(artists)
+        snapshot.add_albums(albums)
+        snapshot.add_songs(songs)
+        return len(artists) + len(albums) + len(songs)
+
+    def load(self):
+        """Build a fresh snapshot and swap it in."""
+        start = time.perf_counter()
+        snapshot = Snapshot()
+        with db.engine.connect() as connection:
+            self._pull(snapshot, connection)
+        with self._lock:
+            self.snapshot = snapshot
+            self._loaded_at = time.monotonic()
+            self._stats["loads"] += 1
+            self._stats["last_load_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+    def refresh(self):
+        """Add rows created since the last load or refresh."""
+        if self.snapshot is None:
+            return
+        start = time.perf_counter()
+        with self._lock:
+            with db.engine.connect() as connection:
+                rows = self._pull(self.snapshot, connection)
+            if rows:
+                self.snapshot.reindex_songs()
+            self._stats["refreshes"] += 1
+            self._stats["refreshed_rows"] += rows
+            self._stats["last_refresh_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+    def start(self):
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._stopping.clear()
+            self._worker = threading.Thread(target=self._run, name="catalog-snapshot", daemon=True)
+            self._worker.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if self.snapshot is None or time.monotonic() - self._loaded_at >= self.full_reload:
+                    self.load()
+                else:
+                    self.refresh()
+            except sqlalchemy.exc.SQLAlchemyError:
+                with self._lock:
+                    self._stats["failed_refreshes"] += 1
+            self._stopping.wait(self.refresh_interval)
+
+    # Lookups. Each returns what the SQL path of the matching handler would, or None when the name is unknown.
+
+    def artist_id(self, artist_name):
+        artist = self.snapshot.artist_by_name.get(artist_name)
+        return artist.id if artist is not None else None
+
+    def album_id(self, album_name):
+        album = self.snapshot.album_by_name.get(album_name)
+        return album.id if album is not None else None
+
+    def song_id(self, song_name, artist_name):
+        song = self.snapshot.song_by_name.get((song_name, artist_name))
+        return song.id if song is not None else None
+
+    def song_info(self, song_name, artist_name):
+        song = self.snapshot.song_by_name.get((song_name, artist_name))
+        if song is None:
+            return None
+        return [{"Name": song.name, "Featured Artist": song.featured_artist,
+                 "Explicit Rating": song.explicit_rating, "Length": song.length}]
+
+    def album_info(self, album_name):
+        snapshot = self.snapshot
+        album = snapshot.album_by_name.get(album_name)
+        if album is None:
+            return None
+        artist = snapshot.artists.get(album.artist_id)
+        if artist is None:
+            return []
+        return [{"Artist": artist.name, "Album Name": album.name, "Genre": album.genre,
+                 "Explicit Rating": album.explicit_rating, "Label": album.label,
+                 "Release Date": album.release_date}]
+
+    def _page(self, ids, records, cursor, limit, to_item):
+        pagination.check_limit(limit)
+        (after_id,) = pagination.decode_cursor(cursor, 1)
+        start = 0 if after_id is None else bisect.bisect_right(ids, after_id)
+        return pagination.page([records[i] for i in ids[start:start + limit + 1]], limit,
+                               lambda record: [record.id], to_item)
+
+    def artist_albums(self, artist_name, cursor=None, limit=pagination.DEFAULT_PAGE_SIZE):
+        snapshot = self.snapshot
+        artist = snapshot.artist_by_name.get(artist_name)
+        if artist is None:
+            return None
+        return self._page(snapshot.albums_by_artist.get(artist.id, []), snapshot.albums, cursor, limit,
+                          lambda album: {"album_id": album.id, "album_name": album.name})
+
+    def album_songs(self, album_name, cursor=None, limit=pagination.DEFAULT_PAGE_SIZE):
+        snapshot = self.snapshot
+        album = snapshot.album_by_name.get(album_name)
+        if album is None:
+            return None
+        return self._page(snapshot.songs_by_album.get(album.id, []), snapshot.songs, cursor, limit,
+                          lambda song: {"song_id": song.id, "song_name": song.name})
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+        snapshot = self.snapshot
+        if snapshot is not None:
+            stats.update(artists=len(snapshot.artists), albums=len(snapshot.albums), songs=len(snapshot.songs))
+        return {"ready": int(snapshot is not None), **stats}
+
+
+catalog = CatalogSnapshot()
+
+
+def stats(lookups=100000):
+    """Load the snapshot and report its size and lookup latency."""
+    catalog.load()
+    snapshot = catalog.snapshot
+    footprint = snapshot.footprint()
+    songs = len(snapshot.songs)
+    keys = list(snapshot.song_by_name)[:lookups] or [("", "")]
+    start = time.perf_counter()
+    for i in range(lookups):
+        catalog.song_info(*keys[i % len(keys)])
+    per_lookup = (time.perf_counter() - start) / lookups
+    return {**catalog.metrics(), "bytes": footprint,
+            "bytes_per_100k_songs": round(footprint / songs * 100000) if songs else 0,
+            "song_info_us": round(per_lookup * 1e6, 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.catalog_snapshot", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["stats"])
+    parser.parse_args(argv)
+    print(json.dumps(stats(), indent=2, default=str))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
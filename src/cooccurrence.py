@@ -0,0 +1,393 @@
+"""Song-to-song co-occurrence index behind /playlist/recommend.
+
+song_cooccurrence holds, for every song, its COOCCURRENCE_NEIGHBORS most
+frequent playlist neighbours and how many playlists they share. The batch
+build counts pairs as a sparse matrix product (songs x playlists times
+playlists x songs); playlist edits then adjust the weights incrementally
+until the next rebuild re-prunes to the top neighbours. A build counts one
+snapshot of song_playlist without locking it. Triggers from
+migrations/0008_cooccurrence_build_log.sql record which playlists are edited
+meanwhile, and the build recounts just those under a brief SHARE lock before
+swapping the new weights in, so no edit is lost to the swap.
+
+    python -m src.cooccurrence build
+    python -m src.cooccurrence bench --playlists 200
+"""
+import argparse
+import collections
+import os
+import random
+import statistics
+import sys
+import time
+
+import dotenv
+import numpy as np
+import sqlalchemy
+from scipy import sparse
+
+from src import database as db
+
+dotenv.load_dotenv()
+
+NEIGHBORS = int(os.environ.get("COOCCURRENCE_NEIGHBORS", "100"))
+BLOCK_SIZE = 512
+WRITE_BATCH = 50000
+BUILD_LOCK_KEY = 7201806  # pg_advisory_lock key held by a build, so only one runs at a time
+
+RECOMMEND = sqlalchemy.text("""
+    WITH playlist_songs AS (
+        SELECT DISTINCT song_id FROM song_playlist WHERE playlist_id = :playlist_id
+    ),
+    scored AS (
+        SELECT c.neighbor_id AS song_id, SUM(c.weight) AS score
+        FROM song_cooccurrence c
+        WHERE c.song_id IN (SELECT song_id FROM playlist_songs)
+          AND c.neighbor_id NOT IN (SELECT song_id FROM playlist_songs)
+        GROUP BY c.neighbor_id
+        ORDER BY score DESC
+        LIMIT :limit
+    )
+    SELECT scored.song_id, s.song_name, al.album_name, art.artist_name
+    FROM scored
+    JOIN song AS s ON s.song_id = scored.song_id
+    JOIN album AS al ON s.album_id = al.id
+    JOIN artist AS art ON s.artist_id = art.id
+    ORDER BY scored.score DESC
+    """)
+
+# The playlist-overlap query /playlist/recommend ran before the index existed,
+# kept so the benchmark can compare the two.
+LEGACY_RECOMMEND = sqlalchemy.text("""
+    WITH playlist_6_songs AS (
+        SELECT song_id FROM song_playlist
+        JOIN user_playlist AS up ON up.playlist_id = song_playlist.playlist_id
+        JOIN users AS u ON u.user_id = up.user_id
+        WHERE up.playlist_name = :playlist_name
+    ),
+    matching_playlists AS (
+        SELECT sp.playlist_id FROM song_playlist AS sp
+        JOIN user_playlist AS up ON up.playlist_id = sp.playlist_id
+        JOIN users AS u ON u.user_id = up.user_id
+        WHERE song_id IN (SELECT song_id FROM playlist_6_songs)
+          AND up.playlist_name != :playlist_name
+        GROUP BY sp.playlist_id
+        HAVING COUNT(DISTINCT song_id) >= 3
+    )
+    SELECT DISTINCT sp.song_id, s.song_name, al.album_name, art.artist_name
+    FROM song_playlist AS sp
+    JOIN song AS s ON s.song_id = sp.song_id
+    JOIN album AS al ON s.album_id = al.id
+    JOIN artist AS art ON s.artist_id = art.id
+    WHERE playlist_id IN (SELECT playlist_id FROM matching_playlists)
+      AND sp.song_id NOT IN (SELECT song_id FROM playlist_6_songs)
+    LIMIT :limit
+    """)
+
+# Pairs between the given (playlist_id, song_id) entries and the rest of their
+# playlists. Used after songs are added (each added song now appears exactly
+# once) and after songs are removed (each removed song no longer appears).
+_PAIRS = """
+    others AS (
+        SELECT DISTINCT sp.playlist_id, sp.song_id FROM song_playlist sp
+        WHERE sp.playlist_id IN (SELECT playlist_id FROM changed)
+          AND (sp.playlist_id, sp.song_id) NOT IN (SELECT playlist_id, song_id FROM changed)
+    ),
+    pairs AS (
+        SELECT c.song_id, o.song_id AS neighbor_id FROM changed c JOIN others o USING (playlist_id)
+        UNION ALL
+        SELECT o.song_id, c.song_id FROM changed c JOIN others o USING (playlist_id)
+        UNION ALL
+        SELECT a.song_id, b.song_id FROM changed a JOIN changed b USING (playlist_id)
+        WHERE a.song_id <> b.song_id
+    )
+    """
+
+ADD_PAIRS = sqlalchemy.text("""
+    WITH changed AS (
+        SELECT sp.playlist_id, sp.song_id FROM song_playlist sp
+        WHERE (sp.playlist_id, sp.song_id) IN (
+            SELECT * FROM unnest(CAST(:playlist_ids AS bigint[]), CAST(:song_ids AS bigint[])))
+        GROUP BY sp.playlist_id, sp.song_id
+        HAVING COUNT(*) = 1
+    ),""" + _PAIRS + """
+    INSERT INTO song_cooccurrence (song_id, neighbor_id, weight)
+    SELECT song_id, neighbor_id, COUNT(*) FROM pairs
+    GROUP BY song_id, neighbor_id
+    ORDER BY song_id, neighbor_id
+    ON CONFLICT (song_id, neighbor_id) DO UPDATE
+    SET weight = song_cooccurrence.weight + EXCLUDED.weight
+    """)
+
+REMOVE_PAIRS = sqlalchemy.text("""
+    WITH changed AS (
+        SELECT DISTINCT r.playlist_id, r.song_id
+        FROM unnest(CAST(:playlist_ids AS bigint[]), CAST(:song_ids AS bigint[])) AS r(playlist_id, song_id)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM song_playlist sp WHERE sp.playlist_id = r.playlist_id AND sp.song_id = r.song_id)
+    ),""" + _PAIRS + """,
+    decrements AS (
+        SELECT song_id, neighbor_id, COUNT(*) AS weight FROM pairs GROUP BY song_id, neighbor_id
+    )
+    UPDATE song_cooccurrence c SET weight = c.weight - d.weight
+    FROM decrements d
+    WHERE c.song_id = d.song_id AND c.neighbor_id = d.neighbor_id
+    RETURNING c.song_id, c.neighbor_id, c.weight
+    """)
+
+DELETE_PAIRS = sqlalchemy.text("""
+    DELETE FROM song_cooccurrence
+    WHERE (song_id, neighbor_id) IN (
+        SELECT * FROM unnest(CAST(:song_ids AS integer[]), CAST(:neighbor_ids AS integer[])))
+    """)
+
+
+def songs_added(connection, entries):
+    """Count new pairs for (playlist_id, song_id) entries just inserted into song_playlist."""
+    if not entries:
+        return
+    playlist_ids, song_ids = (list(column) for column in zip(*entries))
+    connection.execute(ADD_PAIRS, {"playlist_ids": playlist_ids, "song_ids": song_ids})
+
+
+def songs_removed(connection, entries):
+    """Uncount pairs for (playlist_id, song_id) entries just deleted from song_playlist."""
+    if not entries:
+        return
+    playlist_ids, song_ids = (list(column) for column in zip(*entries))
+    updated = connection.execute(REMOVE_PAIRS, {"playlist_ids": playlist_ids, "song_ids": song_ids})
+    emptied = [(song_id, neighbor_id) for song_id, neighbor_id, weight in updated if weight <= 0]
+    if emptied:
+        song_ids, neighbor_ids = (list(column) for column in zip(*emptied))
+        connection.execute(DELETE_PAIRS, {"song_ids": song_ids, "neighbor_ids": neighbor_ids})
+
+
+def recommend(connection, playlist_id, limit):
+    """Songs outside the playlist ranked by summed co-occurrence with the playlist's songs."""
+    return connection.execute(RECOMMEND, {"playlist_id": playlist_id, "limit": limit}).all()
+
+
+def _load_memberships(connection):
+    """song_playlist as two int64 arrays, fetched with a server-side cursor."""
+    playlist_chunks, song_chunks = [], []
+    result = connection.execution_options(stream_results=True, yield_per=WRITE_BATCH).execute(
+        sqlalchemy.text("SELECT playlist_id, song_id FROM song_playlist"))
+    for chunk in result.partitions():
+        pairs = np.array(chunk, dtype=np.int64).reshape(-1, 2)
+        playlist_chunks.append(pairs[:, 0])
+        song_chunks.append(pairs[:, 1])
+    if not playlist_chunks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(playlist_chunks), np.concatenate(song_chunks)
+
+
+# Adds signed weight changes to song_cooccurrence the way the incremental
+# updates do: new pairs are inserted, and pairs falling to zero are deleted.
+APPLY_DELTAS = sqlalchemy.text("""
+    WITH deltas AS (
+        SELECT * FROM unnest(CAST(:song_ids AS integer[]), CAST(:neighbor_ids AS integer[]),
+                             CAST(:weights AS integer[])) AS d(song_id, neighbor_id, weight)
+    ),
+    lowered AS (
+        UPDATE song_cooccurrence c SET weight = c.weight + d.weight
+        FROM deltas d
+        WHERE c.song_id = d.song_id AND c.neighbor_id = d.neighbor_id AND d.weight < 0 AND c.weight + d.weight > 0
+    ),
+    emptied AS (
+        DELETE FROM song_cooccurrence c
+        USING deltas d
+        WHERE c.song_id = d.song_id AND c.neighbor_id = d.neighbor_id AND d.weight < 0 AND c.weight + d.weight <= 0
+    )
+    INSERT INTO song_cooccurrence (song_id, neighbor_id, weight)
+    SELECT song_id, neighbor_id, weight FROM deltas WHERE weight > 0
+    ORDER BY song_id, neighbor_id
+    ON CONFLICT (song_id, neighbor_id) DO UPDATE
+    SET weight = song_cooccurrence.weight + EXCLUDED.weight
+    """)
+
+START_LOGGING = sqlalchemy.text("UPDATE cooccurrence_build SET running = true")
+STOP_LOGGING = sqlalchemy.text("UPDATE cooccurrence_build SET running = false")
+CLEAR_CHANGES = sqlalchemy.text("TRUNCATE cooccurrence_build_changes")
+CHANGED_PLAYLISTS = sqlalchemy.text("SELECT DISTINCT playlist_id FROM cooccurrence_build_changes")
+PLAYLIST_MEMBERS = sqlalchemy.text(
+    "SELECT playlist_id, song_id FROM song_playlist WHERE playlist_id = ANY(CAST(:playlist_ids AS bigint[]))")
+
+
+def top_neighbors(playlist_ids, song_ids, neighbors=NEIGHBORS, block_size=BLOCK_SIZE):
+    """Yield (song_ids, neighbor_ids, weights) arrays holding each song's top co-occurring songs."""
+    playlists, playlist_index = np.unique(playlist_ids, return_inverse=True)
+    songs, song_index = np.unique(song_ids, return_inverse=True)
+    membership = sparse.csr_matrix(
+        (np.ones(len(song_index), dtype=np.int32), (playlist_index, song_index)),
+        shape=(len(playlists), len(songs)))
+    membership.data[:] = 1  # a song listed twice in a playlist still counts once
+    by_song = membership.T.tocsr()
+
+    for start in range(0, len(songs), block_size):
+        block = (by_song[start:start + block_size] @ membership).tocsr()
+        rows, cols, weights = [], [], []
+        for offset in range(block.shape[0]):
+            lo, hi = block.indptr[offset], block.indptr[offset + 1]
+            cand = block.indices[lo:hi]
+            cand_weights = block.data[lo:hi]
+            keep = cand != start + offset
+            cand, cand_weights = cand[keep], cand_weights[keep]
+            if len(cand) > neighbors:
+                best = np.argpartition(cand_weights, -neighbors)[-neighbors:]
+                cand, cand_weights = cand[best], cand_weights[best]
+            rows.append(np.full(len(cand), start + offset))
+            cols.append(cand)
+            weights.append(cand_weights)
+        if rows:
+            yield songs[np.concatenate(rows)], songs[np.concatenate(cols)], np.concatenate(weights)
+
+
+def catch_up(playlist_ids, song_ids, edited, members):
+    """(song_ids, neighbor_ids, weights) changes that move pair counts from the snapshot to now.
+
+    playlist_ids and song_ids are the snapshot the build counted, edited the
+    playlists changed since, and members their current (playlist_id, song_id)
+    rows. Each weight is the change in the number of playlists the pair shares.
+    """
+    before, after = collections.defaultdict(set), collections.defaultdict(set)
+    mask = np.isin(playlist_ids, np.fromiter(edited, dtype=np.int64, count=len(edited)))
+    for playlist_id, song_id in zip(playlist_ids[mask].tolist(), song_ids[mask].tolist()):
+        before[playlist_id].add(song_id)
+    for playlist_id, song_id in members:
+        after[playlist_id].add(song_id)
+    changes = collections.Counter()
+    for playlist_id in edited:
+        old, new = before[playlist_id], after[playlist_id]
+        # Pairs gained have an added song in them, pairs lost a removed one.
+        for songs, others, sign in ((new - old, new, 1), (old - new, old, -1)):
+            kept = others - songs
+            for song_id in songs:
+                for other in others:
+                    if other != song_id:
+                        changes[song_id, other] += sign
+                        if other in kept:
+                            changes[other, song_id] += sign
+    changes = [(pair, weight) for pair, weight in changes.items() if weight]
+    if not changes:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pairs, weights = zip(*changes)
+    pairs = np.array(pairs, dtype=np.int64)
+    return pairs[:, 0], pairs[:, 1], np.array(weights, dtype=np.int64)
+
+
+def build(neighbors=NEIGHBORS, block_size=BLOCK_SIZE):
+    """Rebuild song_cooccurrence from song_playlist. Returns the number of pairs written."""
+    written = 0
+    with db.engine.connect() as connection:
+        connection.execute(sqlalchemy.text("SELECT pg_advisory_lock(:key)"), {"key": BUILD_LOCK_KEY})
+        connection.commit()
+        try:
+            with connection.begin():
+                connection.execute(CLEAR_CHANGES)
+                connection.execute(START_LOGGING)
+            # Edits already running when logging started might not be logged: wait them out
+            # before the snapshot. Every later edit records its playlists.
+            with connection.begin():
+                connection.execute(sqlalchemy.text("LOCK TABLE song_playlist IN SHARE MODE"))
+            with connection.begin():
+                playlist_ids, song_ids = _load_memberships(connection)
+                connection.execute(sqlalchemy.text(
+                    "CREATE TEMP TABLE song_cooccurrence_build (LIKE song_cooccurrence) ON COMMIT DROP"))
+                insert = sqlalchemy.text("""
+                    INSERT INTO song_cooccurrence_build (song_id, neighbor_id, weight)
+                    SELECT * FROM unnest(CAST(:song_ids AS integer[]), CAST(:neighbor_ids AS integer[]),
+                                         CAST(:weights AS integer[]))
+                    """)
+                for sources, targets, weights in top_neighbors(playlist_ids, song_ids, neighbors, block_size):
+                    for lo in range(0, len(sources), WRITE_BATCH):
+                        hi = lo + WRITE_BATCH
+                        connection.execute(insert, {"song_ids": sources[lo:hi].tolist(),
+                                                    "neighbor_ids": targets[lo:hi].tolist(),
+                                                    "weights": weights[lo:hi].tolist()})
+                    written += len(sources)
+
+                # Only the catch-up and the swap hold up playlist edits.
+                connection.execute(sqlalchemy.text("LOCK TABLE song_playlist IN SHARE MODE"))
+                edited = connection.execute(CHANGED_PLAYLISTS).scalars().all()
+                members = connection.execute(PLAYLIST_MEMBERS, {"playlist_ids": edited}).all() if edited else []
+                sources, targets, weights = catch_up(playlist_ids, song_ids, edited, members)
+                connection.execute(sqlalchemy.text("LOCK TABLE song_cooccurrence IN EXCLUSIVE MODE"))
+                connection.execute(sqlalchemy.text("DELETE FROM song_cooccurrence"))
+                connection.execute(sqlalchemy.text("INSERT INTO song_cooccurrence SELECT * FROM song_cooccurrence_build"))
+                for lo in range(0, len(sources), WRITE_BATCH):
+                    hi = lo + WRITE_BATCH
+                    connection.execute(APPLY_DELTAS, {"song_ids": sources[lo:hi].tolist(),
+                                                      "neighbor_ids": targets[lo:hi].tolist(),
+                                                      "weights": weights[lo:hi].tolist()})
+                connection.execute(STOP_LOGGING)
+                connection.execute(CLEAR_CHANGES)
+        finally:
+            if connection.in_transaction():
+                connection.rollback()
+            connection.execute(STOP_LOGGING)
+            connection.execute(sqlalchemy.text("SELECT pg_advisory_unlock(:key)"), {"key": BUILD_LOCK_KEY})
+            connection.commit()
+    return written
+
+
+def bench(playlists=200, limit=5, seed=0):
+    """Time the index against the legacy SQL on a sample of playlists."""
+    with db.engine.connect() as connection:
+        sample = connection.execute(sqlalchemy.text("""
+            SELECT playlist_id, playlist_name FROM user_playlist
+            WHERE playlist_id IN (SELECT DISTINCT playlist_id FROM song_playlist)
+            ORDER BY playlist_id
+            """)).all()
+    random.Random(seed).shuffle(sample)
+    sample = sample[:playlists]
+
+    timings = {"cooccurrence": [], "legacy_sql": []}
+    overlap = []
+    with db.engine.connect() as connection:
+        for playlist_id, playlist_name in sample:
+            start = time.perf_counter()
+            indexed = {row.song_id for row in recommend(connection, playlist_id, limit)}
+            timings["cooccurrence"].append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            legacy = {row.song_id for row in connection.execute(
+                LEGACY_RECOMMEND, {"playlist_name": playlist_name, "limit": limit})}
+            timings["legacy_sql"].append((time.perf_counter() - start) * 1000)
+            if legacy:
+                overlap.append(len(indexed & legacy) / len(legacy))
+
+    report = {}
+    for name, samples in timings.items():
+        samples.sort()
+        report[name] = {
+            "p50_ms": statistics.median(samples) if samples else 0.0,
+            "p95_ms": samples[int(len(samples) * 0.95)] if samples else 0.0,
+            "max_ms": samples[-1] if samples else 0.0,
+        }
+    report["playlists"] = len(sample)
+    report["mean_overlap_with_legacy"] = statistics.mean(overlap) if overlap else 0.0
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.cooccurrence", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["build", "bench"])
+    parser.add_argument("--neighbors", type=int, default=NEIGHBORS, help="neighbours kept per song")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE, help="songs per matrix block")
+    parser.add_argument("--playlists", type=int, default=200, help="playlists sampled by bench")
+    parser.add_argument("--limit", type=int, default=5, help="recommendations per playlist in bench")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        start = time.perf_counter()
+        written = build(args.neighbors, args.block_size)
+        print(f"song_cooccurrence rebuilt: {written} pairs in {time.perf_counter() - start:.1f}s")
+        return 0
+
+    for name, value in bench(args.playlists, args.limit).items():
+        print(f"{name}: {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
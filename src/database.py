@@ -1,10 +1,70 @@
 import os
+import time
 import dotenv
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 def database_connection_url():
     dotenv.load_dotenv()
 
     return os.environ.get("POSTGRES_URI")
 
-engine = create_engine(database_connection_url(), pool_pre_ping=True)
\ No newline at end of file
+def replica_connection_urls():
+    dotenv.load_dotenv()
+
+    return [url.strip() for url in os.environ.get("POSTGRES_REPLICA_URIS", "").split(",") if url.strip()]
+
+def async_database_connection_url(url=None):
+    """POSTGRES_URI (or url) with the asyncpg driver."""
+    return make_url(url or database_connection_url()).set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+
+# "sync" serves musicmain from the psycopg2 engine below; "async" also mounts the
+# async def handlers in src/api/musicmain_async.py on an asyncpg engine.
+BACKEND = os.environ.get("DB_BACKEND", "sync").lower()
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+REPLICA_POOL_SIZE = int(os.environ.get("DB_REPLICA_POOL_SIZE", str(POOL_SIZE)))
+
+# Called with the seconds each pool checkout spent waiting for a connection (see src/metrics.py).
+pool_wait_listeners = []
+
+class TimedCheckout:
+    """Pool mixin that reports how long each checkout waited."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            for listener in pool_wait_listeners:
+                listener(waited)
+
+class TimedQueuePool(TimedCheckout, QueuePool):
+    pass
+
+class TimedAsyncQueuePool(TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+engine = create_engine(database_connection_url(), pool_pre_ping=True, poolclass=TimedQueuePool,
+                       pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW)
+
+# Read replicas from POSTGRES_REPLICA_URIS, each with its own pool. src/replicas.py
+# decides which of these (or the primary) a read-only handler uses.
+replica_engines = [create_engine(url, pool_pre_ping=True, poolclass=TimedQueuePool,
+                                 pool_size=REPLICA_POOL_SIZE, max_overflow=MAX_OVERFLOW)
+                   for url in replica_connection_urls()]
+
+async_engine = None
+async_replica_engines = []
+if BACKEND == "async":
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    async_engine = create_async_engine(async_database_connection_url(), pool_pre_ping=True,
+                                       poolclass=TimedAsyncQueuePool, pool_size=POOL_SIZE,
+                                       max_overflow=MAX_OVERFLOW)
+    async_replica_engines = [create_async_engine(async_database_connection_url(url), pool_pre_ping=True,
+                                                 poolclass=TimedAsyncQueuePool, pool_size=REPLICA_POOL_SIZE,
+                                                 max_overflow=MAX_OVERFLOW)
+                             for url in replica_connection_urls()]
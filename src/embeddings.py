@@ -0,0 +1,340 @@
+"""User and song embeddings from listening history, served from memory-mapped files.
+
+train factorizes the user x song play matrix from the user_song_plays rollup
+(log-scaled play counts, truncated SVD) into EMBEDDING_FACTORS-dimensional
+unit vectors, clusters the song vectors for an IVF index and writes
+everything as .npy files to a new EMBEDDINGS_DIR/<version>/ directory. The
+CURRENT file in EMBEDDINGS_DIR is then switched to it, so servers never see
+a half-written model:
+
+    python -m src.embeddings train      # from cron, or EMBEDDINGS_RETRAIN_INTERVAL
+    python -m src.embeddings stats
+
+Servers memory-map the current version at startup and check CURRENT every
+EMBEDDINGS_RELOAD_INTERVAL seconds, swapping in a new version between
+requests. With EMBEDDINGS_RETRAIN_INTERVAL set, the same worker also runs
+train in a subprocess that often, so the factorization never competes with
+request handlers for the GIL; an advisory lock keeps several servers from
+training at once.
+
+Song vectors are stored grouped by IVF list. An exact lookup scores every
+song; an approximate one scores the IVF_NPROBE lists whose centroids are
+closest to the user's vector. bench.embeddings measures recall against
+latency for different nprobe values.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import dotenv
+import numpy as np
+import sqlalchemy
+
+from src import database as db
+
+dotenv.load_dotenv()
+
+EMBEDDINGS_DIR = os.environ.get("EMBEDDINGS_DIR", "embeddings")
+FACTORS = int(os.environ.get("EMBEDDING_FACTORS", "64"))
+RELOAD_INTERVAL = float(os.environ.get("EMBEDDINGS_RELOAD_INTERVAL", "60"))
+RETRAIN_INTERVAL = float(os.environ.get("EMBEDDINGS_RETRAIN_INTERVAL", "0"))
+NPROBE = int(os.environ.get("IVF_NPROBE", "8"))
+KMEANS_ITERATIONS = 10
+KEEP_VERSIONS = 2
+FETCH_ROWS = 100000
+LOCK_KEY = 7201806  # pg_advisory_lock key held while training
+ARRAYS = ["user_ids", "user_vectors", "user_songs", "song_ids", "song_vectors", "centroids", "list_offsets"]
+
+PLAYS = sqlalchemy.text("SELECT user_id, song_id, play_count FROM user_song_plays")
+
+# Candidates come back best first; the user's own plays are dropped here so the
+# index doesn't need to know about them.
+RECOMMEND = sqlalchemy.text("""
+    SELECT song.song_name, artist.artist_name, candidate.score
+    FROM unnest(CAST(:song_ids AS integer[]), CAST(:scores AS real[])) WITH ORDINALITY
+         AS candidate(song_id, score, ord)
+    JOIN song ON song.song_id = candidate.song_id
+    JOIN artist ON artist.id = song.artist_id
+    WHERE NOT EXISTS (
+        SELECT 1 FROM user_song_plays plays WHERE plays.user_id = :user_id AND plays.song_id = candidate.song_id)
+    ORDER BY candidate.ord
+    LIMIT :limit
+    """)
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def factorize(user_index, song_index, plays, shape, factors=FACTORS, seed=0):
+    """(user vectors, song vectors) as unit rows from a truncated SVD of log(1 + plays)."""
+    import scipy.sparse
+    import scipy.sparse.linalg
+
+    matrix = scipy.sparse.csr_matrix((np.log1p(plays).astype(np.float32), (user_index, song_index)), shape=shape)
+    k = max(1, min(factors, min(shape) - 1))
+    u, s, vt = scipy.sparse.linalg.svds(matrix, k=k, random_state=seed)
+    scale = np.sqrt(s)
+    return _normalize(u * scale), _normalize(vt.T * scale)
+
+
+def kmeans(vectors, lists, iterations=KMEANS_ITERATIONS, seed=0):
+    """Spherical k-means. Returns (unit centroids, assignment per vector)."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(lists):
+            members = vectors[assignment == cluster]
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+        centroids = _normalize(centroids)
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+
+def build_ivf(song_ids, song_vectors, lists=None, seed=0):
+    """Songs reordered so each IVF list is a contiguous slice: (song_ids, vectors, centroids, list_offsets)."""
+    lists = lists or max(1, int(np.sqrt(len(song_ids))))
+    centroids, assignment = kmeans(song_vectors, lists, seed=seed)
+    order = np.argsort(assignment, kind="stable")
+    offsets = np.searchsorted(assignment[order], np.arange(lists + 1))
+    return song_ids[order], song_vectors[order], centroids, offsets
+
+
+def _read_plays(connection):
+    chunks = []
+    result = connection.execution_options(stream_results=True, yield_per=FETCH_ROWS).execute(PLAYS)
+    for rows in result.partitions():
+        chunks.append(np.array([tuple(row) for row in rows], dtype=np.int64).reshape(-1, 3))
+    return np.concatenate(chunks) if chunks else np.empty((0, 3), dtype=np.int64)
+
+
+def _write_version(directory, arrays, meta):
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    path = os.path.join(directory, version)
+    partial = path + ".partial"
+    os.makedirs(partial, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(partial, f"{name}.npy"), array)
+    with open(os.path.join(partial, "meta.json"), "w") as f:
+        json.dump({**meta, "version": version}, f, indent=2)
+    os.replace(partial, path)
+    current = os.path.join(directory, "CURRENT")
+    with open(current + ".partial", "w") as f:
+        f.write(version)
+    os.replace(current + ".partial", current)
+    versions = sorted(name for name in os.listdir(directory)
+                      if os.path.isdir(os.path.join(directory, name)) and not name.endswith(".partial"))
+    # Servers still mapping an old version keep their open files until they reload.
+    for old in versions[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+    return version
+
+
+def train(directory=EMBEDDINGS_DIR, factors=FACTORS, seed=0, engine=None):
+    """Build and publish a new model. Returns its meta, or None if another trainer holds the lock."""
+    engine = engine or db.engine
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock:
+        if not lock.execute(sqlalchemy.text("SELECT pg_try_advisory_lock(:key)"), {"key": LOCK_KEY}).scalar():
+            return None
+        try:
+            return _train(directory, factors, seed, engine)
+        finally:
+            lock.execute(sqlalchemy.text("SELECT pg_advisory_unlock(:key)"), {"key": LOCK_KEY})
+
+
+def _train(directory, factors, seed, engine):
+    start = time.perf_counter()
+    with engine.connect() as connection:
+        plays = _read_plays(connection)
+        connection.rollback()
+    if len(plays) == 0:
+        raise ValueError("user_song_plays is empty; run python -m src.rollups backfill first")
+
+    user_ids, user_index, user_songs = np.unique(plays[:, 0], return_inverse=True, return_counts=True)
+    song_ids, song_index = np.unique(plays[:, 1], return_inverse=True)
+    user_vectors, song_vectors = factorize(user_index, song_index, plays[:, 2], (len(user_ids), len(song_ids)),
+                                           factors, seed)
+    ivf_song_ids, ivf_vectors, centroids, offsets = build_ivf(song_ids, song_vectors, seed=seed)
+    os.makedirs(directory, exist_ok=True)
+    meta = {"factors": user_vectors.shape[1], "users": len(user_ids), "songs": len(song_ids), "plays": len(plays),
+            "lists": len(centroids), "trained_at": datetime.now(timezone.utc).isoformat(),
+            "train_seconds": round(time.perf_counter() - start, 2)}
+    arrays = {"user_ids": user_ids.astype(np.int32), "user_vectors": user_vectors,
+              "user_songs": user_songs.astype(np.int32),
+              "song_ids": ivf_song_ids.astype(np.int32), "song_vectors": ivf_vectors,
+              "centroids": centroids, "list_offsets": offsets.astype(np.int64)}
+    meta["version"] = _write_version(directory, arrays, meta)
+    return meta
+
+
+class Model:
+    """One trained version, memory-mapped."""
+
+    __slots__ = ("version", "meta", *ARRAYS)
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.version = self.meta["version"]
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+
+    def user_row(self, user_id):
+        row = np.searchsorted(self.user_ids, user_id)
+        if row == len(self.user_ids) or self.user_ids[row] != user_id:
+            return None
+        return row
+
+    def top_k(self, vector, k, nprobe=None):
+        """(song_ids, scores) of the k songs closest to vector, best first; nprobe > 0 searches only that many lists."""
+        if nprobe:
+            nprobe = min(nprobe, len(self.centroids))
+            lists = np.argpartition(-(self.centroids @ vector), nprobe - 1)[:nprobe]
+            rows = np.concatenate([np.arange(self.list_offsets[c], self.list_offsets[c + 1]) for c in lists])
+            scores = self.song_vectors[rows] @ vector
+        else:
+            rows = None
+            scores = self.song_vectors @ vector
+        k = min(k, len(scores))
+        if k == 0:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return self.song_ids[best if rows is None else rows[best]], scores[best]
+
+
+class Recommender:
+    """The current model plus the worker that reloads and optionally retrains it."""
+
+    def __init__(self, directory=EMBEDDINGS_DIR, reload_interval=RELOAD_INTERVAL, retrain_interval=RETRAIN_INTERVAL):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self.retrain_interval = retrain_interval
+        self.model = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._worker = None
+        self._trained_at = time.monotonic()
+        self._stats = {"loads": 0, "failed_loads": 0, "retrains": 0, "failed_retrains": 0, "lookups": 0,
+                       "approximate_lookups": 0, "last_load_ms": 0.0}
+
+    @property
+    def ready(self):
+        return self.model is not None
+
+    def _current_version(self):
+        try:
+            with open(os.path.join(self.directory, "CURRENT")) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        """Map the current version if it isn't the one already loaded. Returns whether it swapped."""
+        version = self._current_version()
+        if version is None or (self.model is not None and self.model.version == version):
+            return False
+        start = time.perf_counter()
+        model = Model(os.path.join(self.directory, version))
+        with self._lock:
+            self.model = model
+            self._stats["loads"] += 1
+            self._stats["last_load_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return True
+
+    def retrain(self):
+        """Run train in a subprocess, then load what it published."""
+        completed = subprocess.run([sys.executable, "-m", "src.embeddings", "train", "--dir", self.directory],
+                                   capture_output=True)
+        with self._lock:
+            self._stats["retrains" if completed.returncode == 0 else "failed_retrains"] += 1
+        self.load()
+
+    def start(self):
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._stopping.clear()
+            self._worker = threading.Thread(target=self._run, name="embeddings", daemon=True)
+            self._worker.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.load()
+            except (OSError, ValueError, KeyError):
+                with self._lock:
+                    self._stats["failed_loads"] += 1
+            if self.retrain_interval and time.monotonic() - self._trained_at >= self.retrain_interval:
+                self._trained_at = time.monotonic()
+                self.retrain()
+            self._stopping.wait(self.reload_interval)
+
+    def candidates(self, user_id, k, approximate=False, nprobe=NPROBE):
+        """(song_ids, scores) for user_id best first, or None if the model doesn't know the user.
+
+        Asks the index for k more songs than the user had played at training
+        time, so k are left once RECOMMEND drops the ones they've heard.
+        """
+        model = self.model
+        row = model.user_row(user_id)
+        if row is None:
+            return None
+        with self._lock:
+            self._stats["lookups"] += 1
+            self._stats["approximate_lookups"] += int(approximate)
+        song_ids, scores = model.top_k(np.asarray(model.user_vectors[row]), k + int(model.user_songs[row]),
+                                       nprobe if approximate else None)
+        return song_ids.tolist(), scores.tolist()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+        model = self.model
+        if model is not None:
+            stats.update(users=model.meta["users"], songs=model.meta["songs"], factors=model.meta["factors"])
+        return {"ready": int(model is not None), **stats}
+
+
+recommender = Recommender()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.embeddings", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["train", "stats"])
+    parser.add_argument("--dir", default=EMBEDDINGS_DIR)
+    parser.add_argument("--factors", type=int, default=FACTORS)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.command == "train":
+        meta = train(args.dir, args.factors, args.seed)
+        if meta is None:
+            print("another trainer is running", file=sys.stderr)
+            return 1
+        print(json.dumps(meta, indent=2))
+        return 0
+
+    model = Recommender(args.dir)
+    if not model.load():
+        print(f"no model in {args.dir}", file=sys.stderr)
+        return 1
+    print(json.dumps(model.model.meta, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,308 @@
+"""Bulk export of the catalog and event tables straight from COPY ... TO STDOUT.
+
+Rows never become Python objects: Postgres formats them and the bytes go
+out in EXPORT_CHUNK_BYTES chunks, gzipped on the way when asked, so memory
+stays flat however big the table is. NDJSON is built by row_to_json and
+copied out as single-column CSV with quote and delimiter characters that
+JSON text never contains, so the lines come through untouched.
+
+    python -m src.exports streams song_playlist --format ndjson.gz --jobs 8
+    python -m src.exports all --format csv --dir exports --since 2024-01-01
+
+With --jobs N the ID range of streams and song_playlist is cut into N
+parts exported in parallel, one file each, all reading the same snapshot
+(pg_export_snapshot) so the parts add up to one consistent copy. The HTTP
+route /export/{table} takes part and parts to let a client fetch ID
+ranges in parallel the same way, but each part reads its own snapshot.
+"""
+import argparse
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import dotenv
+import sqlalchemy
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from src import database as db
+from src.replicas import replicas
+
+dotenv.load_dotenv()
+
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "exports")
+EXPORT_CHUNK_BYTES = int(os.environ.get("EXPORT_CHUNK_BYTES", str(1 << 20)))
+EXPORT_GZIP_LEVEL = int(os.environ.get("EXPORT_GZIP_LEVEL", "1"))
+# Chunks buffered between the COPY thread and a slow HTTP client.
+EXPORT_QUEUE_CHUNKS = 8
+SNAPSHOT_ID = re.compile(r"[0-9A-Fa-f-]+")
+
+# table: (columns, id column for ranges and parts, time column for since/until)
+TABLES = {
+    "streams": (["stream_id", "created_at", "user_id", "song_id"], "stream_id", "created_at"),
+    "song_playlist": (["playlist_id", "song_id", "user_id", "position", "created_at"], "playlist_id", "created_at"),
+    "artist": (["id", "artist_name", "created_at"], "id", "created_at"),
+    "album": (["id", "album_name", "artist_id", "genre", "explicit_rating", "label", "release_date", "added_date"],
+              "id", "added_date"),
+    "song": (["song_id", "song_name", "artist_id", "album_id", "featured_artist", "explicit_rating", "length",
+              "created_at"], "song_id", "created_at"),
+}
+# Tables big enough that --jobs splits them; the catalog tables are exported in one piece.
+SPLIT_TABLES = {"streams", "song_playlist"}
+FORMATS = {
+    "csv": "text/csv",
+    "csv.gz": "application/gzip",
+    "ndjson": "application/x-ndjson",
+    "ndjson.gz": "application/gzip",
+}
+
+
+class ExportError(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+def check(table, file_format, part=0, parts=1):
+    if table not in TABLES:
+        raise ExportError(f"table must be one of {', '.join(TABLES)}")
+    if file_format not in FORMATS:
+        raise ExportError(f"format must be one of {', '.join(FORMATS)}")
+    if parts < 1 or not 0 <= part < parts:
+        raise ExportError("part must be between 0 and parts - 1")
+
+
+def copy_sql(cursor, table, file_format, since=None, until=None, from_id=None, to_id=None):
+    """The COPY ... TO STDOUT statement for one export, with its filters inlined by the driver."""
+    columns, id_column, time_column = TABLES[table]
+    filters, params = [], {}
+    for clause, name, value in [(f"{time_column} >= %(since)s", "since", since),
+                                (f"{time_column} < %(until)s", "until", until),
+                                (f"{id_column} >= %(from_id)s", "from_id", from_id),
+                                (f"{id_column} < %(to_id)s", "to_id", to_id)]:
+        if value is not None:
+            filters.append(clause)
+            params[name] = value
+    select = f"SELECT {', '.join(columns)} FROM {table}"
+    if filters:
+        select += " WHERE " + " AND ".join(filters)
+    select = cursor.mogrify(select, params).decode()
+    if file_format.startswith("ndjson"):
+        return (f"COPY (SELECT row_to_json(exported) FROM ({select}) AS exported) TO STDOUT "
+                "WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')")
+    return f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)"
+
+
+def id_bounds(connection, table, from_id=None, to_id=None):
+    """(lowest, highest) id of table within [from_id, to_id), or (None, None) when there are no rows."""
+    _, id_column, _ = TABLES[table]
+    row = connection.execute(sqlalchemy.text(f"""
+        SELECT MIN({id_column}), MAX({id_column}) FROM {table}
+        WHERE {id_column} >= COALESCE(CAST(:from_id AS bigint), {id_column})
+          AND {id_column} < COALESCE(CAST(:to_id AS bigint), {id_column} + 1)
+        """), {"from_id": from_id, "to_id": to_id}).one()
+    return row[0], row[1]
+
+
+def split(low, high, parts):
+    """parts half-open [from_id, to_id) ranges covering low..high; empty ones when there are no rows."""
+    if low is None:
+        return [(0, 0)] * parts
+    span = high + 1 - low
+    edges = [low + span * index // parts for index in range(parts + 1)]
+    return list(zip(edges, edges[1:]))
+
+
+class Sink:
+    """File-like target for copy_expert: batches COPY's per-row writes into chunks and gzips them if asked."""
+
+    def __init__(self, emit, compress=False, chunk_bytes=EXPORT_CHUNK_BYTES):
+        self.emit = emit
+        self.chunk_bytes = chunk_bytes
+        self.compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+        self.buffer = bytearray()
+        self.bytes_in = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer += data
+        self.bytes_in += len(data)
+        if len(self.buffer) >= self.chunk_bytes:
+            self._emit(bytes(self.buffer))
+            self.buffer.clear()
+        return len(data)
+
+    def _emit(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if data:
+            self.emit(data)
+
+    def close(self):
+        self._emit(bytes(self.buffer))
+        self.buffer.clear()
+        if self.compressor is not None:
+            self.emit(self.compressor.flush())
+
+
+def copy_to(connection, table, file_format, emit, **filters):
+    """COPY table out over connection's driver connection into emit(bytes). Returns (rows, uncompressed bytes)."""
+    sink = Sink(emit, compress=file_format.endswith(".gz"))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(copy_sql(cursor, table, file_format, **filters), sink)
+        rows = cursor.rowcount
+    finally:
+        cursor.close()
+    sink.close()
+    return rows, sink.bytes_in
+
+
+def response(table, file_format="csv", since=None, until=None, from_id=None, to_id=None, part=0, parts=1):
+    """A StreamingResponse of one table (or one ID range of it) read from a replica."""
+    try:
+        check(table, file_format, part, parts)
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    chunks = queue.Queue(EXPORT_QUEUE_CHUNKS)
+    stopped = threading.Event()
+    done = object()
+
+    def emit(data):
+        while True:
+            if stopped.is_set():
+                raise Cancelled()
+            try:
+                chunks.put(data, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        try:
+            with replicas.read() as connection:
+                try:
+                    lower, upper = from_id, to_id
+                    if parts > 1:
+                        lower, upper = split(*id_bounds(connection, table, from_id, to_id), parts)[part]
+                    copy_to(connection, table, file_format, emit, since=since, until=until, from_id=lower,
+                            to_id=upper)
+                except BaseException:
+                    # A COPY abandoned halfway leaves the driver connection mid-protocol.
+                    connection.invalidate()
+                    raise
+            emit(done)
+        except Cancelled:
+            pass
+        except BaseException as e:
+            try:
+                emit(e)
+            except Cancelled:
+                pass
+
+    def body():
+        worker = threading.Thread(target=produce, name=f"export-{table}", daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = chunks.get()
+                if item is done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+            worker.join()
+
+    suffix = f".{part:03d}" if parts > 1 else ""
+    return StreamingResponse(body(), media_type=FORMATS[file_format],
+                             headers={"Content-Disposition": f'attachment; filename="{table}{suffix}.{file_format}"'})
+
+
+def _export_file(table, file_format, path, snapshot=None, engine=None, **filters):
+    """Export into path (written as path.partial, then renamed). Returns (rows, uncompressed bytes)."""
+    partial = path + ".partial"
+    with (engine or db.engine).connect() as connection, open(partial, "wb") as f:
+        if snapshot is not None:
+            if not SNAPSHOT_ID.fullmatch(snapshot):
+                raise ExportError(f"bad snapshot id {snapshot!r}")
+            connection.execute(sqlalchemy.text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+            connection.execute(sqlalchemy.text(f"SET TRANSACTION SNAPSHOT '{snapshot}'"))
+        try:
+            rows, size = copy_to(connection, table, file_format, f.write, **filters)
+        except BaseException:
+            connection.invalidate()
+            raise
+        connection.rollback()
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+    return rows, size
+
+
+def export(table, file_format="csv", directory=EXPORT_DIR, jobs=1, engine=None, since=None, until=None,
+           from_id=None, to_id=None):
+    """Export table into directory, split into jobs ID-range files for SPLIT_TABLES. Returns (paths, rows, bytes)."""
+    check(table, file_format)
+    engine = engine or db.engine
+    os.makedirs(directory, exist_ok=True)
+    filters = {"since": since, "until": until}
+    if jobs <= 1 or table not in SPLIT_TABLES:
+        path = os.path.join(directory, f"{table}.{file_format}")
+        rows, size = _export_file(table, file_format, path, engine=engine, from_id=from_id, to_id=to_id, **filters)
+        return [path], rows, size
+
+    with engine.connect() as coordinator:
+        # Held open until every part is written so the parts can import its snapshot.
+        coordinator.execute(sqlalchemy.text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+        snapshot = coordinator.execute(sqlalchemy.text("SELECT pg_export_snapshot()")).scalar()
+        ranges = split(*id_bounds(coordinator, table, from_id, to_id), jobs)
+        paths = [os.path.join(directory, f"{table}.{part:03d}.{file_format}") for part in range(len(ranges))]
+
+        def export_part(index):
+            lower, upper = ranges[index]
+            return _export_file(table, file_format, paths[index], snapshot, engine, from_id=lower, to_id=upper,
+                                **filters)
+
+        with ThreadPoolExecutor(jobs) as pool:
+            results = list(pool.map(export_part, range(len(ranges))))
+        coordinator.rollback()
+    return paths, sum(rows for rows, _ in results), sum(size for _, size in results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.exports", description=__doc__.splitlines()[0])
+    parser.add_argument("tables", nargs="+", choices=[*TABLES, "all"])
+    parser.add_argument("--format", default="csv", choices=list(FORMATS))
+    parser.add_argument("--dir", default=EXPORT_DIR)
+    parser.add_argument("--jobs", type=int, default=1, help="parallel ID-range parts for streams and song_playlist")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="rows created at or after this time")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="rows created before this time")
+    parser.add_argument("--from-id", type=int, help="rows with an id at or above this")
+    parser.add_argument("--to-id", type=int, help="rows with an id below this")
+    args = parser.parse_args(argv)
+
+    tables = list(TABLES) if "all" in args.tables else args.tables
+    for table in tables:
+        start = time.perf_counter()
+        paths, rows, size = export(table, args.format, args.dir, args.jobs, since=args.since, until=args.until,
+                                   from_id=args.from_id, to_id=args.to_id)
+        seconds = time.perf_counter() - start
+        written = sum(os.path.getsize(path) for path in paths)
+        print(f"{table}: {rows} rows, {size / 1048576:.1f} MiB ({written / 1048576:.1f} MiB written) in "
+              f"{len(paths)} file(s), {seconds:.1f}s, {size / 1048576 / max(seconds, 1e-9):.1f} MiB/s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
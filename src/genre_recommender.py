@@ -0,0 +1,205 @@
+"""Genre-prompt song recommendations from the OpenAI chat completions API.
+
+Requests share one pooled async HTTP client, each upstream call gets
+RECOMMENDER_TIMEOUT seconds in total (connect, send, wait and read), at most
+RECOMMENDER_MAX_CONCURRENCY calls are in flight upstream, answers are cached
+per normalized genre, and concurrent requests for the same genre wait on a
+single upstream call.
+
+Point OPENAI_BASE_URL at src/stub_upstream.py to exercise it offline, or run
+
+    python -m src.genre_recommender bench --requests 2000 --genres 50
+
+which drives the stub in-process and reports hit ratio and tail latency.
+"""
+import argparse
+import asyncio
+import collections
+import os
+import random
+import sys
+import time
+
+import dotenv
+import httpx
+
+from src.cache import MISSING, TTLCache
+
+dotenv.load_dotenv()
+
+CHAT_KEY = os.environ.get("CHAT_KEY", "")
+BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+TIMEOUT = float(os.environ.get("RECOMMENDER_TIMEOUT", "10"))
+MAX_CONCURRENCY = int(os.environ.get("RECOMMENDER_MAX_CONCURRENCY", "8"))
+QUEUE_TIMEOUT = float(os.environ.get("RECOMMENDER_QUEUE_TIMEOUT", "2"))
+CACHE_SIZE = int(os.environ.get("RECOMMENDER_CACHE_SIZE", "1024"))
+CACHE_TTL = float(os.environ.get("RECOMMENDER_CACHE_TTL", "3600"))
+
+
+class UpstreamBusy(Exception):
+    """Every upstream slot stayed taken for longer than RECOMMENDER_QUEUE_TIMEOUT."""
+
+
+class UpstreamError(Exception):
+    """The upstream call failed or timed out."""
+
+
+def normalize(genre):
+    return " ".join(genre.lower().split())
+
+
+class GenreRecommender:
+    """Cached, single-flight, concurrency-limited client for the recommendation prompt."""
+
+    def __init__(self, base_url=BASE_URL, api_key=CHAT_KEY, timeout=TIMEOUT, max_concurrency=MAX_CONCURRENCY,
+                 cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL, transport=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.transport = transport
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self._client = None
+        self._semaphore = None
+        self._inflight = {}
+        self.coalesced = 0
+        self.upstream_calls = 0
+        self.upstream_errors = 0
+        self.rejected = 0
+        self._latencies_ms = collections.deque(maxlen=2000)
+
+    def _ensure_client(self):
+        # Created on first use so they bind to the server's running event loop.
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency),
+                headers={"Authorization": "Bearer " + self.api_key},
+                transport=self.transport,
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def recommend(self, genre):
+        key = normalize(genre)
+        cached = self.cache.get(key)
+        if cached is not MISSING:
+            return cached
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # shield so one cancelled caller doesn't cancel the call everyone else is waiting on
+        return await asyncio.shield(task)
+
+    async def _fetch(self, genre):
+        client = self._ensure_client()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise UpstreamBusy()
+        start = time.perf_counter()
+        try:
+            self.upstream_calls += 1
+            # httpx.Timeout bounds each phase separately; wait_for bounds the whole call.
+            song = await asyncio.wait_for(self._ask(client, genre), self.timeout)
+        except asyncio.TimeoutError as e:
+            self.upstream_errors += 1
+            raise UpstreamError(f"no answer within {self.timeout}s") from e
+        except (httpx.HTTPError, KeyError, IndexError, ValueError) as e:
+            self.upstream_errors += 1
+            raise UpstreamError(str(e)) from e
+        finally:
+            self._latencies_ms.append((time.perf_counter() - start) * 1000)
+            self._semaphore.release()
+        self.cache.put(genre, song)
+        return song
+
+    async def _ask(self, client, genre):
+        response = await client.post("/chat/completions", json={
+            "model": "gpt-3.5-turbo",
+            "messages": [{"role": "user", "content": f"You are a Music Reccomendation assistant, I will give you a genre name or lead, and then you will reccomend one song based on that. And you will only say the song name, and artist, nothing else\
+                      Reccomend me a song that is {genre}."}],
+            "temperature": 0.7
+        })
+        response.raise_for_status()
+        return response.json()['choices'][0]['message']['content']
+
+    def metrics(self):
+        latencies = sorted(self._latencies_ms)
+        return {
+            "cache": self.cache.metrics(),
+            "inflight": len(self._inflight),
+            "coalesced": self.coalesced,
+            "upstream_calls": self.upstream_calls,
+            "upstream_errors": self.upstream_errors,
+            "rejected": self.rejected,
+            "upstream_p50_ms": latencies[len(latencies) // 2] if latencies else 0.0,
+            "upstream_p99_ms": latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+        }
+
+
+recommender = GenreRecommender()
+
+
+async def _bench(requests, genres, concurrency, seed):
+    from src import stub_upstream
+
+    bench_recommender = GenreRecommender(base_url="http://stub/v1", api_key="stub",
+                                         transport=httpx.ASGITransport(app=stub_upstream.app))
+    rng = random.Random(seed)
+    # skewed genre popularity, like real traffic
+    names = [f"genre {i}" for i in range(genres)]
+    weights = [1 / (i + 1) for i in range(genres)]
+    workload = rng.choices(names, weights, k=requests)
+    gate = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(genre):
+        async with gate:
+            start = time.perf_counter()
+            await bench_recommender.recommend(genre.upper() if rng.random() < 0.5 else genre)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(one(genre) for genre in workload))
+    await bench_recommender.close()
+    latencies.sort()
+    metrics = bench_recommender.metrics()
+    return {
+        "requests": requests,
+        "hit_ratio": metrics["cache"]["hit_ratio"],
+        "coalesced": metrics["coalesced"],
+        "upstream_calls": metrics["upstream_calls"],
+        "p50_ms": latencies[len(latencies) // 2],
+        "p99_ms": latencies[int(len(latencies) * 0.99)],
+        "max_ms": latencies[-1],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.genre_recommender", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--genres", type=int, default=50, help="distinct genres in the workload")
+    parser.add_argument("--concurrency", type=int, default=64, help="concurrent client requests")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for name, value in asyncio.run(_bench(args.requests, args.genres, args.concurrency, args.seed)).items():
+        print(f"{name}: {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
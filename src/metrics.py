@@ -0,0 +1,204 @@
+"""Request latency, per-request SQL and pool-wait metrics in Prometheus text format.
+
+MetricsMiddleware times every request by route. For a METRICS_SAMPLE_RATE
+fraction of requests, engine event hooks also count and time each SQL
+statement the request runs; statements slower than METRICS_SLOW_QUERY_MS
+are kept as samples. Pool wait comes from database.TimedQueuePool. Other
+modules add their own counters with register().
+"""
+import collections
+import contextvars
+import os
+import random
+import threading
+import time
+
+import dotenv
+from sqlalchemy import event
+
+from src import database as db
+
+dotenv.load_dotenv()
+
+ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", "0.1"))
+SLOW_QUERY_MS = float(os.environ.get("METRICS_SLOW_QUERY_MS", "250"))
+SLOW_QUERY_SAMPLES = 50
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21, 50)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values."""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self._series.items()}
+        for label_values, (counts, total, count) in sorted(series.items()):
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.labels, label_values))
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+
+class RequestStats:
+    __slots__ = ("scope", "statements", "sql_seconds")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+
+def _route(scope):
+    # The router stores the matched endpoint in the request scope.
+    endpoint = scope.get("endpoint")
+    return endpoint.__name__ if endpoint is not None else "unmatched"
+
+
+request_seconds = Histogram("musicmain_request_duration_seconds", "Request latency by route.",
+                            ("route", "method"))
+request_app_seconds = Histogram("musicmain_request_app_seconds",
+                                "Sampled request time outside SQL: handler code and serialization.", ("route",))
+request_sql_seconds = Histogram("musicmain_request_sql_seconds", "Sampled SQL time per request.", ("route",))
+request_statements = Histogram("musicmain_request_sql_statements", "Sampled SQL statements per request.",
+                               ("route",), COUNT_BUCKETS)
+statement_seconds = Histogram("musicmain_sql_statement_duration_seconds", "Sampled SQL statement latency.")
+pool_wait_seconds = Histogram("musicmain_db_pool_wait_seconds", "Time spent waiting for a pool connection.")
+
+_responses = collections.Counter()
+_responses_lock = threading.Lock()
+_current = contextvars.ContextVar("musicmain_request_stats", default=None)
+slow_queries = collections.deque(maxlen=SLOW_QUERY_SAMPLES)
+_collectors = {}
+
+
+def register(component, collect):
+    """Expose collect()'s numeric values as musicmain_<component>_<key> gauges."""
+    _collectors[component] = collect
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    starts = conn.info.get("metrics_query_start")
+    if stats is None or not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    stats.statements += 1
+    stats.sql_seconds += elapsed
+    statement_seconds.observe(elapsed)
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_queries.append({"route": _route(stats.scope), "ms": round(elapsed * 1000, 2),
+                             "statement": " ".join(statement.split())[:500], "at": time.time()})
+
+
+def instrument(engine):
+    """Attach the SQL timing hooks and pool-wait listener to an engine."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    if pool_wait_seconds.observe not in db.pool_wait_listeners:
+        db.pool_wait_listeners.append(pool_wait_seconds.observe)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route latency and, when sampled, per-request SQL."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENABLED:
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats(scope) if random.random() < SAMPLE_RATE else None
+        token = _current.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            _current.reset(token)
+            route = _route(scope)
+            request_seconds.observe(elapsed, route, scope["method"])
+            with _responses_lock:
+                _responses[(route, str(status))] += 1
+            if stats is not None:
+                request_statements.observe(stats.statements, route)
+                request_sql_seconds.observe(stats.sql_seconds, route)
+                request_app_seconds.observe(max(elapsed - stats.sql_seconds, 0.0), route)
+
+
+def _gauges(prefix, values):
+    for key, value in values.items():
+        if isinstance(value, dict):
+            yield from _gauges(f"{prefix}_{key}", value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}_{key} {value}"
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for histogram in (request_seconds, request_app_seconds, request_sql_seconds, request_statements,
+                      statement_seconds, pool_wait_seconds):
+        lines.extend(histogram.render())
+
+    lines += ["# HELP musicmain_responses_total Responses by route and status.",
+              "# TYPE musicmain_responses_total counter"]
+    with _responses_lock:
+        responses = sorted(_responses.items())
+    for (route, status), count in responses:
+        lines.append(f'musicmain_responses_total{{route="{route}",status="{status}"}} {count}')
+
+    engines = [("db", db.engine)] + ([("db_async", db.async_engine)] if db.async_engine is not None else [])
+    for name, engine in engines:
+        pool = engine.pool
+        lines += [f"# TYPE musicmain_{name}_pool_checked_out gauge", f"musicmain_{name}_pool_checked_out {pool.checkedout()}",
+                  f"# TYPE musicmain_{name}_pool_size gauge", f"musicmain_{name}_pool_size {pool.size()}",
+                  f"# TYPE musicmain_{name}_pool_overflow gauge", f"musicmain_{name}_pool_overflow {pool.overflow()}"]
+
+    for component, collect in sorted(_collectors.items()):
+        lines.extend(_gauges(f"musicmain_{component}", collect()))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,177 @@
+"""Versioned schema migrations from migrations/NNNN_name.sql.
+
+Applied versions are recorded in schema_migrations with a checksum of the
+file, so editing a migration after it ran is reported instead of silently
+diverging. Each file runs in one transaction unless its first line is
+"-- migrate: no-transaction" (needed for CREATE INDEX CONCURRENTLY); those
+run one statement at a time, split on lines ending in ";", and every
+statement must be safe to repeat, because a failure leaves the earlier ones
+applied. A failed CREATE INDEX CONCURRENTLY leaves an invalid index that
+IF NOT EXISTS skips: drop it before rerunning. An advisory lock keeps two
+runners from applying the same migration.
+
+    python -m src.migrate status
+    python -m src.migrate up              # apply everything pending
+    python -m src.migrate up --to 3
+
+docs/schema.sql shows the schema after every migration.
+"""
+import argparse
+import hashlib
+import os
+import re
+import sys
+
+import dotenv
+import sqlalchemy
+
+from src import database as db
+
+dotenv.load_dotenv()
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+NO_TRANSACTION = "-- migrate: no-transaction"
+LOCK_KEY = 7201805  # pg_advisory_lock key held while migrating
+
+CREATE_TABLE = sqlalchemy.text("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version integer PRIMARY KEY,
+        name text NOT NULL,
+        checksum text NOT NULL,
+        applied_at timestamptz NOT NULL DEFAULT now()
+    )""")
+APPLIED = sqlalchemy.text("SELECT version, name, checksum, applied_at FROM schema_migrations ORDER BY version")
+RECORD = sqlalchemy.text("INSERT INTO schema_migrations (version, name, checksum) VALUES (:version, :name, :checksum)")
+
+
+class MigrationError(Exception):
+    pass
+
+
+class Migration:
+    __slots__ = ("version", "name", "sql", "checksum", "transactional")
+
+    def __init__(self, version, name, sql):
+        self.version = version
+        self.name = name
+        self.sql = sql
+        self.checksum = hashlib.sha256(sql.encode()).hexdigest()
+        self.transactional = not sql.lstrip().startswith(NO_TRANSACTION)
+
+    def statements(self):
+        """The file split into single statements, for no-transaction migrations."""
+        statements, current = [], []
+        for line in self.sql.splitlines():
+            if line.strip().startswith("--") and not current:
+                continue
+            current.append(line)
+            if line.rstrip().endswith(";"):
+                statements.append("\n".join(current).strip())
+                current = []
+        if "\n".join(current).strip():
+            statements.append("\n".join(current).strip())
+        return statements
+
+
+def discover(directory=MIGRATIONS_DIR):
+    """Migrations on disk in version order."""
+    migrations = []
+    for filename in sorted(os.listdir(directory)):
+        match = re.fullmatch(r"(\d+)_(\w+)\.sql", filename)
+        if match is None:
+            continue
+        with open(os.path.join(directory, filename)) as f:
+            migrations.append(Migration(int(match.group(1)), match.group(2), f.read()))
+    versions = [migration.version for migration in migrations]
+    if len(set(versions)) != len(versions):
+        raise MigrationError(f"duplicate migration versions in {directory}")
+    return migrations
+
+
+def applied(connection):
+    """schema_migrations rows by version."""
+    connection.execute(CREATE_TABLE)
+    return {row.version: row for row in connection.execute(APPLIED)}
+
+
+def plan(migrations, done, target=None):
+    """Pending migrations up to target. Raises if an applied file changed or a gap was filled in later."""
+    for migration in migrations:
+        row = done.get(migration.version)
+        if row is not None and row.checksum != migration.checksum:
+            raise MigrationError(f"migration {migration.version}_{migration.name} changed after it was applied")
+    pending = [migration for migration in migrations
+               if migration.version not in done and (target is None or migration.version <= target)]
+    if pending and done and pending[0].version < max(done):
+        raise MigrationError(f"migration {pending[0].version}_{pending[0].name} is older than the newest applied one")
+    return pending
+
+
+def _run(connection, sql):
+    connection.execution_options(no_parameters=True).exec_driver_sql(sql)
+
+
+def apply(migration, engine=None):
+    """Apply one migration and record it."""
+    engine = engine or db.engine
+    params = {"version": migration.version, "name": migration.name, "checksum": migration.checksum}
+    if migration.transactional:
+        with engine.begin() as connection:
+            _run(connection, migration.sql)
+            connection.execute(RECORD, params)
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for statement in migration.statements():
+            _run(connection, statement)
+        connection.execute(RECORD, params)
+
+
+def up(target=None, engine=None, log=print):
+    """Apply pending migrations in order. Returns the applied versions."""
+    engine = engine or db.engine
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock:
+        lock.execute(sqlalchemy.text("SELECT pg_advisory_lock(:key)"), {"key": LOCK_KEY})
+        try:
+            pending = plan(discover(), applied(lock), target)
+            for migration in pending:
+                log(f"applying {migration.version:04d}_{migration.name}")
+                apply(migration, engine)
+            return [migration.version for migration in pending]
+        finally:
+            lock.execute(sqlalchemy.text("SELECT pg_advisory_unlock(:key)"), {"key": LOCK_KEY})
+
+
+def status(engine=None):
+    """(version, name, applied_at or None, changed) for every migration on disk."""
+    engine = engine or db.engine
+    with engine.begin() as connection:
+        done = applied(connection)
+    return [(migration.version, migration.name,
+             done[migration.version].applied_at if migration.version in done else None,
+             migration.version in done and done[migration.version].checksum != migration.checksum)
+            for migration in discover()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.migrate", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["status", "up"])
+    parser.add_argument("--to", type=int, default=None, help="stop after this version")
+    args = parser.parse_args(argv)
+
+    if args.command == "status":
+        for version, name, applied_at, changed in status():
+            state = "pending" if applied_at is None else f"applied {applied_at:%Y-%m-%d %H:%M}"
+            print(f"{version:04d}_{name}: {state}{' (file changed since)' if changed else ''}")
+        return 0
+
+    try:
+        versions = up(args.to)
+    except MigrationError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    print(f"applied {len(versions)} migrations" if versions else "up to date")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+"""Keyset pagination cursors and pages for the listing endpoints.
+
+A listing statement filters on its own sort key with bind parameters named in
+`after` (NULL on the first page) and ends in LIMIT :limit. Pages come back as
+{"items": [...], "next_cursor": ...} where next_cursor is an opaque token for
+the last row's key. queries.listing runs the statements, and with
+stream=true sends every row as NDJSON from a server-side cursor instead.
+"""
+import base64
+import json
+import os
+
+import dotenv
+from fastapi import HTTPException
+
+dotenv.load_dotenv()
+
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "1000"))
+STREAM_FETCH_ROWS = 1000
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key), default=str).encode()).decode()
+
+
+def decode_cursor(cursor, size):
+    if cursor is None:
+        return [None] * size
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        key = None
+    if not isinstance(key, list) or len(key) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
+
+def check_limit(limit):
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+
+def bind(params, after, cursor, limit):
+    check_limit(limit)
+    return {**params, **dict(zip(after, decode_cursor(cursor, len(after))))}
+
+
+def page(rows, limit, key_of, to_item):
+    """The response for up to limit + 1 rows fetched after the cursor."""
+    next_cursor = encode_cursor(key_of(rows[limit - 1])) if len(rows) > limit else None
+    return {"items": [to_item(row) for row in rows[:limit]], "next_cursor": next_cursor}
+
@@ -0,0 +1,271 @@
+"""Monthly partitions of streams and archival of old ones to compressed column files.
+
+streams is range-partitioned on created_at by UTC month (migration 0007) into
+streams_pYYYY_MM tables, with streams_default catching anything outside them.
+Run ensure and archive from cron, daily is plenty:
+
+    python -m src.partitions ensure     # partitions for the next PARTITION_MONTHS_AHEAD months
+    python -m src.partitions archive    # months older than ARCHIVE_AFTER_MONTHS
+    python -m src.partitions status
+
+archive writes each old partition to ARCHIVE_DIR/streams_pYYYY_MM.npz, one
+zip-compressed numpy array per column sorted by user_id then stream_id, and
+then, in one transaction, detaches and drops the partition, records the file
+in streams_archive and folds the rows into streams_archived_plays so the
+rollups can still be rebuilt. If the partition's row count changed after the
+file was written the transaction is rolled back and the file removed.
+
+Archived rows only come back when a request asks for them:
+get_total_streams with include_archived=true merges the files' rows for that
+user into the page.
+"""
+import argparse
+import collections
+import functools
+import os
+import re
+import sys
+from datetime import datetime, timezone
+
+import dotenv
+import numpy as np
+import sqlalchemy
+
+from src import database as db
+from src import pagination
+from src import queries
+from src import rollups
+
+dotenv.load_dotenv()
+
+PARTITION_MONTHS_AHEAD = int(os.environ.get("PARTITION_MONTHS_AHEAD", "3"))
+ARCHIVE_AFTER_MONTHS = int(os.environ.get("ARCHIVE_AFTER_MONTHS", "12"))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+ARCHIVE_CACHE_FILES = int(os.environ.get("ARCHIVE_CACHE_FILES", "4"))
+FETCH_ROWS = 100000
+PARTITION_NAME = re.compile(r"streams_p(\d{4})_(\d{2})")
+COLUMNS = ["stream_id", "created_at", "user_id", "song_id"]
+
+CREATE_PARTITIONS = sqlalchemy.text("""
+    SELECT streams_create_partitions(COALESCE(CAST(:since AS timestamptz), now()),
+                                     now() + make_interval(months => :ahead))
+    """)
+
+PARTITIONS = sqlalchemy.text("""
+    SELECT child.relname AS name, child.reltuples AS estimated_rows,
+           pg_total_relation_size(child.oid) AS bytes
+    FROM pg_inherits
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE pg_inherits.inhparent = 'public.streams'::regclass
+    ORDER BY child.relname
+    """)
+
+ARCHIVES = sqlalchemy.text("""
+    SELECT partition_name, range_start, range_end, path, row_count, archived_at FROM streams_archive
+    ORDER BY range_start
+    """)
+
+ARCHIVE_PATHS = sqlalchemy.text("SELECT path FROM streams_archive ORDER BY range_start")
+
+SONG_NAMES = sqlalchemy.text("""
+    SELECT song.song_id, song.song_name, artist.artist_name, song.featured_artist
+    FROM song
+    JOIN artist on artist.id = song.artist_id
+    WHERE song.song_id = ANY(CAST(:song_ids AS integer[]))
+    """)
+
+ArchivedStream = collections.namedtuple(
+    "ArchivedStream", ["stream_id", "created_at", "song_name", "artist_name", "featured_artist"])
+
+
+class PartitionError(Exception):
+    pass
+
+
+def month_start(name):
+    """The UTC start of partition `name`'s month, or None for the default partition."""
+    match = PARTITION_NAME.fullmatch(name)
+    if match is None:
+        return None
+    return datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)
+
+
+def next_month(start):
+    return start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+
+
+def archive_cutoff(now=None, months=ARCHIVE_AFTER_MONTHS):
+    """Partitions whose month ends on or before this are archived."""
+    now = now or datetime.now(timezone.utc)
+    total = now.year * 12 + now.month - 1 - months
+    return datetime(total // 12, total % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def ensure(months_ahead=PARTITION_MONTHS_AHEAD, since=None, engine=None):
+    """Create monthly partitions from since (default now) through months_ahead months out. Returns how many."""
+    with (engine or db.engine).begin() as connection:
+        return connection.execute(CREATE_PARTITIONS, {"since": since, "ahead": months_ahead}).scalar()
+
+
+def _write(connection, name, path):
+    """Dump partition `name` to path as compressed column arrays. Returns the row count."""
+    chunks = {column: [] for column in COLUMNS}
+    result = connection.execution_options(stream_results=True, yield_per=FETCH_ROWS).execute(sqlalchemy.text(f"""
+        SELECT stream_id, CAST(EXTRACT(EPOCH FROM created_at) * 1000000 AS bigint),
+               COALESCE(user_id, 0), COALESCE(song_id, 0)
+        FROM "{name}"
+        ORDER BY COALESCE(user_id, 0), stream_id"""))
+    for rows in result.partitions():
+        block = np.array([tuple(row) for row in rows], dtype=np.int64).reshape(-1, len(COLUMNS))
+        for index, column in enumerate(COLUMNS):
+            chunks[column].append(block[:, index])
+    arrays = {column: np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+              for column, parts in chunks.items()}
+    arrays["user_id"] = arrays["user_id"].astype(np.int32)
+    arrays["song_id"] = arrays["song_id"].astype(np.int32)
+    partial = path + ".partial"
+    with open(partial, "wb") as f:
+        np.savez_compressed(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+    return len(arrays["stream_id"])
+
+
+def archive_partition(name, directory=ARCHIVE_DIR, engine=None):
+    """Write partition `name` to directory, then detach and drop it. Returns (path, rows)."""
+    engine = engine or db.engine
+    start = month_start(name)
+    if start is None:
+        raise PartitionError(f"{name} is not a monthly streams partition")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.abspath(os.path.join(directory, f"{name}.npz"))
+    with engine.connect() as connection:
+        rows = _write(connection, name, path)
+        connection.rollback()
+    try:
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.text(f'ALTER TABLE streams DETACH PARTITION "{name}"'))
+            current = connection.execute(sqlalchemy.text(f'SELECT COUNT(*) FROM "{name}"')).scalar()
+            if current != rows:
+                raise PartitionError(f"{name} has {current} rows but {rows} were archived; rerun archive")
+            connection.execute(sqlalchemy.text(f"""
+                INSERT INTO streams_archived_plays (user_id, song_id, play_count, first_played_at, last_played_at)
+                SELECT user_id, song_id, COUNT(*), MIN(created_at), MAX(created_at) FROM "{name}"
+                WHERE user_id IS NOT NULL AND song_id IS NOT NULL
+                GROUP BY 1, 2
+                ON CONFLICT (user_id, song_id) DO UPDATE
+                SET play_count = streams_archived_plays.play_count + EXCLUDED.play_count,
+                    first_played_at = LEAST(streams_archived_plays.first_played_at, EXCLUDED.first_played_at),
+                    last_played_at = GREATEST(streams_archived_plays.last_played_at, EXCLUDED.last_played_at)
+                """))
+            connection.execute(sqlalchemy.text("""
+                INSERT INTO streams_archive (partition_name, range_start, range_end, path, row_count)
+                VALUES (:name, :start, :end, :path, :rows)
+                """), {"name": name, "start": start, "end": next_month(start), "path": path, "rows": rows})
+            connection.execute(sqlalchemy.text(f'DROP TABLE "{name}"'))
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, rows
+
+
+def archive(months=ARCHIVE_AFTER_MONTHS, directory=ARCHIVE_DIR, engine=None, log=print):
+    """Archive every partition whose month ended at least `months` months ago. Returns the archived names."""
+    cutoff = archive_cutoff(months=months)
+    if (datetime.now(timezone.utc) - cutoff).days < rollups.DAILY_RETENTION_DAYS:
+        raise PartitionError(f"archiving after {months} months would drop plays still in the daily buckets")
+    with (engine or db.engine).begin() as connection:
+        names = [row.name for row in connection.execute(PARTITIONS)]
+    archived = []
+    for name in names:
+        start = month_start(name)
+        if start is None or next_month(start) > cutoff:
+            continue
+        path, rows = archive_partition(name, directory, engine)
+        log(f"archived {name}: {rows} rows to {path}")
+        archived.append(name)
+    return archived
+
+
+@functools.lru_cache(maxsize=ARCHIVE_CACHE_FILES)
+def _load(path):
+    with np.load(path) as arrays:
+        return {column: arrays[column] for column in COLUMNS}
+
+
+def archived_user_streams(paths, user_id, after_id, limit):
+    """Up to limit (stream_id, created_at, song_id) rows of user_id below after_id from the archive files."""
+    found = []
+    for path in paths:
+        arrays = _load(path)
+        low, high = np.searchsorted(arrays["user_id"], [user_id, user_id + 1])
+        stream_ids = arrays["stream_id"][low:high]
+        keep = np.flatnonzero(stream_ids < after_id) if after_id is not None else np.arange(len(stream_ids))
+        keep = keep[np.argsort(-stream_ids[keep], kind="stable")[:limit]]
+        found.extend(zip(stream_ids[keep].tolist(), arrays["created_at"][low:high][keep].tolist(),
+                         arrays["song_id"][low:high][keep].tolist()))
+    found.sort(reverse=True)
+    return found[:limit]
+
+
+def listing_with_archive(connection, username, to_item, cursor=None, limit=pagination.DEFAULT_PAGE_SIZE):
+    """get_total_streams' page with the user's archived plays merged in by stream_id."""
+    params = pagination.bind({"username": username}, ["after_id"], cursor, limit)
+    rows = connection.execute(queries.USER_STREAMS.statement, {**params, "limit": limit + 1}).all()
+    message = queries.USER_STREAMS.missing(rows[0] if rows else None)
+    if message is not None:
+        return message
+    paths = connection.execute(ARCHIVE_PATHS).scalars().all()
+    archived = archived_user_streams(paths, rows[0].user_id, params["after_id"], limit + 1)
+    songs = {}
+    if archived:
+        songs = {song.song_id: song for song in connection.execute(
+            SONG_NAMES, {"song_ids": sorted({song_id for _, _, song_id in archived})})}
+    merged = queries.USER_STREAMS.items(rows)
+    for stream_id, created_us, song_id in archived:
+        song = songs.get(song_id)
+        merged.append(ArchivedStream(stream_id, datetime.fromtimestamp(created_us / 1000000, timezone.utc),
+                                     song and song.song_name, song and song.artist_name,
+                                     song and song.featured_artist))
+    merged.sort(key=lambda row: row.stream_id, reverse=True)
+    return pagination.page(merged[:limit + 1], limit, lambda row: [row.stream_id], to_item)
+
+
+def status(engine=None):
+    """(attached partitions, archives) rows for the status command."""
+    with (engine or db.engine).begin() as connection:
+        return connection.execute(PARTITIONS).all(), connection.execute(ARCHIVES).all()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.partitions", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["ensure", "archive", "status"])
+    parser.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD)
+    parser.add_argument("--after-months", type=int, default=ARCHIVE_AFTER_MONTHS,
+                        help="archive partitions whose month ended at least this many months ago")
+    parser.add_argument("--dir", default=ARCHIVE_DIR)
+    args = parser.parse_args(argv)
+
+    if args.command == "ensure":
+        print(f"created {ensure(args.months_ahead)} partitions")
+        return 0
+    if args.command == "archive":
+        try:
+            archived = archive(args.after_months, args.dir)
+        except PartitionError as e:
+            print(f"error: {e}", file=sys.stderr)
+            return 1
+        print(f"archived {len(archived)} partitions" if archived else "nothing to archive")
+        return 0
+
+    attached, archives = status()
+    for row in attached:
+        print(f"{row.name}: ~{max(int(row.estimated_rows), 0)} rows, {row.bytes // 1048576} MiB")
+    for row in archives:
+        print(f"{row.partition_name}: archived {row.archived_at:%Y-%m-%d}, {row.row_count} rows in {row.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
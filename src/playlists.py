@@ -0,0 +1,177 @@
+"""Set-based playlist mutations by playlist_id and song IDs.
+
+Each batch is one statement against song_playlist, plus the co-occurrence
+upkeep from src/cooccurrence.py for the rows it actually changed:
+
+- add appends songs after the playlist's current last position, in the order
+  given. Songs already in the playlist and unknown song IDs are skipped, so
+  retrying a batch is harmless.
+- remove deletes whichever of the songs are in the playlist.
+- reorder moves the given songs to the front in the given order and keeps
+  the rest in their current order behind them. Only rows whose position
+  changes are written, so repeating a reorder writes nothing.
+
+Every statement also reports whether the playlist exists, so a missing
+playlist costs no extra round trip.
+
+    python -m src.playlists backfill     # number rows added before the position column
+"""
+import argparse
+import collections
+import os
+import sys
+
+import dotenv
+import sqlalchemy
+from fastapi import HTTPException
+
+from src import cooccurrence
+from src import database as db
+
+dotenv.load_dotenv()
+
+MAX_BATCH = int(os.environ.get("PLAYLIST_BATCH_MAX", "5000"))
+
+ADD_SONGS = sqlalchemy.text("""
+    WITH playlist AS (
+        SELECT user_playlist.playlist_id, user_playlist.user_id, user_playlist.playlist_name, users.username
+        FROM user_playlist
+        LEFT JOIN users ON users.user_id = user_playlist.user_id
+        WHERE user_playlist.playlist_id = :playlist_id
+    ),
+    wanted AS (
+        SELECT song_id, MIN(ord) AS ord
+        FROM unnest(CAST(:song_ids AS integer[])) WITH ORDINALITY AS t(song_id, ord)
+        GROUP BY song_id
+    ),
+    tail AS (
+        SELECT COALESCE(MAX(position), 0) AS last FROM song_playlist WHERE playlist_id = :playlist_id
+    ),
+    inserted AS (
+        INSERT INTO song_playlist (user_id, playlist_id, song_id, position)
+        SELECT playlist.user_id, playlist.playlist_id, song.song_id, tail.last + ROW_NUMBER() OVER (ORDER BY wanted.ord)
+        FROM playlist
+        CROSS JOIN tail
+        CROSS JOIN wanted
+        JOIN song ON song.song_id = wanted.song_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM song_playlist sp WHERE sp.playlist_id = playlist.playlist_id AND sp.song_id = wanted.song_id)
+        ORDER BY wanted.ord
+        ON CONFLICT (playlist_id, song_id) DO NOTHING
+        RETURNING playlist_id, song_id
+    )
+    SELECT playlist.playlist_name, playlist.username, inserted.song_id FROM playlist LEFT JOIN inserted ON true
+    """)
+
+REMOVE_SONGS = sqlalchemy.text("""
+    WITH playlist AS (
+        SELECT user_playlist.playlist_id, user_playlist.user_id, user_playlist.playlist_name, users.username
+        FROM user_playlist
+        LEFT JOIN users ON users.user_id = user_playlist.user_id
+        WHERE user_playlist.playlist_id = :playlist_id
+    ),
+    removed AS (
+        DELETE FROM song_playlist
+        WHERE playlist_id = :playlist_id AND song_id = ANY(CAST(:song_ids AS integer[]))
+        RETURNING playlist_id, song_id
+    )
+    SELECT playlist.playlist_name, playlist.username, removed.song_id FROM playlist LEFT JOIN removed ON true
+    """)
+
+REORDER_SONGS = sqlalchemy.text("""
+    WITH playlist AS (
+        SELECT user_playlist.playlist_id, user_playlist.user_id, user_playlist.playlist_name, users.username
+        FROM user_playlist
+        LEFT JOIN users ON users.user_id = user_playlist.user_id
+        WHERE user_playlist.playlist_id = :playlist_id
+    ),
+    wanted AS (
+        SELECT song_id, MIN(ord) AS ord
+        FROM unnest(CAST(:song_ids AS integer[])) WITH ORDINALITY AS t(song_id, ord)
+        GROUP BY song_id
+    ),
+    ranked AS (
+        SELECT sp.song_id,
+               ROW_NUMBER() OVER (ORDER BY wanted.ord NULLS LAST, sp.position, sp.created_at, sp.song_id) AS position
+        FROM song_playlist sp
+        LEFT JOIN wanted ON wanted.song_id = sp.song_id
+        WHERE sp.playlist_id = :playlist_id
+    ),
+    moved AS (
+        UPDATE song_playlist sp SET position = ranked.position
+        FROM ranked
+        WHERE sp.playlist_id = :playlist_id AND sp.song_id = ranked.song_id
+          AND sp.position IS DISTINCT FROM ranked.position
+        RETURNING sp.song_id
+    )
+    SELECT playlist.playlist_name, playlist.username, moved.song_id FROM playlist LEFT JOIN moved ON true
+    """)
+
+BACKFILL_POSITIONS = sqlalchemy.text("""
+    WITH ranked AS (
+        SELECT playlist_id, song_id,
+               ROW_NUMBER() OVER (PARTITION BY playlist_id ORDER BY position NULLS LAST, created_at, song_id) AS position
+        FROM song_playlist
+        WHERE playlist_id IN (SELECT DISTINCT playlist_id FROM song_playlist WHERE position IS NULL)
+    )
+    UPDATE song_playlist sp SET position = ranked.position
+    FROM ranked
+    WHERE sp.playlist_id = ranked.playlist_id AND sp.song_id = ranked.song_id
+      AND sp.position IS DISTINCT FROM ranked.position
+    """)
+
+
+Change = collections.namedtuple("Change", ["playlist_name", "username", "song_ids"])
+
+
+def check_batch(song_ids):
+    """Reject batches over MAX_BATCH with a 413."""
+    if len(song_ids) > MAX_BATCH:
+        raise HTTPException(status_code=413, detail=f"at most {MAX_BATCH} song_ids per request")
+    return song_ids
+
+
+def _mutate(connection, statement, playlist_id, song_ids):
+    rows = connection.execute(statement, {"playlist_id": playlist_id, "song_ids": song_ids}).all()
+    if not rows:
+        return None
+    return Change(rows[0].playlist_name, rows[0].username, [row.song_id for row in rows if row.song_id is not None])
+
+
+def add_songs(connection, playlist_id, song_ids):
+    """Append song_ids to the playlist. Returns a Change of the added IDs, or None if the playlist doesn't exist."""
+    change = _mutate(connection, ADD_SONGS, playlist_id, song_ids)
+    if change is not None:
+        cooccurrence.songs_added(connection, [(playlist_id, song_id) for song_id in change.song_ids])
+    return change
+
+
+def remove_songs(connection, playlist_id, song_ids):
+    """Remove song_ids from the playlist. Returns a Change of the removed IDs, or None if the playlist doesn't exist."""
+    change = _mutate(connection, REMOVE_SONGS, playlist_id, song_ids)
+    if change is not None:
+        cooccurrence.songs_removed(connection, [(playlist_id, song_id) for song_id in change.song_ids])
+    return change
+
+
+def reorder_songs(connection, playlist_id, song_ids):
+    """Move song_ids to the front in order. Returns a Change of the moved IDs, or None if the playlist doesn't exist."""
+    return _mutate(connection, REORDER_SONGS, playlist_id, song_ids)
+
+
+def backfill_positions():
+    """Number rows without a position after the playlist's positioned rows, oldest first."""
+    with db.engine.begin() as connection:
+        return connection.execute(BACKFILL_POSITIONS).rowcount
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.playlists", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["backfill"])
+    parser.parse_args(argv)
+    print(f"positioned {backfill_positions()} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,301 @@
+"""One statement per lookup-then-fetch read endpoint.
+
+Each statement resolves the names in a request and fetches what they point
+at in the same round trip. The lookups are LEFT JOIN LATERALs off a one-row
+FROM, and the fetch is one more, so a statement always returns at least one
+row and its first row tells the cases apart: a NULL lookup column means that
+name doesn't exist, a NULL item column means it exists but has nothing to
+list. Listings filter on their sort key like src/pagination.py statements
+and end in LIMIT :limit.
+
+The statements are module-level text() constructs, so SQLAlchemy compiles
+each once and reuses it; on the async backend asyncpg also keeps them
+prepared per connection. Callers run them on the autocommit connections
+from replicas.read(), which skip BEGIN and COMMIT.
+"""
+import itertools
+import json
+
+import sqlalchemy
+from fastapi.responses import StreamingResponse
+
+from src import pagination
+
+
+class Query:
+    """A statement plus the lookup columns that report a missing name, checked in order."""
+
+    __slots__ = ("statement", "lookups", "item")
+
+    def __init__(self, sql, lookups, item):
+        self.statement = sqlalchemy.text(sql)
+        self.lookups = lookups
+        self.item = item
+
+    def missing(self, row):
+        """The not-found message for a result whose first row is row, or None."""
+        if row is None:
+            return self.lookups[0][1]
+        for column, message in self.lookups:
+            if row._mapping[column] is None:
+                return message
+        return None
+
+    def items(self, rows):
+        return [row for row in rows if row._mapping[self.item] is not None]
+
+
+SONG_INFO = Query("""
+    SELECT song.song_name, song.featured_artist, song.explicit_rating, song.length
+    FROM song
+    JOIN artist ON artist.id = song.artist_id
+    WHERE song.song_name = :song_name AND artist.artist_name = :artist_name
+    LIMIT 1""", [("song_name", "Song does not exist by this Artist!")], "song_name")
+
+ALBUM_INFO = Query("""
+    SELECT album.id, artist.artist_name, album.album_name, album.genre, album.explicit_rating, album.label,
+           album.release_date
+    FROM album
+    JOIN artist ON artist.id = album.artist_id
+    WHERE album.album_name = :album_name
+    LIMIT 1""", [("id", "Album does not exist!")], "id")
+
+ARTIST_ALBUMS = Query("""
+    SELECT artist.id AS artist_id, albums.id, albums.album_name
+    FROM (SELECT 1) AS request
+    LEFT JOIN LATERAL (SELECT id FROM artist WHERE artist_name = :artist_name LIMIT 1) AS artist ON true
+    LEFT JOIN LATERAL (
+        SELECT id, album_name FROM album
+        WHERE artist_id = artist.id AND (CAST(:after_id AS integer) IS NULL OR id > :after_id)
+        ORDER BY id
+        LIMIT :limit
+    ) AS albums ON true
+    ORDER BY albums.id""", [("artist_id", "Artist does not exist!")], "id")
+
+ALBUM_SONGS = Query("""
+    SELECT album.id AS album_id, songs.song_id, songs.song_name
+    FROM (SELECT 1) AS request
+    LEFT JOIN LATERAL (SELECT id FROM album WHERE album_name = :album_name LIMIT 1) AS album ON true
+    LEFT JOIN LATERAL (
+        SELECT song_id, song_name FROM song
+        WHERE album_id = album.id AND (CAST(:after_id AS integer) IS NULL OR song_id > :after_id)
+        ORDER BY song_id
+        LIMIT :limit
+    ) AS songs ON true
+    ORDER BY songs.song_id""", [("album_id", "Album does not exist!")], "song_id")
+
+USER_STREAMS = Query("""
+    SELECT listener.user_id, plays.stream_id, plays.created_at, plays.song_name, plays.artist_name,
+           plays.featured_artist
+    FROM (SELECT 1) AS request
+    LEFT JOIN LATERAL (SELECT user_id FROM users WHERE username = :username LIMIT 1) AS listener ON true
+    LEFT JOIN LATERAL (
+        SELECT streams.stream_id, streams.created_at, song.song_name, artist.artist_name, song.featured_artist
+        FROM streams
+        JOIN song on streams.song_id = song.song_id
+        JOIN artist on artist.id = song.artist_id
+        WHERE streams.user_id = listener.user_id
+        AND (CAST(:after_id AS bigint) IS NULL OR streams.stream_id < :after_id)
+        ORDER BY streams.stream_id DESC
+        LIMIT :limit
+    ) AS plays ON true
+    ORDER BY plays.stream_id DESC""", [("user_id", "User does not exist!")], "stream_id")
+
+USER_ARTIST_STREAMS = Query("""
+    SELECT listener.user_id, performer.id AS artist_id, plays.stream_id, plays.created_at, plays.song_name
+    FROM (SELECT 1) AS request
+    LEFT JOIN LATERAL (SELECT user_id FROM users WHERE username = :username LIMIT 1) AS listener ON true
+    LEFT JOIN LATERAL (SELECT id FROM artist WHERE artist_name = :artist_name LIMIT 1) AS performer ON true
+    LEFT JOIN LATERAL (
+        SELECT streams.stream_id, streams.created_at, song.song_name FROM streams
+        JOIN song on streams.song_id = song.song_id
+        WHERE streams.user_id = listener.user_id AND song.artist_id = performer.id
+        AND (CAST(:after_id AS bigint) IS NULL OR streams.stream_id < :after_id)
+        ORDER BY streams.stream_id DESC
+        LIMIT :limit
+    ) AS plays ON true
+    ORDER BY plays.stream_id DESC""",
+    [("user_id", "User doesn't exist!"), ("artist_id", "Artist doesn't exist!")], "stream_id")
+
+PLAYLIST_SONGS = Query("""
+    SELECT owner.user_id, playlist.playlist_id, entries.position, entries.created_at, entries.song_id,
+           entries.song_name
+    FROM (SELECT 1) AS request
+    LEFT JOIN LATERAL (SELECT user_id FROM users WHERE username = :username LIMIT 1) AS owner ON true
+    LEFT JOIN LATERAL (
+        SELECT playlist_id FROM user_playlist
+        WHERE user_id = owner.user_id AND playlist_name = :playlist_name
+        LIMIT 1
+    ) AS playlist ON true
+    LEFT JOIN LATERAL (
+        -- Rows not yet numbered by python -m src.playlists backfill sort last and still give the cursor a key.
+        SELECT COALESCE(song_playlist.position, 2147483647) AS position, song_playlist.created_at, song.song_id,
+               song.song_name
+        FROM song_playlist
+        JOIN song on song.song_id = song_playlist.song_id
+        WHERE song_playlist.playlist_id = playlist.playlist_id
+        AND (CAST(:after_position AS integer) IS NULL
+             OR (COALESCE(song_playlist.position, 2147483647), song_playlist.song_id) > (:after_position, :after_id))
+        ORDER BY COALESCE(song_playlist.position, 2147483647), song_playlist.song_id
+        LIMIT :limit
+    ) AS entries ON true
+    ORDER BY entries.position, entries.song_id""",
+    [("user_id", "User does not exist!"), ("playlist_id", "Playlist does not exist!")], "song_id")
+
+USER_TOP_ARTISTS = Query("""
+    SELECT listener.user_id, top.artist_name, top.play_count, top.first_played_at, top.last_played_at
+    FROM (SELECT 1) AS request
+    LEFT JOIN LATERAL (SELECT user_id FROM users WHERE username = :username LIMIT 1) AS listener ON true
+    LEFT JOIN LATERAL (
+        SELECT artist.artist_name, plays.play_count, plays.first_played_at, plays.last_played_at
+        FROM user_artist_plays plays
+        JOIN artist ON artist.id = plays.artist_id
+        WHERE plays.user_id = listener.user_id
+        ORDER BY plays.play_count DESC, plays.artist_id
+        LIMIT :limit
+    ) AS top ON true
+    ORDER BY top.play_count DESC""", [("user_id", "User does not exist!")], "artist_name")
+
+USER_TOP_SONGS = Query("""
+    SELECT listener.user_id, top.song_name, top.artist_name, top.play_count, top.first_played_at, top.last_played_at
+    FROM (SELECT 1) AS request
+    LEFT JOIN LATERAL (SELECT user_id FROM users WHERE username = :username LIMIT 1) AS listener ON true
+    LEFT JOIN LATERAL (
+        SELECT song.song_name, artist.artist_name, plays.play_count, plays.first_played_at, plays.last_played_at
+        FROM user_song_plays plays
+        JOIN song ON song.song_id = plays.song_id
+        JOIN artist ON artist.id = song.artist_id
+        WHERE plays.user_id = listener.user_id
+        ORDER BY plays.play_count DESC, plays.song_id
+        LIMIT :limit
+    ) AS top ON true
+    ORDER BY top.play_count DESC""", [("user_id", "User does not exist!")], "song_name")
+
+USER_ARTIST_PLAYS = Query("""
+    SELECT listener.user_id, performer.id AS artist_id, COALESCE(plays.play_count, 0) AS play_count,
+           plays.first_played_at, plays.last_played_at
+    FROM (SELECT 1) AS request
+    LEFT JOIN LATERAL (SELECT user_id FROM users WHERE username = :username LIMIT 1) AS listener ON true
+    LEFT JOIN LATERAL (SELECT id FROM artist WHERE artist_name = :artist_name LIMIT 1) AS performer ON true
+    LEFT JOIN user_artist_plays plays ON plays.user_id = listener.user_id AND plays.artist_id = performer.id""",
+    [("user_id", "User doesn't exist!"), ("artist_id", "Artist doesn't exist!")], "artist_id")
+
+
+# Songs nobody has voted on fall back to the catalog's explicit_rating.
+CLEAN_PLAYLIST_SONGS = Query("""
+    SELECT playlist.playlist_id, clean.song_name
+    FROM (SELECT 1) AS request
+    LEFT JOIN LATERAL (SELECT playlist_id FROM user_playlist WHERE playlist_name = :playlist_name LIMIT 1) AS playlist ON true
+    LEFT JOIN LATERAL (
+        SELECT song.song_name, song_playlist.position, song_playlist.song_id
+        FROM song_playlist
+        JOIN song on song.song_id = song_playlist.song_id
+        LEFT JOIN song_explicit_scores scores on scores.song_id = song_playlist.song_id
+        WHERE song_playlist.playlist_id = playlist.playlist_id
+        AND COALESCE(CAST(scores.explicit_votes AS float) / NULLIF(scores.votes, 0), song.explicit_rating, 0) < :threshold
+    ) AS clean ON true
+    ORDER BY clean.position, clean.song_id""", [("playlist_id", "Playlist doesn't exist")], "song_name")
+
+# cooccurrence.RECOMMEND for the playlist named :playlist_name.
+PLAYLIST_RECOMMEND = Query("""
+    SELECT playlist.playlist_id, picks.song_id, picks.song_name, picks.album_name, picks.artist_name
+    FROM (SELECT 1) AS request
+    LEFT JOIN LATERAL (SELECT playlist_id FROM user_playlist WHERE playlist_name = :playlist_name LIMIT 1) AS playlist ON true
+    LEFT JOIN LATERAL (
+        SELECT scored.song_id, s.song_name, al.album_name, art.artist_name, scored.score
+        FROM (
+            SELECT c.neighbor_id AS song_id, SUM(c.weight) AS score
+            FROM song_cooccurrence c
+            WHERE c.song_id IN (SELECT song_id FROM song_playlist WHERE playlist_id = playlist.playlist_id)
+              AND c.neighbor_id NOT IN (SELECT song_id FROM song_playlist WHERE playlist_id = playlist.playlist_id)
+            GROUP BY c.neighbor_id
+            ORDER BY score DESC
+            LIMIT :limit
+        ) AS scored
+        JOIN song AS s ON s.song_id = scored.song_id
+        JOIN album AS al ON s.album_id = al.id
+        JOIN artist AS art ON s.artist_id = art.id
+    ) AS picks ON true
+    ORDER BY picks.score DESC""", [("playlist_id", "Playlist doesn't exist")], "song_id")
+
+
+def fetch(connection, query, params):
+    """(not-found message or None, item rows) for a non-listing query."""
+    rows = connection.execute(query.statement, params).all()
+    return query.missing(rows[0] if rows else None), query.items(rows)
+
+
+async def fetch_async(connection, query, params):
+    rows = (await connection.execute(query.statement, params)).all()
+    return query.missing(rows[0] if rows else None), query.items(rows)
+
+
+def _lines(query, first, rows, to_item):
+    for row in itertools.chain([first], rows):
+        if row._mapping[query.item] is not None:
+            yield json.dumps(to_item(row), default=str) + "\n"
+
+
+def listing(connection, query, params, after, key_of, to_item, cursor=None, limit=pagination.DEFAULT_PAGE_SIZE,
+            stream=False):
+    """A page of query's items, its not-found message, or with stream=True every item as NDJSON."""
+    params = pagination.bind(params, after, cursor, limit)
+    if not stream:
+        rows = connection.execute(query.statement, {**params, "limit": limit + 1}).all()
+        message = query.missing(rows[0] if rows else None)
+        return message if message is not None else pagination.page(query.items(rows), limit, key_of, to_item)
+
+    # Server-side cursors need a transaction, so streams get their own connection.
+    stream_connection = connection.engine.connect()
+    try:
+        result = stream_connection.execution_options(
+            stream_results=True, yield_per=pagination.STREAM_FETCH_ROWS).execute(query.statement,
+                                                                                {**params, "limit": None})
+        first = result.fetchone()
+        message = query.missing(first)
+    except BaseException:
+        stream_connection.close()
+        raise
+    if message is not None:
+        stream_connection.close()
+        return message
+
+    def lines():
+        with stream_connection:
+            yield from _lines(query, first, result, to_item)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+async def listing_async(connection, query, params, after, key_of, to_item, cursor=None,
+                        limit=pagination.DEFAULT_PAGE_SIZE, stream=False):
+    """listing on an async connection."""
+    params = pagination.bind(params, after, cursor, limit)
+    if not stream:
+        rows = (await connection.execute(query.statement, {**params, "limit": limit + 1})).all()
+        message = query.missing(rows[0] if rows else None)
+        return message if message is not None else pagination.page(query.items(rows), limit, key_of, to_item)
+
+    stream_connection = await connection.engine.connect().start()
+    try:
+        result = await stream_connection.stream(query.statement, {**params, "limit": None})
+        first = await result.fetchone()
+        message = query.missing(first)
+    except BaseException:
+        await stream_connection.close()
+        raise
+    if message is not None:
+        await stream_connection.close()
+        return message
+
+    async def lines():
+        try:
+            if first._mapping[query.item] is not None:
+                yield json.dumps(to_item(first), default=str) + "\n"
+            async for row in result:
+                if row._mapping[query.item] is not None:
+                    yield json.dumps(to_item(row), default=str) + "\n"
+        finally:
+            await stream_connection.close()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
@@ -0,0 +1,218 @@
+"""Route read-only handlers to read replicas.
+
+database.py builds an engine per POSTGRES_REPLICA_URIS entry. read() hands out
+a connection on the next healthy replica in round-robin order, or on the
+primary when there are no replicas, none are healthy, or the username passed
+in wrote something within the last READ_YOUR_WRITES_SECONDS (0, the default,
+turns that window off). A background thread runs REPLAY_LAG on every replica
+each REPLICA_CHECK_INTERVAL seconds; a replica that fails the check, lags more
+than REPLICA_MAX_LAG seconds or refuses a connection is skipped until a later
+check passes.
+
+    python -m src.replicas status
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+import dotenv
+import sqlalchemy
+from sqlalchemy.exc import DBAPIError
+
+from src import database as db
+from src.cache import TTLCache
+
+dotenv.load_dotenv()
+
+CHECK_INTERVAL = float(os.environ.get("REPLICA_CHECK_INTERVAL", "5"))
+MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", "10"))
+READ_YOUR_WRITES = float(os.environ.get("READ_YOUR_WRITES_SECONDS", "0"))
+RECENT_WRITERS = 100000
+
+# Seconds the replica is behind. A replica that has replayed everything it
+# received counts as current even if the primary has been idle, and a server
+# that isn't in recovery (a plain second instance) reports 0.
+REPLAY_LAG = sqlalchemy.text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+    """)
+
+
+class Replica:
+    __slots__ = ("name", "engine", "async_engine", "healthy", "lag", "reads", "failures", "last_error")
+
+    def __init__(self, name, engine, async_engine=None):
+        self.name = name
+        self.engine = engine
+        self.async_engine = async_engine
+        self.healthy = True
+        self.lag = 0.0
+        self.reads = 0
+        self.failures = 0
+        self.last_error = None
+
+
+class ReplicaSet:
+    """Healthy-replica round robin with primary fallback and a per-user read-your-writes window."""
+
+    def __init__(self, engines, async_engines=(), check_interval=CHECK_INTERVAL, max_lag=MAX_LAG,
+                 read_your_writes=READ_YOUR_WRITES):
+        async_engines = list(async_engines) + [None] * (len(engines) - len(async_engines))
+        self.replicas = [Replica(f"replica{i}", engine, async_engine)
+                         for i, (engine, async_engine) in enumerate(zip(engines, async_engines))]
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self._writers = TTLCache(RECENT_WRITERS, read_your_writes) if read_your_writes > 0 else None
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._worker = None
+        self._stats = {"primary_reads": 0, "replica_reads": 0, "pinned_reads": 0, "fallbacks": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def wrote(self, *usernames):
+        """Pin these users' reads to the primary for the read-your-writes window."""
+        if self._writers is not None:
+            for username in usernames:
+                self._writers.put(username, True)
+
+    def pick(self, username=None):
+        """The replica to read from, or None for the primary."""
+        if self._writers is not None and username is not None and self._writers.get(username, None):
+            self._count("pinned_reads")
+            return None
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._next) % len(healthy)]
+
+    def mark_down(self, replica, error):
+        with self._lock:
+            replica.healthy = False
+            replica.failures += 1
+            replica.last_error = str(error).splitlines()[0][:200]
+
+    def check(self, replica):
+        try:
+            with replica.engine.connect() as connection:
+                lag = float(connection.execute(REPLAY_LAG).scalar())
+        except DBAPIError as e:
+            self.mark_down(replica, e)
+            return
+        with self._lock:
+            replica.lag = lag
+            replica.healthy = lag <= self.max_lag
+            if not replica.healthy:
+                replica.last_error = f"replay lag {lag:.1f}s"
+
+    def check_all(self):
+        for replica in self.replicas:
+            self.check(replica)
+
+    def start(self):
+        """Start the health-check worker if there are replicas to watch."""
+        with self._lock:
+            if not self.replicas or (self._worker is not None and self._worker.is_alive()):
+                return
+            self._stopping.clear()
+            self._worker = threading.Thread(target=self._run, name="replica-health", daemon=True)
+            self._worker.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self.check_all()
+            self._stopping.wait(self.check_interval)
+
+    def _opened(self, replica):
+        with self._lock:
+            self._stats["replica_reads"] += 1
+            replica.reads += 1
+
+    @contextlib.contextmanager
+    def read(self, username=None):
+        """An autocommit connection on a replica, or on the primary when none will do."""
+        replica = self.pick(username)
+        connection = None
+        if replica is not None:
+            try:
+                connection = replica.engine.connect()
+                self._opened(replica)
+            except DBAPIError as e:
+                self.mark_down(replica, e)
+                self._count("fallbacks")
+        if connection is None:
+            self._count("primary_reads")
+            connection = db.engine.connect()
+        # Reads need no transaction; autocommit saves the BEGIN and COMMIT round trips.
+        with connection.execution_options(isolation_level="AUTOCOMMIT"):
+            yield connection
+
+    @contextlib.asynccontextmanager
+    async def read_async(self, username=None):
+        """read() on the async engines."""
+        replica = self.pick(username)
+        connection = None
+        if replica is not None and replica.async_engine is not None:
+            try:
+                connection = await replica.async_engine.connect().start()
+                self._opened(replica)
+            except DBAPIError as e:
+                self.mark_down(replica, e)
+                self._count("fallbacks")
+        if connection is None:
+            self._count("primary_reads")
+            connection = await db.async_engine.connect().start()
+        try:
+            await connection.execution_options(isolation_level="AUTOCOMMIT")
+            yield connection
+        finally:
+            await connection.close()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            replicas = {replica.name: {"healthy": int(replica.healthy), "lag_seconds": replica.lag,
+                                       "reads": replica.reads, "failures": replica.failures}
+                        for replica in self.replicas}
+        return {**stats, "replicas": replicas}
+
+    def status(self):
+        """Per-replica health including the last error, for the CLI."""
+        with self._lock:
+            return [{"name": replica.name, "url": replica.engine.url.render_as_string(hide_password=True),
+                     "healthy": replica.healthy, "lag_seconds": replica.lag, "last_error": replica.last_error}
+                    for replica in self.replicas]
+
+
+replicas = ReplicaSet(db.replica_engines, db.async_replica_engines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.replicas", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["status"])
+    parser.parse_args(argv)
+
+    started = time.perf_counter()
+    replicas.check_all()
+    print(json.dumps({"checked_in_ms": round((time.perf_counter() - started) * 1000, 2),
+                      "replicas": replicas.status()}, indent=2))
+    return 0 if all(replica.healthy for replica in replicas.replicas) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""Process-wide name-to-ID cache for users, artists, albums, songs and playlists.
+
+Most musicmain handlers start by turning names into IDs. The resolver keeps
+those answers in bounded LRU caches, including "no such name" answers for a
+shorter time, so a warm request goes straight to the query that does the
+work. Handlers that create users, artists, albums, songs or playlists must
+call the matching forget_* so a cached miss doesn't hide the new row.
+"""
+import os
+
+import dotenv
+import sqlalchemy
+
+from src.cache import MISSING, TTLCache
+
+dotenv.load_dotenv()
+
+CACHE_SIZE = int(os.environ.get("RESOLVER_CACHE_SIZE", "100000"))
+CACHE_TTL = float(os.environ.get("RESOLVER_CACHE_TTL", "600"))
+NEGATIVE_TTL = float(os.environ.get("RESOLVER_NEGATIVE_TTL", "30"))
+
+USER_ID = sqlalchemy.text("SELECT user_id FROM users WHERE username = :name")
+ARTIST_ID = sqlalchemy.text("SELECT id FROM artist WHERE artist_name = :name")
+ALBUM_ID = sqlalchemy.text("SELECT id FROM album WHERE album_name = :name")
+PLAYLIST_ID = sqlalchemy.text("SELECT playlist_id FROM user_playlist WHERE user_id = :user_id AND playlist_name = :name")
+SONG_ID = sqlalchemy.text("SELECT song_id FROM song JOIN artist ON artist.id = song.artist_id WHERE song_name = :name AND artist_name = :artist_name")
+
+
+class Resolver:
+    """Cached user, artist, album, (song, artist) and (user ID, playlist) lookups."""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL, negative_ttl=NEGATIVE_TTL):
+        self.negative_ttl = negative_ttl
+        self.users = TTLCache(maxsize, ttl)
+        self.artists = TTLCache(maxsize, ttl)
+        self.albums = TTLCache(maxsize, ttl)
+        self.songs = TTLCache(maxsize, ttl)
+        self.playlists = TTLCache(maxsize, ttl)
+
+    def remember(self, cache, key, value):
+        cache.put(key, value, ttl=self.negative_ttl if value is None else None)
+
+    def _resolve(self, cache, key, connection, statement, params):
+        value = cache.get(key)
+        if value is MISSING:
+            value = connection.execute(statement, params).scalar()
+            self.remember(cache, key, value)
+        return value
+
+    def user_id(self, connection, username):
+        return self._resolve(self.users, username, connection, USER_ID, {"name": username})
+
+    def artist_id(self, connection, artist_name):
+        return self._resolve(self.artists, artist_name, connection, ARTIST_ID, {"name": artist_name})
+
+    def album_id(self, connection, album_name):
+        return self._resolve(self.albums, album_name, connection, ALBUM_ID, {"name": album_name})
+
+    def song_id(self, connection, song_name, artist_name):
+        return self._resolve(self.songs, (song_name, artist_name), connection, SONG_ID,
+                             {"name": song_name, "artist_name": artist_name})
+
+    def playlist_id(self, connection, user_id, playlist_name):
+        return self._resolve(self.playlists, (user_id, playlist_name), connection, PLAYLIST_ID,
+                             {"user_id": user_id, "name": playlist_name})
+
+    async def _resolve_async(self, cache, key, connection, statement, params):
+        value = cache.get(key)
+        if value is MISSING:
+            value = (await connection.execute(statement, params)).scalar()
+            self.remember(cache, key, value)
+        return value
+
+    async def user_id_async(self, connection, username):
+        return await self._resolve_async(self.users, username, connection, USER_ID, {"name": username})
+
+    async def artist_id_async(self, connection, artist_name):
+        return await self._resolve_async(self.artists, artist_name, connection, ARTIST_ID, {"name": artist_name})
+
+    async def album_id_async(self, connection, album_name):
+        return await self._resolve_async(self.albums, album_name, connection, ALBUM_ID, {"name": album_name})
+
+    async def song_id_async(self, connection, song_name, artist_name):
+        return await self._resolve_async(self.songs, (song_name, artist_name), connection, SONG_ID,
+                                         {"name": song_name, "artist_name": artist_name})
+
+    async def playlist_id_async(self, connection, user_id, playlist_name):
+        return await self._resolve_async(self.playlists, (user_id, playlist_name), connection, PLAYLIST_ID,
+                                         {"user_id": user_id, "name": playlist_name})
+
+    def forget_user(self, username):
+        self.users.pop(username)
+
+    def forget_artist(self, artist_name):
+        self.artists.pop(artist_name)
+
+    def forget_album(self, album_name):
+        self.albums.pop(album_name)
+
+    def forget_song(self, song_name, artist_name):
+        self.songs.pop((song_name, artist_name))
+
+    def forget_playlist(self, user_id, playlist_name):
+        self.playlists.pop((user_id, playlist_name))
+
+    def metrics(self):
+        return {
+            "users": self.users.metrics(),
+            "artists": self.artists.metrics(),
+            "albums": self.albums.metrics(),
+            "songs": self.songs.metrics(),
+            "playlists": self.playlists.metrics(),
+        }
+
+
+resolver = Resolver()
@@ -0,0 +1,217 @@
+"""Response cache for catalog reads, with tag invalidation and ETags.
+
+@cached("artist:{artist_name}") on a route handler stores its JSON response
+keyed by route and parameters. Each tag is formatted from the handler's
+arguments and carries a generation number that is part of the key;
+invalidate() bumps a tag's generation, so every response cached under the
+old one is never looked up again and ages out of the backend. Writers call
+invalidate() for what they changed: artist:<name>, album:<name> and
+playlist:<name>.
+
+Responses carry an ETag; a request whose If-None-Match matches it gets an
+empty 304. Handler return values that are already Responses (NDJSON
+streams) and raised HTTPExceptions are passed through uncached.
+
+RESPONSE_CACHE picks the backend: "memory" (default, per process), "redis"
+(RESPONSE_CACHE_URL, shared by every worker, needs the redis package) or
+"off".
+"""
+import functools
+import hashlib
+import inspect
+import json
+import os
+import threading
+
+import dotenv
+from fastapi import Header
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+
+from src.cache import MISSING, TTLCache
+
+dotenv.load_dotenv()
+
+BACKEND = os.environ.get("RESPONSE_CACHE", "memory").lower()
+URL = os.environ.get("RESPONSE_CACHE_URL", "redis://localhost:6379/0")
+CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "10000"))
+CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "300"))
+# top_streams changes with every play, so it is only ever refreshed by expiry.
+TOP_STREAMS_TTL = float(os.environ.get("TOP_STREAMS_CACHE_TTL", "10"))
+KEY_PREFIX = "musicmain:response:"
+
+
+class MemoryBackend:
+    blocking = False
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.entries = TTLCache(maxsize, ttl)
+        # Bounded like the entries. Generations come from one counter that only
+        # grows, so a tag evicted here comes back at the counter's current value:
+        # the same one it had if nothing was invalidated since, a value no older
+        # entry is keyed under otherwise.
+        self.generations = TTLCache(maxsize, ttl)
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def generation(self, tags):
+        with self._lock:
+            generations = []
+            for tag in tags:
+                value = self.generations.get(tag)
+                if value is MISSING:
+                    value = self._counter
+                    self.generations.put(tag, value)
+                generations.append(value)
+            return generations
+
+    def bump(self, tags):
+        with self._lock:
+            self._counter += 1
+            for tag in tags:
+                self.generations.put(tag, self._counter)
+
+    def get(self, key):
+        return self.entries.get(key, None)
+
+    def put(self, key, entry, ttl):
+        self.entries.put(key, entry, ttl)
+
+    def metrics(self):
+        return {**self.entries.metrics(), "tags": len(self.generations)}
+
+
+class RedisBackend:
+    blocking = True
+
+    def __init__(self, url=URL, ttl=CACHE_TTL):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.errors = redis.RedisError
+        self.ttl = ttl
+        self._stats = {"hits": 0, "misses": 0, "errors": 0}
+
+    def generation(self, tags):
+        try:
+            return [int(value or 0) for value in self.client.mget([KEY_PREFIX + "tag:" + tag for tag in tags])]
+        except self.errors:
+            self._stats["errors"] += 1
+            return None
+
+    def bump(self, tags):
+        try:
+            with self.client.pipeline(transaction=False) as pipe:
+                for tag in tags:
+                    pipe.incr(KEY_PREFIX + "tag:" + tag)
+                pipe.execute()
+        except self.errors:
+            self._stats["errors"] += 1
+
+    def get(self, key):
+        try:
+            value = self.client.get(KEY_PREFIX + key)
+        except self.errors:
+            self._stats["errors"] += 1
+            return None
+        self._stats["hits" if value is not None else "misses"] += 1
+        if value is None:
+            return None
+        etag, _, body = value.partition(b"\n")
+        return etag.decode(), body
+
+    def put(self, key, entry, ttl):
+        etag, body = entry
+        try:
+            self.client.set(KEY_PREFIX + key, etag.encode() + b"\n" + body, ex=max(1, int(ttl or self.ttl)))
+        except self.errors:
+            self._stats["errors"] += 1
+
+    def metrics(self):
+        return dict(self._stats)
+
+
+class ResponseCache:
+    """Tag-invalidated cache of serialized route responses."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._stats = {"not_modified": 0, "invalidations": 0}
+
+    def invalidate(self, *tags):
+        if self.backend is not None and tags:
+            self.backend.bump(tags)
+            self._stats["invalidations"] += len(tags)
+
+    def _key(self, route, arguments, tags):
+        generations = self.backend.generation(tags)
+        if generations is None:
+            return None
+        raw = json.dumps([route, arguments, generations], sort_keys=True, default=str)
+        return route + ":" + hashlib.sha1(raw.encode()).hexdigest()
+
+    def _lookup(self, route, arguments, tags):
+        key = self._key(route, arguments, tags)
+        return key, (self.backend.get(key) if key is not None else None)
+
+    async def _call(self, function, *args):
+        if self.backend.blocking:
+            return await run_in_threadpool(function, *args)
+        return function(*args)
+
+    def _respond(self, etag, body, if_none_match, max_age):
+        headers = {"ETag": etag, "Cache-Control": f"private, max-age={int(max_age)}"}
+        if if_none_match is not None and etag in (tag.strip() for tag in if_none_match.split(",")):
+            self._stats["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def cached(self, *tags, ttl=None):
+        """Cache a route handler's response under the given tag templates."""
+        def decorate(handler):
+            if self.backend is None:
+                return handler
+            signature = inspect.signature(handler)
+            is_async = inspect.iscoroutinefunction(handler)
+            max_age = CACHE_TTL if ttl is None else ttl
+
+            @functools.wraps(handler)
+            async def endpoint(*args, if_none_match=None, **kwargs):
+                arguments = signature.bind(*args, **kwargs).arguments
+                route_tags = [tag.format(**arguments) for tag in tags]
+                key, entry = await self._call(self._lookup, handler.__name__, arguments, route_tags)
+                if entry is None:
+                    result = await handler(**arguments) if is_async else await run_in_threadpool(handler, **arguments)
+                    if isinstance(result, Response):
+                        return result
+                    body = json.dumps(jsonable_encoder(result), ensure_ascii=False, separators=(",", ":")).encode()
+                    entry = ('"' + hashlib.sha1(body).hexdigest() + '"', body)
+                    if key is not None:
+                        await self._call(self.backend.put, key, entry, ttl)
+                return self._respond(*entry, if_none_match, max_age)
+
+            endpoint.__signature__ = signature.replace(parameters=[
+                *signature.parameters.values(),
+                inspect.Parameter("if_none_match", inspect.Parameter.KEYWORD_ONLY, default=Header(None), annotation=str),
+            ])
+            return endpoint
+        return decorate
+
+    def metrics(self):
+        if self.backend is None:
+            return {}
+        return {**self._stats, **self.backend.metrics()}
+
+
+def _backend():
+    if BACKEND == "off":
+        return None
+    if BACKEND == "redis":
+        return RedisBackend()
+    return MemoryBackend()
+
+
+response_cache = ResponseCache(_backend())
+cached = response_cache.cached
+invalidate = response_cache.invalidate
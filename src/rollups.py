@@ -0,0 +1,355 @@
+"""Aggregates maintained alongside their raw tables so reads don't rescan them.
+
+stream_ingest.INSERT_STREAMS keeps the play counts and the per-user
+listening profiles (user_song_plays and user_artist_plays: play count, first
+and last play per user and song or artist) current on every insert, and
+musicmain.SUBMIT_RATING does the same for song_explicit_scores, the per-song
+vote count and explicit-vote sum behind get_clean_songs. This module
+rebuilds them from scratch, checks them against the raw tables and compacts
+the time buckets behind the trending charts:
+
+    python -m src.rollups rebuild
+    python -m src.rollups backfill --workers 4   # only the per-user profiles
+    python -m src.rollups check
+    python -m src.rollups compact
+
+The per-user profiles are rebuilt in chunks of USER_PLAYS_CHUNK users, in
+parallel. Each chunk locks its users' rows FOR UPDATE, in user_id order,
+before touching their rollup rows. INSERT_STREAMS takes FOR KEY SHARE on its
+plays' users, in the same order, before it writes any rollup row. Plays for
+a chunk's users therefore wait until the chunk commits and land on top of
+the recount instead of in it. Because both sides lock in the same order,
+they can't deadlock.
+
+Counts are lifetime totals: plays in partitions archived by src/partitions.py
+are read back from their per user and song totals in streams_archived_plays.
+
+Plays land in hourly buckets. compact (run it from cron, hourly is plenty)
+folds hourly buckets older than HOURLY_RETENTION_HOURS into daily buckets and
+drops daily buckets older than DAILY_RETENTION_DAYS, so a window query only
+ever sums a bounded number of buckets no matter how long streams grows.
+TOP_SONGS_IN_WINDOW counts whole days where only daily buckets are left: the
+day a window starts in is included in full, so a window reaching past
+HOURLY_RETENTION_HOURS can count up to 23 hours of plays before its start
+rather than miss them.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import dotenv
+import sqlalchemy
+
+from src import database as db
+
+dotenv.load_dotenv()
+
+HOURLY_RETENTION_HOURS = int(os.environ.get("HOURLY_RETENTION_HOURS", "48"))
+DAILY_RETENTION_DAYS = int(os.environ.get("DAILY_RETENTION_DAYS", "35"))
+MAX_WINDOW_HOURS = DAILY_RETENTION_DAYS * 24
+# Songs whose share of explicit votes is at or above this aren't clean.
+EXPLICIT_THRESHOLD = float(os.environ.get("EXPLICIT_THRESHOLD", "0.5"))
+USER_PLAYS_CHUNK = int(os.environ.get("USER_PLAYS_CHUNK", "5000"))
+DEADLOCK_RETRIES = 3
+
+TOP_SONGS_IN_WINDOW = sqlalchemy.text("""
+    SELECT ROW_NUMBER() OVER (ORDER BY windowed.plays DESC) AS Position,
+           song.song_name AS Song, artist.artist_name AS Artist, windowed.plays AS Streams
+    FROM (
+        SELECT song_id, SUM(play_count) AS plays
+        FROM (
+            SELECT song_id, play_count FROM song_play_hourly
+            WHERE bucket_start >= date_trunc('hour', now() - make_interval(hours => :hours))
+            UNION ALL
+            SELECT song_id, play_count FROM song_play_daily
+            WHERE bucket_start >= date_trunc('day', now() - make_interval(hours => :hours))
+        ) AS buckets
+        GROUP BY song_id
+        ORDER BY plays DESC
+        LIMIT :limit
+    ) AS windowed
+    JOIN song ON song.song_id = windowed.song_id
+    JOIN artist ON artist.id = song.artist_id
+    ORDER BY Position ASC
+    """)
+
+
+def rebuild_song_play_counts(connection):
+    """Recount song_play_counts from streams and archived plays. Concurrent writers wait on the lock."""
+    connection.execute(sqlalchemy.text("LOCK TABLE song_play_counts IN EXCLUSIVE MODE"))
+    connection.execute(sqlalchemy.text("DELETE FROM song_play_counts"))
+    return connection.execute(sqlalchemy.text("""
+        INSERT INTO song_play_counts (song_id, play_count)
+        SELECT song_id, SUM(play_count) FROM (
+            SELECT song_id, COUNT(*) AS play_count FROM streams
+            WHERE song_id IS NOT NULL
+            GROUP BY song_id
+            UNION ALL
+            SELECT song_id, play_count FROM streams_archived_plays
+        ) AS plays
+        GROUP BY song_id
+        """)).rowcount
+
+
+def check_song_play_counts(connection, sample=10):
+    """Songs whose rolled-up count disagrees with streams, as (song_id, rollup, actual)."""
+    connection.execute(sqlalchemy.text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+    return connection.execute(sqlalchemy.text("""
+        SELECT COALESCE(c.song_id, s.song_id) AS song_id,
+               COALESCE(c.play_count, 0) AS rollup,
+               COALESCE(s.play_count, 0) AS actual
+        FROM song_play_counts c
+        FULL JOIN (
+            SELECT song_id, SUM(play_count) AS play_count FROM (
+                SELECT song_id, COUNT(*) AS play_count FROM streams
+                WHERE song_id IS NOT NULL
+                GROUP BY song_id
+                UNION ALL
+                SELECT song_id, play_count FROM streams_archived_plays
+            ) AS plays
+            GROUP BY song_id
+        ) s ON s.song_id = c.song_id
+        WHERE COALESCE(c.play_count, 0) <> COALESCE(s.play_count, 0)
+        ORDER BY song_id
+        LIMIT :sample
+        """), {"sample": sample}).all()
+
+
+def rebuild_explicit_scores(connection):
+    """Recount song_explicit_scores from explicit_submissions. Concurrent raters wait on the lock."""
+    connection.execute(sqlalchemy.text("LOCK TABLE song_explicit_scores IN EXCLUSIVE MODE"))
+    connection.execute(sqlalchemy.text("DELETE FROM song_explicit_scores"))
+    return connection.execute(sqlalchemy.text("""
+        INSERT INTO song_explicit_scores (song_id, votes, explicit_votes)
+        SELECT song_id, COUNT(*), COUNT(*) FILTER (WHERE exbool <> 0) FROM explicit_submissions
+        WHERE song_id IS NOT NULL
+        GROUP BY song_id
+        """)).rowcount
+
+
+def check_explicit_scores(connection, sample=10):
+    """Songs whose rolled-up votes disagree with explicit_submissions, as (song_id, rollup, actual)."""
+    connection.execute(sqlalchemy.text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+    return connection.execute(sqlalchemy.text("""
+        SELECT COALESCE(e.song_id, s.song_id) AS song_id,
+               ARRAY[COALESCE(e.votes, 0), COALESCE(e.explicit_votes, 0)] AS rollup,
+               ARRAY[COALESCE(s.votes, 0), COALESCE(s.explicit_votes, 0)] AS actual
+        FROM song_explicit_scores e
+        FULL JOIN (
+            SELECT song_id, COUNT(*) AS votes, COUNT(*) FILTER (WHERE exbool <> 0) AS explicit_votes
+            FROM explicit_submissions
+            WHERE song_id IS NOT NULL
+            GROUP BY song_id
+        ) s ON s.song_id = e.song_id
+        WHERE (COALESCE(e.votes, 0), COALESCE(e.explicit_votes, 0))
+              IS DISTINCT FROM (COALESCE(s.votes, 0), COALESCE(s.explicit_votes, 0))
+        ORDER BY song_id
+        LIMIT :sample
+        """), {"sample": sample}).all()
+
+
+def rebuild_user_plays(connection, first_user_id, last_user_id):
+    """Recount user_song_plays and user_artist_plays for users first_user_id..last_user_id, archived plays included."""
+    params = {"first": first_user_id, "last": last_user_id}
+    connection.execute(sqlalchemy.text("""
+        SELECT user_id FROM users WHERE user_id BETWEEN :first AND :last ORDER BY user_id FOR UPDATE
+        """), params)
+    connection.execute(sqlalchemy.text("DELETE FROM user_song_plays WHERE user_id BETWEEN :first AND :last"), params)
+    connection.execute(sqlalchemy.text("DELETE FROM user_artist_plays WHERE user_id BETWEEN :first AND :last"), params)
+    rows = connection.execute(sqlalchemy.text("""
+        INSERT INTO user_song_plays (user_id, song_id, play_count, first_played_at, last_played_at)
+        SELECT user_id, song_id, SUM(play_count), MIN(first_played_at), MAX(last_played_at) FROM (
+            SELECT user_id, song_id, COUNT(*) AS play_count, MIN(created_at) AS first_played_at,
+                   MAX(created_at) AS last_played_at
+            FROM streams
+            WHERE user_id BETWEEN :first AND :last AND song_id IS NOT NULL
+            GROUP BY 1, 2
+            UNION ALL
+            SELECT user_id, song_id, play_count, first_played_at, last_played_at FROM streams_archived_plays
+            WHERE user_id BETWEEN :first AND :last
+        ) AS plays
+        GROUP BY 1, 2
+        """), params).rowcount
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO user_artist_plays (user_id, artist_id, play_count, first_played_at, last_played_at)
+        SELECT plays.user_id, song.artist_id, SUM(plays.play_count), MIN(plays.first_played_at),
+               MAX(plays.last_played_at)
+        FROM user_song_plays plays
+        JOIN song ON song.song_id = plays.song_id
+        WHERE plays.user_id BETWEEN :first AND :last AND song.artist_id IS NOT NULL
+        GROUP BY 1, 2
+        """), params)
+    return rows
+
+
+def _rebuild_user_chunk(bounds):
+    for attempt in range(1, DEADLOCK_RETRIES + 1):
+        try:
+            with db.engine.begin() as connection:
+                return rebuild_user_plays(connection, *bounds)
+        except sqlalchemy.exc.OperationalError as e:
+            # Ingest locks users in the same order, so this is only a safety net for other writers.
+            if getattr(e.orig, "pgcode", None) != "40P01" or attempt == DEADLOCK_RETRIES:
+                raise
+
+
+def backfill_user_plays(workers=4, chunk=USER_PLAYS_CHUNK):
+    """Rebuild the per-user profiles chunk by chunk on `workers` connections. Returns (users, rows)."""
+    with db.engine.begin() as connection:
+        low, high = connection.execute(sqlalchemy.text("SELECT MIN(user_id), MAX(user_id) FROM users")).one()
+    if low is None:
+        return 0, 0
+    bounds = [(start, min(start + chunk - 1, high)) for start in range(low, high + 1, chunk)]
+    with ThreadPoolExecutor(workers) as pool:
+        rows = sum(pool.map(_rebuild_user_chunk, bounds))
+    return high - low + 1, rows
+
+
+def check_user_plays(connection, sample=10):
+    """(table, key, rollup, actual) for per-user profile rows that disagree with streams."""
+    connection.execute(sqlalchemy.text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+    return connection.execute(sqlalchemy.text("""
+        WITH actual AS (
+            SELECT user_id, song_id, SUM(play_count) AS play_count, MIN(first_played_at) AS first_played_at,
+                   MAX(last_played_at) AS last_played_at
+            FROM (
+                SELECT user_id, song_id, COUNT(*) AS play_count, MIN(created_at) AS first_played_at,
+                       MAX(created_at) AS last_played_at
+                FROM streams
+                WHERE user_id IS NOT NULL AND song_id IS NOT NULL
+                GROUP BY user_id, song_id
+                UNION ALL
+                SELECT user_id, song_id, play_count, first_played_at, last_played_at FROM streams_archived_plays
+            ) AS plays
+            GROUP BY user_id, song_id
+        ),
+        actual_artists AS (
+            SELECT actual.user_id, song.artist_id, SUM(actual.play_count) AS play_count,
+                   MIN(actual.first_played_at) AS first_played_at, MAX(actual.last_played_at) AS last_played_at
+            FROM actual
+            JOIN song ON song.song_id = actual.song_id
+            WHERE song.artist_id IS NOT NULL
+            GROUP BY actual.user_id, song.artist_id
+        )
+        (SELECT 'user_song_plays' AS "table",
+                ARRAY[COALESCE(r.user_id, a.user_id), COALESCE(r.song_id, a.song_id)] AS key,
+                CONCAT_WS(' ', r.play_count, r.first_played_at, r.last_played_at) AS rollup,
+                CONCAT_WS(' ', a.play_count, a.first_played_at, a.last_played_at) AS actual
+         FROM user_song_plays r
+         FULL JOIN actual a ON a.user_id = r.user_id AND a.song_id = r.song_id
+         WHERE (r.play_count, r.first_played_at, r.last_played_at)
+               IS DISTINCT FROM (a.play_count, a.first_played_at, a.last_played_at)
+         LIMIT :sample)
+        UNION ALL
+        (SELECT 'user_artist_plays',
+                ARRAY[COALESCE(r.user_id, a.user_id), COALESCE(r.artist_id, a.artist_id)],
+                CONCAT_WS(' ', r.play_count, r.first_played_at, r.last_played_at),
+                CONCAT_WS(' ', a.play_count, a.first_played_at, a.last_played_at)
+         FROM user_artist_plays r
+         FULL JOIN actual_artists a ON a.user_id = r.user_id AND a.artist_id = r.artist_id
+         WHERE (r.play_count, r.first_played_at, r.last_played_at)
+               IS DISTINCT FROM (a.play_count, a.first_played_at, a.last_played_at)
+         LIMIT :sample)
+        """), {"sample": sample}).all()
+
+
+def compact_buckets(connection, hourly_retention_hours=HOURLY_RETENTION_HOURS,
+                    daily_retention_days=DAILY_RETENTION_DAYS):
+    """Fold old hourly buckets into daily ones and expire old daily buckets. Returns (folded, expired)."""
+    folded = connection.execute(sqlalchemy.text("""
+        WITH moved AS (
+            DELETE FROM song_play_hourly
+            WHERE bucket_start < date_trunc('day', now() - make_interval(hours => :hours))
+            RETURNING bucket_start, song_id, play_count
+        )
+        INSERT INTO song_play_daily (bucket_start, song_id, play_count)
+        SELECT date_trunc('day', bucket_start), song_id, SUM(play_count) FROM moved
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        ON CONFLICT (bucket_start, song_id) DO UPDATE
+        SET play_count = song_play_daily.play_count + EXCLUDED.play_count
+        """), {"hours": hourly_retention_hours}).rowcount
+    expired = connection.execute(sqlalchemy.text("""
+        DELETE FROM song_play_daily
+        WHERE bucket_start < date_trunc('day', now() - make_interval(days => :days))
+        """), {"days": daily_retention_days}).rowcount
+    return folded, expired
+
+
+def rebuild_buckets(connection, hourly_retention_hours=HOURLY_RETENTION_HOURS,
+                    daily_retention_days=DAILY_RETENTION_DAYS):
+    """Recount hourly and daily buckets from the streams still inside the retention window."""
+    connection.execute(sqlalchemy.text("LOCK TABLE song_play_hourly, song_play_daily IN EXCLUSIVE MODE"))
+    connection.execute(sqlalchemy.text("DELETE FROM song_play_hourly"))
+    connection.execute(sqlalchemy.text("DELETE FROM song_play_daily"))
+    params = {"hours": hourly_retention_hours, "days": daily_retention_days}
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO song_play_hourly (bucket_start, song_id, play_count)
+        SELECT date_trunc('hour', created_at), song_id, COUNT(*) FROM streams
+        WHERE song_id IS NOT NULL
+          AND created_at >= date_trunc('day', now() - make_interval(hours => :hours))
+        GROUP BY 1, 2
+        """), params)
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO song_play_daily (bucket_start, song_id, play_count)
+        SELECT date_trunc('day', created_at), song_id, COUNT(*) FROM streams
+        WHERE song_id IS NOT NULL
+          AND created_at >= date_trunc('day', now() - make_interval(days => :days))
+          AND created_at < date_trunc('day', now() - make_interval(hours => :hours))
+        GROUP BY 1, 2
+        """), params)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.rollups", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["rebuild", "backfill", "check", "compact"])
+    parser.add_argument("--sample", type=int, default=10, help="mismatches to print for check")
+    parser.add_argument("--workers", type=int, default=4, help="parallel connections for the per-user profiles")
+    parser.add_argument("--chunk", type=int, default=USER_PLAYS_CHUNK, help="users per backfill transaction")
+    args = parser.parse_args(argv)
+
+    if args.command == "backfill":
+        users, rows = backfill_user_plays(args.workers, args.chunk)
+        print(f"per-user profiles rebuilt: {users} user IDs, {rows} user/song rows")
+        return 0
+
+    if args.command == "rebuild":
+        with db.engine.begin() as connection:
+            rows = rebuild_song_play_counts(connection)
+            rebuild_buckets(connection)
+        with db.engine.begin() as connection:
+            scored = rebuild_explicit_scores(connection)
+        users, profile_rows = backfill_user_plays(args.workers, args.chunk)
+        print(f"song_play_counts rebuilt: {rows} songs; time buckets rebuilt; "
+              f"song_explicit_scores rebuilt: {scored} songs; "
+              f"per-user profiles rebuilt: {profile_rows} user/song rows")
+        return 0
+
+    if args.command == "compact":
+        with db.engine.begin() as connection:
+            folded, expired = compact_buckets(connection)
+        print(f"buckets compacted: {folded} daily buckets updated, {expired} expired")
+        return 0
+
+    with db.engine.begin() as connection:
+        mismatches = check_song_play_counts(connection, args.sample)
+    for song_id, rollup, actual in mismatches:
+        print(f"song_play_counts mismatch: song {song_id} rollup={rollup} streams={actual}")
+    with db.engine.begin() as connection:
+        score_mismatches = check_explicit_scores(connection, args.sample)
+    for song_id, rollup, actual in score_mismatches:
+        print(f"song_explicit_scores mismatch: song {song_id} rollup={rollup} submissions={actual}")
+    with db.engine.begin() as connection:
+        profile_mismatches = check_user_plays(connection, args.sample)
+    for table, key, rollup, actual in profile_mismatches:
+        print(f"{table} mismatch: {key} rollup={rollup or '-'} streams={actual or '-'}")
+    if mismatches or score_mismatches or profile_mismatches:
+        return 1
+    print("song_play_counts and per-user profiles consistent with streams; "
+          "song_explicit_scores consistent with explicit_submissions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,399 @@
+"""Ranked prefix and typo-tolerant search over songs, artists and albums.
+
+SEARCH_BACKEND=memory (default) keeps a trigram inverted index in process:
+every name is lower-cased and accent-stripped, each word contributes
+pg_trgm-style trigrams ("  w", " wo", "wor", "ord", "rd "), and postings are
+int32 arrays of document numbers. A query unions the postings of its rarest
+trigrams, scores the documents of the requested types sharing the most of
+them by exact trigram similarity, adds prefix matches from each type's
+name-sorted document order, and ranks
+
+    exact name > name prefix > word prefix, then by similarity, then shorter names.
+
+The index loads in a background thread at startup and then picks up new rows
+every SEARCH_REFRESH_INTERVAL seconds. /create_artist, /upload_music/ and
+/catalog/import/ refresh it as soon as they commit.
+
+SEARCH_BACKEND=pg_trgm runs the same ranking in Postgres against the
+trigram indexes from migrations/0005_search_trgm.sql. SEARCH_BACKEND=auto
+uses pg_trgm when the extension is installed and the in-process index
+otherwise.
+
+    python -m src.search bench --queries 2000
+"""
+import argparse
+import bisect
+import json
+import os
+import random
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from datetime import timedelta
+
+import dotenv
+import numpy as np
+import sqlalchemy
+from fastapi import HTTPException
+
+from src import database as db
+from src import pagination
+
+dotenv.load_dotenv()
+
+BACKEND = os.environ.get("SEARCH_BACKEND", "memory").lower()
+REFRESH_INTERVAL = float(os.environ.get("SEARCH_REFRESH_INTERVAL", "5"))
+REFRESH_OVERLAP = timedelta(seconds=60)
+MIN_SIMILARITY = float(os.environ.get("SEARCH_MIN_SIMILARITY", "0.3"))
+MAX_RESULTS = 200
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+QUERY_GRAMS = 6
+POSTING_BUDGET = 40000
+PREFIX_CANDIDATES = 500
+SIMILARITY_CANDIDATES = 128
+LOAD_FETCH_ROWS = 10000
+
+KINDS = ("song", "artist", "album")
+
+ARTISTS = sqlalchemy.text("""
+    SELECT id, artist_name, CAST(NULL AS text), created_at FROM artist
+    WHERE CAST(:since AS timestamptz) IS NULL OR created_at >= :since""")
+ALBUMS = sqlalchemy.text("""
+    SELECT album.id, album.album_name, artist.artist_name, album.added_date FROM album
+    LEFT JOIN artist ON artist.id = album.artist_id
+    WHERE CAST(:since AS timestamptz) IS NULL OR album.added_date >= :since""")
+SONGS = sqlalchemy.text("""
+    SELECT song.song_id, song.song_name, artist.artist_name, song.created_at FROM song
+    LEFT JOIN artist ON artist.id = song.artist_id
+    WHERE CAST(:since AS timestamptz) IS NULL OR song.created_at >= :since""")
+SOURCES = {"artist": ARTISTS, "album": ALBUMS, "song": SONGS}
+
+HAS_PG_TRGM = sqlalchemy.text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+
+# :prefix and :word_prefix are LIKE patterns built by _like_prefix.
+PG_SEARCH = sqlalchemy.text("""
+    SELECT kind, id, name, artist_name,
+           CASE WHEN lower(name) = :q THEN 3 WHEN lower(name) LIKE :prefix THEN 2
+                WHEN lower(name) LIKE :word_prefix THEN 1.5 ELSE 0 END + similarity(lower(name), :q) AS score
+    FROM (
+        SELECT 'artist' AS kind, id, artist_name AS name, CAST(NULL AS text) AS artist_name FROM artist
+        WHERE 'artist' = ANY(:kinds) AND (lower(artist_name) % :q OR lower(artist_name) LIKE :prefix OR lower(artist_name) LIKE :word_prefix)
+        UNION ALL
+        SELECT 'album', album.id, album.album_name, artist.artist_name FROM album
+        LEFT JOIN artist ON artist.id = album.artist_id
+        WHERE 'album' = ANY(:kinds) AND (lower(album.album_name) % :q OR lower(album.album_name) LIKE :prefix OR lower(album.album_name) LIKE :word_prefix)
+        UNION ALL
+        SELECT 'song', song.song_id, song.song_name, artist.artist_name FROM song
+        LEFT JOIN artist ON artist.id = song.artist_id
+        WHERE 'song' = ANY(:kinds) AND (lower(song.song_name) % :q OR lower(song.song_name) LIKE :prefix OR lower(song.song_name) LIKE :word_prefix)
+    ) AS hits
+    ORDER BY score DESC, length(name), kind, id
+    LIMIT :limit
+    """)
+
+
+def normalize(text):
+    """Lower-case, strip accents and collapse whitespace."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    return " ".join("".join(c if c.isalnum() else " " for c in text).split())
+
+
+def trigrams(norm):
+    """pg_trgm-style trigrams of a normalized string."""
+    grams = set()
+    for word in norm.split():
+        padded = "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _like_prefix(q):
+    escaped = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + "%", "% " + escaped + "%"
+
+
+class SearchIndex:
+    """Append-only trigram index; documents are numbered in the order they are added."""
+
+    def __init__(self):
+        self.kinds = array("b")
+        self.ids = array("i")
+        self.names = []
+        self.norms = []
+        self.artist_names = []
+        self.postings = {}
+        self.orders = {kind_code: array("i") for kind_code in range(len(KINDS))}
+        self.seen = {kind: bytearray() for kind in KINDS}
+        self.watermarks = {kind: None for kind in KINDS}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _is_seen(self, kind, entity_id):
+        seen = self.seen[kind]
+        return entity_id < len(seen) and seen[entity_id]
+
+    def add(self, kind, rows):
+        """Index (id, name, artist_name, created_at) rows not already indexed. Returns how many were new."""
+        kind_code = KINDS.index(kind)
+        added = []
+        with self._lock:
+            seen = self.seen[kind]
+            for entity_id, name, artist_name, created_at in rows:
+                mark = self.watermarks[kind]
+                self.watermarks[kind] = created_at if mark is None or created_at > mark else mark
+                if entity_id is None or self._is_seen(kind, entity_id):
+                    continue
+                if entity_id >= len(seen):
+                    seen.extend(bytes(max(entity_id + 1 - len(seen), len(seen))))
+                seen[entity_id] = 1
+                doc = len(self.ids)
+                norm = normalize(name)
+                grams = trigrams(norm)
+                self.kinds.append(kind_code)
+                self.ids.append(entity_id)
+                self.names.append(name)
+                self.norms.append(sys.intern(norm))
+                self.artist_names.append(sys.intern(artist_name) if artist_name is not None else None)
+                for gram in grams:
+                    posting = self.postings.get(gram)
+                    if posting is None:
+                        posting = self.postings[gram] = array("i")
+                    posting.append(doc)
+                added.append(doc)
+            order = self.orders[kind_code]
+            if len(added) > 1000:
+                self.orders[kind_code] = array("i", sorted(order + array("i", added), key=self.norms.__getitem__))
+            else:
+                for doc in added:
+                    order.insert(bisect.bisect_right(order, self.norms[doc], key=self.norms.__getitem__), doc)
+        return len(added)
+
+    def _prefix_docs(self, q, kind_codes):
+        """Up to PREFIX_CANDIDATES documents of each kind whose name starts with q."""
+        norms = self.norms
+        docs = []
+        for kind_code in sorted(kind_codes):
+            order = self.orders[kind_code]
+            start = bisect.bisect_left(order, q, key=norms.__getitem__)
+            for doc in order[start:start + PREFIX_CANDIDATES]:
+                if not norms[doc].startswith(q):
+                    break
+                docs.append(doc)
+        return docs
+
+    def _candidate_docs(self, grams, kind_codes):
+        """Documents of the given kinds sharing the most of the query's rarest trigrams, best first."""
+        postings = sorted((self.postings[g] for g in grams if g in self.postings), key=len)
+        if not postings:
+            return []
+        chosen, budget = [], POSTING_BUDGET
+        for posting in postings[:QUERY_GRAMS]:
+            if chosen and len(posting) > budget:
+                break
+            chosen.append(np.frombuffer(posting, dtype=np.int32))
+            budget -= len(posting)
+        docs, hits = np.unique(np.concatenate(chosen), return_counts=True)
+        if len(kind_codes) < len(KINDS):
+            # Filter before the cap, or the far more numerous songs crowd artists and albums out of it.
+            wanted = np.isin(np.frombuffer(self.kinds, dtype=np.int8)[docs], list(kind_codes))
+            docs, hits = docs[wanted], hits[wanted]
+        if len(docs) > SIMILARITY_CANDIDATES:
+            top = np.argpartition(-hits, SIMILARITY_CANDIDATES)[:SIMILARITY_CANDIDATES]
+            docs, hits = docs[top], hits[top]
+        return docs[np.argsort(-hits, kind="stable")].tolist()
+
+    def search(self, query, kinds=KINDS, limit=MAX_RESULTS):
+        """Up to limit (doc, score) pairs, best first."""
+        q = normalize(query)
+        if not q:
+            return []
+        kind_codes = {KINDS.index(kind) for kind in kinds}
+        grams = trigrams(q)
+        word_prefix = " " + q
+        with self._lock:
+            scores = {}
+            for doc in self._prefix_docs(q, kind_codes):
+                scores[doc] = 3.0 if self.norms[doc] == q else 2.0
+            for doc in self._candidate_docs(grams, kind_codes):
+                doc_grams = trigrams(self.norms[doc])
+                shared = len(grams & doc_grams)
+                similarity = shared / (len(grams) + len(doc_grams) - shared)
+                bonus = scores.get(doc, 1.5 if word_prefix in " " + self.norms[doc] else 0.0)
+                if bonus or similarity >= MIN_SIMILARITY:
+                    scores[doc] = bonus + similarity
+
+            ranked = sorted(((score, doc) for doc, score in scores.items()),
+                            key=lambda hit: (-hit[0], len(self.norms[hit[1]]), self.kinds[hit[1]], self.ids[hit[1]]))
+        return [(doc, score) for score, doc in ranked[:limit]]
+
+    def item(self, doc, score):
+        item = {"type": KINDS[self.kinds[doc]], "id": self.ids[doc], "name": self.names[doc], "score": round(score, 3)}
+        if self.artist_names[doc] is not None:
+            item["artist_name"] = self.artist_names[doc]
+        return item
+
+    def footprint(self):
+        """Approximate bytes held by the index arrays, names and postings."""
+        total = sum(sys.getsizeof(a) for a in (self.kinds, self.ids, *self.orders.values()))
+        total += sys.getsizeof(self.names) + sum(sys.getsizeof(name) for name in self.names)
+        total += sys.getsizeof(self.norms) + sum(sys.getsizeof(norm) for norm in self.norms)
+        total += sys.getsizeof(self.postings) + sum(sys.getsizeof(p) for p in self.postings.values())
+        return total
+
+
+class Search:
+    """The configured backend plus the worker keeping the in-process index current."""
+
+    def __init__(self, backend=BACKEND, refresh_interval=REFRESH_INTERVAL):
+        self.backend = backend
+        self.refresh_interval = refresh_interval
+        self.index = None
+        self._stopping = threading.Event()
+        self._worker = None
+        self._stats = {"queries": 0, "refreshes": 0, "indexed": 0, "failed_refreshes": 0, "load_ms": 0.0}
+
+    @property
+    def ready(self):
+        return self.backend == "pg_trgm" or self.index is not None
+
+    def _pull(self, index, connection, fetch_rows=None):
+        added = 0
+        for kind, statement in SOURCES.items():
+            mark = index.watermarks[kind]
+            params = {"since": mark - REFRESH_OVERLAP if mark is not None else None}
+            if fetch_rows:
+                result = connection.execution_options(stream_results=True, yield_per=fetch_rows).execute(statement, params)
+                for rows in result.partitions():
+                    added += index.add(kind, rows)
+            else:
+                added += index.add(kind, connection.execute(statement, params).all())
+        return added
+
+    def load(self):
+        start = time.perf_counter()
+        index = SearchIndex()
+        with db.engine.connect() as connection:
+            self._pull(index, connection, LOAD_FETCH_ROWS)
+        self.index = index
+        self._stats["indexed"] = len(index)
+        self._stats["load_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+    def refresh(self):
+        """Index rows created since the last load or refresh."""
+        if self.index is None:
+            return
+        with db.engine.connect() as connection:
+            self._stats["indexed"] += self._pull(self.index, connection)
+        self._stats["refreshes"] += 1
+
+    def start(self):
+        if self.backend == "auto":
+            with db.engine.connect() as connection:
+                self.backend = "pg_trgm" if connection.execute(HAS_PG_TRGM).scalar() else "memory"
+        if self.backend != "memory" or (self._worker is not None and self._worker.is_alive()):
+            return
+        self._stopping.clear()
+        self._worker = threading.Thread(target=self._run, name="search-index", daemon=True)
+        self._worker.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if self.index is None:
+                    self.load()
+                else:
+                    self.refresh()
+            except sqlalchemy.exc.SQLAlchemyError:
+                self._stats["failed_refreshes"] += 1
+            self._stopping.wait(self.refresh_interval)
+
+    def search(self, connection_factory, query, kinds=KINDS, limit=MAX_RESULTS):
+        """Ranked result items for query. connection_factory is only opened for pg_trgm."""
+        self._stats["queries"] += 1
+        if self.backend == "pg_trgm":
+            q = normalize(query)
+            if not q:
+                return []
+            prefix, word_prefix = _like_prefix(q)
+            with connection_factory() as connection:
+                rows = connection.execute(PG_SEARCH, {"q": q, "prefix": prefix, "word_prefix": word_prefix,
+                                                      "kinds": list(kinds), "limit": limit}).all()
+            return [{"type": row.kind, "id": row.id, "name": row.name, "score": round(float(row.score), 3),
+                     **({"artist_name": row.artist_name} if row.artist_name is not None else {})} for row in rows]
+        index = self.index
+        return [index.item(doc, score) for doc, score in index.search(query, kinds, limit)]
+
+    def page(self, connection_factory, query, kinds=KINDS, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """One page of ranked results; the cursor is an offset into the top MAX_RESULTS."""
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        unknown = set(kinds) - set(KINDS)
+        if unknown or not kinds:
+            raise HTTPException(status_code=400, detail=f"types must be a comma-separated subset of {','.join(KINDS)}")
+        if not self.ready:
+            raise HTTPException(status_code=503, detail="Search index is loading, try again later",
+                                headers={"Retry-After": "5"})
+        (offset,) = pagination.decode_cursor(cursor, 1)
+        offset = offset or 0
+        hits = self.search(connection_factory, query, kinds, MAX_RESULTS)
+        next_cursor = pagination.encode_cursor([offset + limit]) if len(hits) > offset + limit else None
+        return {"items": hits[offset:offset + limit], "next_cursor": next_cursor}
+
+    def metrics(self):
+        return {"ready": int(self.ready), "documents": len(self.index) if self.index is not None else 0, **self._stats}
+
+
+search_index = Search()
+
+
+def bench(queries=2000, seed=0):
+    """Load the index and time prefix, exact and one-typo queries drawn from it."""
+    search_index.backend = "memory"
+    search_index.load()
+    index = search_index.index
+    rng = random.Random(seed)
+    samples = []
+    for _ in range(queries):
+        name = index.norms[rng.randrange(len(index))] or "a"
+        style = rng.choice(["prefix", "exact", "typo"])
+        if style == "prefix":
+            samples.append(name[:rng.randint(1, max(1, min(6, len(name))))])
+        elif style == "typo" and len(name) > 3:
+            i = rng.randrange(len(name))
+            samples.append(name[:i] + rng.choice("abcdefghijklmnopqrstuvwxyz") + name[i + 1:])
+        else:
+            samples.append(name)
+    latencies = []
+    for q in samples:
+        start = time.perf_counter()
+        index.search(q, KINDS, 20)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return {"documents": len(index), "load_ms": search_index._stats["load_ms"], "bytes": index.footprint(),
+            "queries": queries, "p50_ms": round(latencies[len(latencies) // 2], 3),
+            "p99_ms": round(latencies[int(len(latencies) * 0.99)], 3), "max_ms": round(latencies[-1], 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.search", description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    print(json.dumps(bench(args.queries, args.seed), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
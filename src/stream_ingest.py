@@ -0,0 +1,272 @@
+"""Stream ingestion: set-based writes into streams plus an optional buffered writer.
+
+With STREAM_INGEST_MODE=buffered, log_streams hands resolved plays to an
+in-process bounded queue and a background worker flushes them to the database
+as multi-row batches once STREAM_BATCH_SIZE plays are waiting or
+STREAM_FLUSH_INTERVAL seconds have passed, whichever comes first.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+import dotenv
+import sqlalchemy
+
+from src import database as db
+
+dotenv.load_dotenv()
+
+BUFFERED = os.environ.get("STREAM_INGEST_MODE", "direct").lower() == "buffered"
+QUEUE_DEPTH = int(os.environ.get("STREAM_QUEUE_DEPTH", "50000"))
+BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", "1000"))
+FLUSH_INTERVAL = float(os.environ.get("STREAM_FLUSH_INTERVAL", "0.5"))
+PUT_TIMEOUT = float(os.environ.get("STREAM_PUT_TIMEOUT", "0.05"))
+FLUSH_RETRIES = 3
+BULK_MAX_PLAYS = int(os.environ.get("STREAM_BULK_MAX_PLAYS", "5000"))
+
+# Rollups maintained alongside streams (see src/rollups.py) are updated by
+# data-modifying CTEs in the same statement, so they commit with the plays.
+# The plays' users are locked first, in user_id order, before any rollup row:
+# the same order rollups.rebuild_user_plays locks in, so the two can't deadlock.
+INSERT_STREAMS = sqlalchemy.text("""
+    WITH listeners AS (
+        SELECT COUNT(*) FROM (
+            SELECT user_id FROM users WHERE user_id = ANY(CAST(:user_ids AS integer[]))
+            ORDER BY user_id
+            FOR KEY SHARE
+        ) AS locked
+    ),
+    inserted AS (
+        INSERT INTO streams (user_id, song_id, created_at)
+        SELECT play.user_id, play.song_id, play.created_at
+        -- Joining the one-row count makes every lock come before the first play is written.
+        FROM listeners,
+             unnest(CAST(:user_ids AS integer[]),
+                    CAST(:song_ids AS integer[]),
+                    CAST(:created_ats AS timestamptz[])) AS play(user_id, song_id, created_at)
+        RETURNING user_id, song_id, created_at
+    ),
+    song_counts AS (
+        INSERT INTO song_play_counts (song_id, play_count)
+        SELECT song_id, COUNT(*) FROM inserted
+        WHERE song_id IS NOT NULL
+        GROUP BY song_id
+        ORDER BY song_id
+        ON CONFLICT (song_id) DO UPDATE
+        SET play_count = song_play_counts.play_count + EXCLUDED.play_count
+    ),
+    hourly_counts AS (
+        INSERT INTO song_play_hourly (bucket_start, song_id, play_count)
+        SELECT date_trunc('hour', created_at), song_id, COUNT(*) FROM inserted
+        WHERE song_id IS NOT NULL
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        ON CONFLICT (bucket_start, song_id) DO UPDATE
+        SET play_count = song_play_hourly.play_count + EXCLUDED.play_count
+    ),
+    user_song_counts AS (
+        INSERT INTO user_song_plays (user_id, song_id, play_count, first_played_at, last_played_at)
+        SELECT user_id, song_id, COUNT(*), MIN(created_at), MAX(created_at) FROM inserted
+        WHERE user_id IS NOT NULL AND song_id IS NOT NULL
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        ON CONFLICT (user_id, song_id) DO UPDATE
+        SET play_count = user_song_plays.play_count + EXCLUDED.play_count,
+            first_played_at = LEAST(user_song_plays.first_played_at, EXCLUDED.first_played_at),
+            last_played_at = GREATEST(user_song_plays.last_played_at, EXCLUDED.last_played_at)
+    ),
+    user_artist_counts AS (
+        INSERT INTO user_artist_plays (user_id, artist_id, play_count, first_played_at, last_played_at)
+        SELECT inserted.user_id, song.artist_id, COUNT(*), MIN(inserted.created_at), MAX(inserted.created_at)
+        FROM inserted
+        JOIN song ON song.song_id = inserted.song_id
+        WHERE inserted.user_id IS NOT NULL AND song.artist_id IS NOT NULL
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        ON CONFLICT (user_id, artist_id) DO UPDATE
+        SET play_count = user_artist_plays.play_count + EXCLUDED.play_count,
+            first_played_at = LEAST(user_artist_plays.first_played_at, EXCLUDED.first_played_at),
+            last_played_at = GREATEST(user_artist_plays.last_played_at, EXCLUDED.last_played_at)
+    )
+    SELECT COUNT(*) FROM inserted
+    """)
+
+RESOLVE_PLAYS = sqlalchemy.text("""
+    SELECT play.ord, u.user_id, s.song_id
+    FROM unnest(CAST(:usernames AS text[]),
+                CAST(:song_names AS text[]),
+                CAST(:artist_names AS text[])) WITH ORDINALITY AS play(username, song_name, artist_name, ord)
+    LEFT JOIN LATERAL (
+        SELECT user_id FROM users WHERE username = play.username LIMIT 1
+    ) u ON true
+    LEFT JOIN LATERAL (
+        SELECT song.song_id FROM song
+        JOIN artist ON artist.id = song.artist_id
+        WHERE song.song_name = play.song_name AND artist.artist_name = play.artist_name
+        LIMIT 1
+    ) s ON true
+    ORDER BY play.ord
+    """)
+
+
+def now():
+    """Timestamp recorded for a play at the moment it is accepted."""
+    return datetime.now(timezone.utc)
+
+
+def insert_params(plays):
+    """Bind parameters for INSERT_STREAMS from (user_id, song_id, created_at) plays."""
+    user_ids, song_ids, created_ats = (list(column) for column in zip(*plays))
+    return {"user_ids": user_ids, "song_ids": song_ids, "created_ats": created_ats}
+
+
+def insert_streams(connection, plays):
+    """Insert (user_id, song_id, created_at) plays in a single statement."""
+    if not plays:
+        return 0
+    connection.execute(INSERT_STREAMS, insert_params(plays))
+    return len(plays)
+
+
+def resolve_plays(connection, plays):
+    """Map (username, song_name, artist_name) plays to (user_id, song_id) pairs, None where unknown."""
+    if not plays:
+        return []
+    usernames, song_names, artist_names = (list(column) for column in zip(*plays))
+    result = connection.execute(RESOLVE_PLAYS, {"usernames": usernames, "song_names": song_names,
+                                                "artist_names": artist_names})
+    return [(user_id, song_id) for _, user_id, song_id in result]
+
+
+class StreamBuffer:
+    """Bounded queue of plays drained by a background worker in multi-row batches."""
+
+    def __init__(self, max_depth=QUEUE_DEPTH, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 put_timeout=PUT_TIMEOUT):
+        self.max_depth = max_depth
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._worker = None
+        self._stats = {
+            "enqueued": 0,
+            "backpressured": 0,
+            "dropped": 0,
+            "flushed_batches": 0,
+            "flushed_plays": 0,
+            "failed_batches": 0,
+            "failed_plays": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    def _count(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                self._stats[name] += value
+
+    def start(self):
+        """Start the flush worker if it is not already running."""
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._stopping.clear()
+            self._worker = threading.Thread(target=self._run, name="stream-flush", daemon=True)
+            self._worker.start()
+
+    def stop(self, timeout=10.0):
+        """Flush everything still queued and stop the worker."""
+        self._stopping.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+
+    def put(self, plays):
+        """Queue plays, blocking briefly when full. Returns how many were accepted."""
+        self.start()
+        accepted = 0
+        for play in plays:
+            try:
+                self._queue.put_nowait(play)
+            except queue.Full:
+                self._count(backpressured=1)
+                try:
+                    self._queue.put(play, timeout=self.put_timeout)
+                except queue.Full:
+                    self._count(dropped=1)
+                    continue
+            accepted += 1
+        self._count(enqueued=accepted)
+        return accepted
+
+    def _drain(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get_nowait() if remaining <= 0 else self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        for attempt in range(1, FLUSH_RETRIES + 1):
+            start = time.perf_counter()
+            try:
+                with db.engine.begin() as connection:
+                    insert_streams(connection, batch)
+            except Exception:
+                logging.exception(f"Stream flush of {len(batch)} plays failed (attempt {attempt})")
+                time.sleep(min(0.1 * 2 ** attempt, 2.0))
+                continue
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                stats = self._stats
+                stats["flushed_batches"] += 1
+                stats["flushed_plays"] += len(batch)
+                stats["last_batch_size"] = len(batch)
+                stats["max_batch_size"] = max(stats["max_batch_size"], len(batch))
+                stats["last_flush_ms"] = elapsed_ms
+                stats["max_flush_ms"] = max(stats["max_flush_ms"], elapsed_ms)
+                stats["total_flush_ms"] += elapsed_ms
+            return
+        self._count(failed_batches=1, failed_plays=len(batch))
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._drain()
+            if batch:
+                self._flush(batch)
+
+    def metrics(self):
+        """Snapshot of queue and flush counters for tuning."""
+        with self._lock:
+            stats = dict(self._stats)
+        batches = stats.pop("flushed_batches")
+        total_flush_ms = stats.pop("total_flush_ms")
+        return {
+            "mode": "buffered" if BUFFERED else "direct",
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self.max_depth,
+            "batch_size_limit": self.batch_size,
+            "flush_interval_s": self.flush_interval,
+            "flushed_batches": batches,
+            "avg_batch_size": stats["flushed_plays"] / batches if batches else 0,
+            "avg_flush_ms": total_flush_ms / batches if batches else 0.0,
+            **stats,
+        }
+
+
+buffer = StreamBuffer()
@@ -0,0 +1,30 @@
+"""Stand-in for the OpenAI chat completions endpoint, for testing the recommender offline.
+
+    uvicorn src.stub_upstream:app --port 3001
+    OPENAI_BASE_URL=http://localhost:3001/v1 python main.py
+
+STUB_LATENCY_MS sets the typical response time; STUB_SLOW_RATE of the calls
+take STUB_SLOW_MS instead so the recommender's tail handling can be observed.
+"""
+import asyncio
+import os
+import random
+
+from fastapi import FastAPI, Request
+
+LATENCY_MS = float(os.environ.get("STUB_LATENCY_MS", "300"))
+SLOW_RATE = float(os.environ.get("STUB_SLOW_RATE", "0.02"))
+SLOW_MS = float(os.environ.get("STUB_SLOW_MS", "3000"))
+
+app = FastAPI(title="stub upstream")
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    prompt = body["messages"][-1]["content"]
+    delay_ms = SLOW_MS if random.random() < SLOW_RATE else random.uniform(0.5, 1.5) * LATENCY_MS
+    await asyncio.sleep(delay_ms / 1000)
+    genre = prompt.rsplit("that is", 1)[-1].strip(" .")
+    return {"choices": [{"index": 0, "message": {"role": "assistant",
+                                                 "content": f"Stub Song ({genre}) - Stub Artist"}}]}
@@ -0,0 +1,11 @@
+import os
+
+# src reads its settings at import time, so pin them before any test imports it.
+os.environ["API_KEY"] = "test-key"
+os.environ["RESPONSE_CACHE"] = "off"
+os.environ["CATALOG_SNAPSHOT"] = "0"
+os.environ["DB_BACKEND"] = "sync"
+os.environ.pop("API_KEYS", None)
+os.environ.pop("API_KEY_HASHES", None)
+os.environ.pop("POSTGRES_REPLICA_URIS", None)
+os.environ["POSTGRES_URI"] = os.environ.get("TEST_POSTGRES_URI", "postgresql://test@localhost:1/unused")
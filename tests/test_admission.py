@@ -0,0 +1,109 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from src import admission
+from src.api import server
+
+ROUTE = "/musicmain/resolver/metrics/"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def controller(monkeypatch, clock):
+    # One token a second, two in the bucket; at most one resolver_metrics request at a time.
+    controller = admission.Controller(admission.parse_keys("good:1:2"), None, {"resolver_metrics": 1}, clock=clock)
+    monkeypatch.setattr(admission, "controller", controller)
+    return controller
+
+
+@pytest.fixture
+def client(controller):
+    # Not entered as a context manager, so the startup hooks (pools, snapshot, listeners) don't run.
+    return TestClient(server.app)
+
+
+def get(client, key="good"):
+    return client.get(ROUTE, headers={"access_token": key} if key is not None else {})
+
+
+def test_missing_key_is_401(client, controller):
+    response = get(client, key=None)
+    assert response.status_code == 401
+    assert controller.metrics()["keys"][admission.key_id(admission.digest("good"))]["admitted"] == 0
+
+
+def test_unknown_key_is_401(client):
+    assert get(client, key="bad").status_code == 401
+
+
+def test_known_key_is_admitted(client, controller):
+    assert get(client).status_code == 200
+    assert controller.metrics()["keys"][admission.key_id(admission.digest("good"))]["admitted"] == 1
+
+
+def test_drained_bucket_is_429_until_refilled(client, controller, clock):
+    assert get(client).status_code == 200
+    assert get(client).status_code == 200
+
+    response = get(client)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    assert controller.metrics()["keys"][admission.key_id(admission.digest("good"))]["rate_limited"] == 1
+
+    clock.now += 0.5
+    assert get(client).status_code == 429
+
+    clock.now += 0.5
+    assert get(client).status_code == 200
+
+
+def test_retry_after_rounds_up(client, monkeypatch, clock):
+    slow = admission.Controller(admission.parse_keys("good:0.25:1"), None, clock=clock)
+    monkeypatch.setattr(admission, "controller", slow)
+    assert get(client).status_code == 200
+
+    response = get(client)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "4"
+
+
+def test_full_route_is_503_and_refunds_the_token(client, controller):
+    release = controller.admit(admission.digest("good"), "resolver_metrics")
+
+    response = get(client)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(admission.SHED_RETRY_AFTER)
+    assert controller.metrics()["routes"]["resolver_metrics"]["shed"] == 1
+
+    release()
+    # The held request took one token and the shed one got its token back, so one is left.
+    assert get(client).status_code == 200
+
+
+def test_route_slot_is_released_after_the_response(client, controller):
+    assert get(client).status_code == 200
+    assert get(client).status_code == 200
+
+    routes = controller.metrics()["routes"]
+    assert routes["resolver_metrics"] == {"in_flight": 0, "shed": 0, "cap": 1}
+    assert controller.metrics()["keys"][admission.key_id(admission.digest("good"))]["in_flight"] == 0
+
+
+def test_other_routes_are_not_capped(client, controller):
+    release = controller.admit(admission.digest("good"), "resolver_metrics")
+    try:
+        assert client.get("/musicmain/admission/metrics/", headers={"access_token": "good"}).status_code == 200
+    finally:
+        release()
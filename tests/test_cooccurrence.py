@@ -0,0 +1,38 @@
+import collections
+
+import numpy as np
+
+from src import cooccurrence
+
+
+def memberships(rows):
+    rows = np.array(rows, dtype=np.int64).reshape(-1, 2)
+    return rows[:, 0], rows[:, 1]
+
+
+def pair_counts(rows):
+    counts = collections.Counter()
+    for sources, targets, weights in cooccurrence.top_neighbors(*memberships(rows), neighbors=1000):
+        for pair in zip(sources.tolist(), targets.tolist(), weights.tolist()):
+            counts[pair[:2]] += pair[2]
+    return counts
+
+
+def test_catch_up_turns_snapshot_counts_into_current_ones():
+    snapshot = [(1, 10), (1, 11), (1, 12), (2, 10), (2, 11), (3, 12), (3, 13), (4, 14), (4, 15)]
+    # Playlist 1 swaps 12 for 13, playlist 3 gains 10, playlist 4 is emptied and 5 is new.
+    current = [(1, 10), (1, 11), (1, 13), (2, 10), (2, 11), (3, 12), (3, 13), (3, 10), (5, 11), (5, 12)]
+    edited = [1, 3, 4, 5]
+    members = [row for row in current if row[0] in edited]
+
+    counts = pair_counts(snapshot)
+    for pair in zip(*(column.tolist() for column in cooccurrence.catch_up(*memberships(snapshot), edited, members))):
+        counts[pair[:2]] += pair[2]
+
+    assert +counts == pair_counts(current)
+
+
+def test_catch_up_without_changes_is_empty():
+    snapshot = [(1, 10), (1, 11)]
+    sources, targets, weights = cooccurrence.catch_up(*memberships(snapshot), [1], snapshot)
+    assert len(sources) == len(targets) == len(weights) == 0
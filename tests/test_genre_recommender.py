@@ -0,0 +1,48 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from src import genre_recommender
+
+ANSWER = json.dumps({"choices": [{"message": {"content": "Song - Artist"}}]}).encode()
+
+
+class Trickle(httpx.AsyncByteStream):
+    """A body sent a byte at a time, each arriving well inside the read timeout."""
+
+    async def __aiter__(self):
+        for byte in ANSWER:
+            await asyncio.sleep(0.01)
+            yield bytes([byte])
+
+
+def recommender(stream):
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, stream=stream))
+    return genre_recommender.GenreRecommender(base_url="http://upstream", timeout=0.2, transport=transport)
+
+
+def test_slow_upstream_is_cut_off_at_the_total_timeout():
+    slow = recommender(Trickle())
+
+    async def ask():
+        start = time.perf_counter()
+        with pytest.raises(genre_recommender.UpstreamError):
+            await slow.recommend("jazz")
+        return time.perf_counter() - start
+
+    assert asyncio.run(ask()) < 0.5
+    assert slow.upstream_errors == 1
+    assert slow.metrics()["inflight"] == 0
+
+
+def test_prompt_answer_is_cached():
+    fast = recommender(httpx.ByteStream(ANSWER))
+
+    async def ask():
+        return [await fast.recommend(genre) for genre in ("Indie  Folk", "indie folk")]
+
+    assert asyncio.run(ask()) == ["Song - Artist", "Song - Artist"]
+    assert fast.upstream_calls == 1
@@ -0,0 +1,26 @@
+from src import response_cache
+
+
+def test_generations_are_bounded():
+    backend = response_cache.MemoryBackend(maxsize=3, ttl=60)
+    for n in range(100):
+        backend.generation([f"artist:{n}"])
+        backend.bump([f"album:{n}"])
+    assert len(backend.generations) == 3
+
+
+def test_evicted_tag_does_not_revive_stale_entries():
+    backend = response_cache.MemoryBackend(maxsize=2, ttl=60)
+    before = backend.generation(["artist:a"])
+    backend.bump(["artist:a"])
+    backend.generation(["artist:b"])
+    backend.generation(["artist:c"])
+    after = backend.generation(["artist:a"])
+    assert after != before
+
+
+def test_untouched_tag_keeps_its_generation_across_eviction():
+    backend = response_cache.MemoryBackend(maxsize=1, ttl=60)
+    first = backend.generation(["artist:a"])
+    backend.generation(["artist:b"])
+    assert backend.generation(["artist:a"]) == first
@@ -0,0 +1,192 @@
+"""Each lookup-then-fetch route answers found, not-found and empty in one statement.
+
+Needs a scratch Postgres in TEST_POSTGRES_URI; migrations are applied to it
+and the rows seeded here are deleted afterwards.
+"""
+import os
+import uuid
+
+import pytest
+import sqlalchemy
+from fastapi.testclient import TestClient
+
+from src import admission
+from src import database as db
+from src import migrate
+from src.api import server
+
+pytestmark = pytest.mark.skipif(not os.environ.get("TEST_POSTGRES_URI"), reason="TEST_POSTGRES_URI is not set")
+
+
+@pytest.fixture(scope="module")
+def names():
+    tag = f"round-trips-{uuid.uuid4().hex[:8]}"
+    names = {key: f"{tag}-{key}" for key in
+             ["listener", "idle", "performer", "silent", "album", "empty_album", "song", "mix", "blank", "missing"]}
+    migrate.up(log=lambda message: None)
+    with db.engine.begin() as connection:
+        def insert(sql, **params):
+            return connection.execute(sqlalchemy.text(sql), params).scalar_one()
+
+        listener = insert("INSERT INTO users (username) VALUES (:name) RETURNING user_id", name=names["listener"])
+        idle = insert("INSERT INTO users (username) VALUES (:name) RETURNING user_id", name=names["idle"])
+        performer = insert("INSERT INTO artist (artist_name) VALUES (:name) RETURNING id", name=names["performer"])
+        silent = insert("INSERT INTO artist (artist_name) VALUES (:name) RETURNING id", name=names["silent"])
+        album = insert("""INSERT INTO album (album_name, artist_id, genre, explicit_rating, label, release_date)
+                          VALUES (:name, :artist_id, 'Rock', 0, 'Label', '2020-01-01') RETURNING id""",
+                       name=names["album"], artist_id=performer)
+        empty_album = insert("INSERT INTO album (album_name, artist_id) VALUES (:name, :artist_id) RETURNING id",
+                             name=names["empty_album"], artist_id=performer)
+        song = insert("""INSERT INTO song (artist_id, song_name, featured_artist, explicit_rating, length, album_id)
+                         VALUES (:artist_id, :name, '', 0, 180, :album_id) RETURNING song_id""",
+                      artist_id=performer, name=names["song"], album_id=album)
+        insert("INSERT INTO streams (user_id, song_id) VALUES (:user_id, :song_id) RETURNING stream_id",
+               user_id=listener, song_id=song)
+        mix = insert("INSERT INTO user_playlist (playlist_name, user_id) VALUES (:name, :user_id) RETURNING playlist_id",
+                     name=names["mix"], user_id=listener)
+        insert("INSERT INTO user_playlist (playlist_name, user_id) VALUES (:name, :user_id) RETURNING playlist_id",
+               name=names["blank"], user_id=listener)
+        insert("""INSERT INTO song_playlist (user_id, playlist_id, song_id, position)
+                  VALUES (:user_id, :playlist_id, :song_id, 1) RETURNING song_id""",
+               user_id=listener, playlist_id=mix, song_id=song)
+    yield names
+    with db.engine.begin() as connection:
+        for sql, params in [
+            ("DELETE FROM user_playlist WHERE user_id IN (:listener, :idle)", {"listener": listener, "idle": idle}),
+            ("DELETE FROM streams WHERE user_id IN (:listener, :idle)", {"listener": listener, "idle": idle}),
+            ("DELETE FROM song WHERE song_id = :song", {"song": song}),
+            ("DELETE FROM album WHERE id IN (:album, :empty_album)", {"album": album, "empty_album": empty_album}),
+            ("DELETE FROM artist WHERE id IN (:performer, :silent)", {"performer": performer, "silent": silent}),
+            ("DELETE FROM users WHERE user_id IN (:listener, :idle)", {"listener": listener, "idle": idle}),
+        ]:
+            connection.execute(sqlalchemy.text(sql), params)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Unlimited key and no route caps, so admission never gets in the way of the counts.
+    monkeypatch.setattr(admission, "controller", admission.Controller(admission.parse_keys("test-key:0"), None))
+    return TestClient(server.app)
+
+
+@pytest.fixture
+def post(client, names):
+    """POSTs to a musicmain route and returns (response body, statements it sent)."""
+    captured = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        captured.append(statement)
+
+    def post(path, params=None, json=None):
+        captured.clear()
+        response = client.post(f"/musicmain/{path}", params=params, json=json, headers={"access_token": "test-key"})
+        assert response.status_code == 200
+        return response.json(), list(captured)
+
+    # Opens the pooled connection first, so connect-time statements aren't counted.
+    post("song_info/", {"song_name": names["missing"], "artist_name": names["missing"]})
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute", record)
+    yield post
+    sqlalchemy.event.remove(db.engine, "before_cursor_execute", record)
+
+
+def test_song_info(post, names):
+    body, statements = post("song_info/", {"song_name": names["song"], "artist_name": names["performer"]})
+    assert [song["Name"] for song in body] == [names["song"]]
+    assert len(statements) == 1
+
+    body, statements = post("song_info/", {"song_name": names["song"], "artist_name": names["silent"]})
+    assert body == "Song does not exist by this Artist!"
+    assert len(statements) == 1
+
+
+def test_album_info(post, names):
+    body, statements = post("album_info/", {"album_name": names["album"]})
+    assert [(album["Artist"], album["Genre"]) for album in body] == [(names["performer"], "Rock")]
+    assert len(statements) == 1
+
+    body, statements = post("album_info/", {"album_name": names["missing"]})
+    assert body == "Album does not exist!"
+    assert len(statements) == 1
+
+
+def test_artist_albums(post, names):
+    body, statements = post("artist_albums/", {"artist_name": names["performer"]})
+    assert [album["album_name"] for album in body["items"]] == [names["album"], names["empty_album"]]
+    assert len(statements) == 1
+
+    body, statements = post("artist_albums/", {"artist_name": names["missing"]})
+    assert body == "Artist does not exist!"
+    assert len(statements) == 1
+
+    body, statements = post("artist_albums/", {"artist_name": names["silent"]})
+    assert body == {"items": [], "next_cursor": None}
+    assert len(statements) == 1
+
+
+def test_album_songs(post, names):
+    body, statements = post("album_songs/", {"album_name": names["album"]})
+    assert [song["song_name"] for song in body["items"]] == [names["song"]]
+    assert len(statements) == 1
+
+    body, statements = post("album_songs/", {"album_name": names["missing"]})
+    assert body == "Album does not exist!"
+    assert len(statements) == 1
+
+    body, statements = post("album_songs/", {"album_name": names["empty_album"]})
+    assert body == {"items": [], "next_cursor": None}
+    assert len(statements) == 1
+
+
+def test_get_total_streams(post, names):
+    body, statements = post("get_total_streams/", {"username": names["listener"]})
+    assert [play["song_name"] for play in body["items"]] == [names["song"]]
+    assert len(statements) == 1
+
+    body, statements = post("get_total_streams/", {"username": names["missing"]})
+    assert body == "User does not exist!"
+    assert len(statements) == 1
+
+    body, statements = post("get_total_streams/", {"username": names["idle"]})
+    assert body == {"items": [], "next_cursor": None}
+    assert len(statements) == 1
+
+
+def test_get_stream_by_artist(post, names):
+    def by_artist(username, artist_name):
+        return post("get_stream_by_artist/", json={"user": {"username": username},
+                                                   "artist": {"artist_name": artist_name}})
+
+    body, statements = by_artist(names["listener"], names["performer"])
+    assert [play["song_name"] for play in body["items"]] == [names["song"]]
+    assert len(statements) == 1
+
+    body, statements = by_artist(names["missing"], names["performer"])
+    assert body == "User doesn't exist!"
+    assert len(statements) == 1
+
+    body, statements = by_artist(names["listener"], names["missing"])
+    assert body == "Artist doesn't exist!"
+    assert len(statements) == 1
+
+    body, statements = by_artist(names["listener"], names["silent"])
+    assert body == {"items": [], "next_cursor": None}
+    assert len(statements) == 1
+
+
+def test_view_playlist(post, names):
+    body, statements = post("view_playlist/", {"playlist_name": names["mix"], "username": names["listener"]})
+    assert [song["song_name"] for song in body["items"]] == [names["song"]]
+    assert len(statements) == 1
+
+    body, statements = post("view_playlist/", {"playlist_name": names["mix"], "username": names["missing"]})
+    assert body == "User does not exist!"
+    assert len(statements) == 1
+
+    body, statements = post("view_playlist/", {"playlist_name": names["missing"], "username": names["listener"]})
+    assert body == "Playlist does not exist!"
+    assert len(statements) == 1
+
+    body, statements = post("view_playlist/", {"playlist_name": names["blank"], "username": names["listener"]})
+    assert body == {"items": [], "next_cursor": None}
+    assert len(statements) == 1
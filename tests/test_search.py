@@ -0,0 +1,44 @@
+from datetime import datetime, timezone
+
+from src import search
+
+CREATED = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def index_with_crowding_songs():
+    index = search.SearchIndex()
+    index.add("song", [(n, f"Metallic song {n}", "Someone", CREATED) for n in range(1, 3000)])
+    index.add("artist", [(1, "Metallica", None, CREATED)])
+    index.add("album", [(1, "Metal Machine Music", "Lou Reed", CREATED)])
+    return index
+
+
+def found(index, query, kinds):
+    return [(search.KINDS[index.kinds[doc]], index.names[doc]) for doc, _ in index.search(query, kinds)]
+
+
+def test_type_filtered_prefix_query_is_not_crowded_out():
+    index = index_with_crowding_songs()
+    assert found(index, "metal", ["artist"]) == [("artist", "Metallica")]
+    assert found(index, "metal", ["album"]) == [("album", "Metal Machine Music")]
+
+
+def test_type_filtered_typo_query_is_not_crowded_out():
+    index = index_with_crowding_songs()
+    assert found(index, "metalica", ["artist"]) == [("artist", "Metallica")]
+
+
+def test_unfiltered_prefix_query_ranks_every_type():
+    index = index_with_crowding_songs()
+    hits = found(index, "metal", search.KINDS)
+    assert ("artist", "Metallica") in hits and ("album", "Metal Machine Music") in hits
+    assert {kind for kind, _ in hits} == {"song", "artist", "album"}
+
+
+def test_prefix_order_stays_sorted_across_small_and_bulk_adds():
+    index = search.SearchIndex()
+    index.add("song", [(n, f"song {n:04d}", None, CREATED) for n in range(2000, 0, -1)])
+    index.add("song", [(2001, "aaa", None, CREATED)])
+    order = index.orders[search.KINDS.index("song")]
+    assert [index.norms[doc] for doc in order] == sorted(index.norms)
+    assert len(index.orders[search.KINDS.index("artist")]) == 0